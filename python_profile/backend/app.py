@@ -1,24 +1,68 @@
-from flask import Flask, request, jsonify, session
+from flask import Flask, Request, request, jsonify, session, g, Response, send_from_directory, stream_with_context
 from flask_cors import CORS
 import os
-import pickle
-import pstats
 import cProfile
 import io
 import tempfile
 from werkzeug.utils import secure_filename
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import json
 import uuid
+import argparse
 import hashlib
+import itertools
+import math
+import re
 import shutil
 import threading
 import time
+import multiprocessing
+import numpy as np
+from profile_table import (CATEGORIES, TABLE_SUFFIX, ProfileTable, load_table, release_table, release_tables,
+                           resolve_sort_column, table_views)
+from profile_views import MAX_TREE_NODES, ORDER_COLUMNS, collapsed_stacks, flame_tree_view
+from comparison import SessionComparisons
+from regression import detect_regressions, mann_whitney
+from profile_parser import SUMMARY_FUNCTION_COUNT, parse_profile_batch, parse_profile_file, table_profile_data
+from profile_formats import DEFAULT_SAMPLE_SECONDS, supported_extensions
+from profile_merge import merge_profile_dumps
+from upload_archives import ArchiveTooLarge, extract_profile_members, is_archive
+from parse_jobs import ParseJobQueue, QueueFullError
+from call_graph import diff_subgraphs, subgraph_view
+from function_index import search_tables
+from query_cache import QueryCache
+from metrics import MetricsRegistry
+from response_compression import compress_response
+from blob_store import BlobQuotaExceeded, BlobStore
+from chunked_uploads import ChunkedUploadError, ChunkedUploads, decoded_filename
+from live_profiles import LiveStreamError, LiveStreams
+from parse_cache import ParseCache, hash_file, link_or_copy, save_stream_with_hash
+from profile_store import ProfileStore
+from session_expiry import ExpiryScheduler, SessionExpiryIndex
+from trend_store import TrendRunExists, TrendStore, validate_name
+from downsample import lttb, min_max_buckets
+from process_coordination import ProcessLock, load_or_create_secret_key
+
+# Endpoints that take many dumps at once get BULK_MAX_CONTENT_LENGTH instead of MAX_CONTENT_LENGTH
+BULK_UPLOAD_ENDPOINTS = {'upload_profile_batch', 'merge_profiles'}
+# Called by profiling agents with a stream token rather than a browser session
+SESSIONLESS_ENDPOINTS = {'ingest_live_samples'}
+
+class ProfileRequest(Request):
+    @property
+    def max_content_length(self):
+        if self.endpoint in BULK_UPLOAD_ENDPOINTS:
+            return app.config['BULK_MAX_CONTENT_LENGTH']
+        return super().max_content_length
 
 app = Flask(__name__)
+app.request_class = ProfileRequest
 
 # Configuration without Redis
-app.config['SECRET_KEY'] = os.urandom(24)  # Random secret key
+# Sessions are signed cookies, so every server process must share one key:
+# SECRET_KEY from the environment, else a key file created on first start
+app.config['SECRET_KEY_FILE'] = os.environ.get('SECRET_KEY_FILE', 'secret_key')
+app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY') or load_or_create_secret_key(app.config['SECRET_KEY_FILE'])
 app.config['SESSION_TYPE'] = 'filesystem'  # Use filesystem instead of Redis
 app.config['SESSION_FILE_DIR'] = os.path.join(os.getcwd(), 'sessions')  # Session storage directory
 app.config['SESSION_PERMANENT'] = True
@@ -32,7 +76,37 @@ app.config['SESSION_COOKIE_SECURE'] = False  # Set True in production with HTTPS
 
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['PROFILES_STORAGE_DIR'] = 'profile_data'
+app.config['PROFILE_TABLES_DIR'] = 'profile_tables'
+app.config['PARSE_CACHE_DIR'] = 'parse_cache'
+app.config['PARSE_CACHE_MAX_BYTES'] = 2 * 1024 * 1024 * 1024
+app.config['SESSION_INDEX_PATH'] = 'session_index.db'
+# Raw uploads, stored once per content hash and compressed
+app.config['BLOB_STORE_DIR'] = 'blob_store'
+app.config['BLOB_SESSION_QUOTA_BYTES'] = int(os.environ.get('BLOB_SESSION_QUOTA_BYTES', 1024 * 1024 * 1024))
+app.config['BLOB_GLOBAL_QUOTA_BYTES'] = int(os.environ.get('BLOB_GLOBAL_QUOTA_BYTES', 20 * 1024 * 1024 * 1024))
+app.config['BLOB_UNREFERENCED_TTL_SECONDS'] = int(os.environ.get('BLOB_UNREFERENCED_TTL_SECONDS', 3600))
+app.config['JOB_STATE_DIR'] = 'job_state'
+# Held by the one process per host that runs the expiry cleanup
+app.config['CLEANUP_LOCK_PATH'] = 'cleanup.lock'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+app.config['BULK_MAX_CONTENT_LENGTH'] = int(os.environ.get('BULK_MAX_CONTENT_LENGTH', 512 * 1024 * 1024))
+# Resumable uploads (/api/uploads) take dumps of any size up to this, one chunk per request
+app.config['CHUNKED_UPLOAD_MAX_BYTES'] = int(os.environ.get('CHUNKED_UPLOAD_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+app.config['CHUNKED_UPLOAD_CHUNK_BYTES'] = 8 * 1024 * 1024
+# Opt-in self-profiling: run cProfile on every Nth request (0 disables)
+app.config['SELF_PROFILE_EVERY'] = int(os.environ.get('SELF_PROFILE_EVERY', '0'))
+app.config['SELF_PROFILE_DIR'] = 'self_profiles'
+# JSON bodies at least this large are gzip/brotli compressed when the client accepts it
+app.config['COMPRESS_MIN_BYTES'] = 1024
+# Opt-in persistent history of runs tagged with a job name (see trend_store); unset disables it
+app.config['TREND_STORE_DIR'] = os.environ.get('TREND_STORE_DIR')
+app.config['TREND_FUNCTIONS_PER_RUN'] = int(os.environ.get('TREND_FUNCTIONS_PER_RUN', '10000'))
+# Live profiles fed by sampling agents (see live_profiles)
+app.config['LIVE_STREAMS_DIR'] = 'live_streams'
+app.config['LIVE_MAX_FUNCTIONS'] = int(os.environ.get('LIVE_MAX_FUNCTIONS', '50000'))
+app.config['LIVE_MAX_EDGES'] = int(os.environ.get('LIVE_MAX_EDGES', '250000'))
+app.config['LIVE_SNAPSHOT_SECONDS'] = float(os.environ.get('LIVE_SNAPSHOT_SECONDS', '2'))
+app.config['LIVE_STREAM_IDLE_SECONDS'] = int(os.environ.get('LIVE_STREAM_IDLE_SECONDS', 3600))
 
 # Initialize CORS
 CORS(app, supports_credentials=True, origins=['*'])
@@ -41,11 +115,120 @@ CORS(app, supports_credentials=True, origins=['*'])
 os.makedirs(app.config['SESSION_FILE_DIR'], exist_ok=True)
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['PROFILES_STORAGE_DIR'], exist_ok=True)
+os.makedirs(app.config['PROFILE_TABLES_DIR'], exist_ok=True)
+os.makedirs(app.config['SELF_PROFILE_DIR'], exist_ok=True)
+
+# Every extension some registered profile format claims (see profile_formats)
+ALLOWED_EXTENSIONS = set(supported_extensions())
+
+MAX_PAGE_SIZE = 1000
+MAX_GRAPH_HOPS = 6
+MAX_GRAPH_NODES = 2000
+MAX_HOTSPOT_FUNCTIONS = 100
+
+# Call-graph query results keyed by profile content, so repeated UI clicks are cheap
+call_graph_cache = QueryCache(maxsize=256)
+# Function comparisons keyed by the compared slots' content hashes
+comparison_cache = QueryCache(maxsize=64)
+# Hotspot and flame tree responses keyed by profile content and query
+view_cache = QueryCache(maxsize=128)
+# Per-session function axis and slot columns, updated slot by slot as uploads land
+comparison_states = SessionComparisons(maxsize=32)
+MAX_COMPARE_FUNCTIONS = 500
+
+# Bump whenever parse_profile_file output changes so stale cache entries are ignored
+PARSE_CACHE_VERSION = 8
+parse_cache = ParseCache(app.config['PARSE_CACHE_DIR'], app.config['PARSE_CACHE_MAX_BYTES'],
+                         version=PARSE_CACHE_VERSION)
+
+# Self-monitoring for this process, served on /api/metrics
+# Under gunicorn, workers publish to METRICS_SHARED_DIR so any of them can answer /api/metrics for the host
+metrics = MetricsRegistry(shared_dir=os.environ.get('METRICS_SHARED_DIR'))
+request_latency = metrics.histogram('profile_http_request_duration_seconds',
+                                    'Request latency by endpoint, method and status')
+parse_job_duration = metrics.histogram('profile_parse_job_duration_seconds',
+                                       'Parse and merge job time from submission to completion, by final state',
+                                       buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0))
+parse_cache_lookups = metrics.counter('profile_parse_cache_lookups_total', 'Parse cache lookups by result')
+upload_bytes = metrics.counter('profile_upload_bytes_total', 'Bytes of uploaded files written to disk')
+cleanup_duration = metrics.histogram('profile_cleanup_duration_seconds', 'Duration of expired session cleanup runs')
+cleanup_removed = metrics.counter('profile_cleanup_sessions_removed_total', 'Expired sessions removed by cleanup')
+live_samples = metrics.counter('profile_live_samples_total', 'Stack samples folded into live streams')
+live_snapshot_duration = metrics.histogram('profile_live_snapshot_duration_seconds',
+                                           'Time to rebuild a live slot from its stream aggregate')
+self_profiles_written = metrics.counter('profile_self_profiles_written_total', 'Self-profiling dumps saved')
+SELF_PROFILE_KEEP = 100
+self_profile_counter = itertools.count(1)
+self_profile_lock = threading.Lock()
+
+def record_job_finished(job):
+    parse_job_duration.observe(job['finished_at'] - job['submitted_at'], state=job['state'])
+
+# Parsing runs in a bounded process pool; uploads beyond PARSE_MAX_PENDING get a 503
+# Each server process has its own pool; set PARSE_WORKERS lower when running several processes
+PARSE_WORKERS = int(os.environ.get('PARSE_WORKERS', 0)) or min(8, os.cpu_count() or 2)
+PARSE_MAX_PENDING = 32
+PARSE_TIMEOUT_SECONDS = 300
+parse_jobs = ParseJobQueue(PARSE_WORKERS, PARSE_MAX_PENDING, PARSE_TIMEOUT_SECONDS,
+                           on_finished=record_job_finished, state_dir=app.config['JOB_STATE_DIR'])
+# Upper bound on dumps folded into one merged profile (files plus archive members)
+MERGE_MAX_FILES = 5000
+# Uncompressed bytes one archive member, and all archives of one merge, may expand to
+ARCHIVE_MAX_MEMBER_BYTES = int(os.environ.get('ARCHIVE_MAX_MEMBER_BYTES', 512 * 1024 * 1024))
+MERGE_MAX_EXTRACT_BYTES = int(os.environ.get('MERGE_MAX_EXTRACT_BYTES', 2 * 1024 * 1024 * 1024))
+# Upper bound on slots filled by one batch upload
+BATCH_MAX_FILES = 500
+# Uncompressed bytes all archives of one batch upload may expand to
+MAX_BATCH_EXTRACT_BYTES = int(os.environ.get('MAX_BATCH_EXTRACT_BYTES', 2 * 1024 * 1024 * 1024))
+
+def slot_summary(profile):
+    """Small per-slot summary for /api/profiles listings, stored next to each record"""
+    data = profile.get('data') or {}
+    return {
+        'filename': profile.get('filename'),
+        'uploaded_at': profile.get('uploaded_at'),
+        'content_hash': profile.get('content_hash'),
+        'total_calls': data.get('total_calls', 0),
+        'total_time': data.get('total_time', 0),
+        'function_count': data.get('function_count', len(data.get('functions', []))),
+        'has_table': bool(profile.get('table_path')),
+        'error': data.get('error')
+    }
 
-ALLOWED_EXTENSIONS = {'prof', 'pstats', 'pkl'}
+# Per-session slot storage; each session has its own database and lock
+blob_store = BlobStore(app.config['BLOB_STORE_DIR'], app.config['BLOB_SESSION_QUOTA_BYTES'],
+                       app.config['BLOB_GLOBAL_QUOTA_BYTES'], app.config['BLOB_UNREFERENCED_TTL_SECONDS'])
 
-# Global lock for file operations
-file_lock = threading.Lock()
+profile_store = ProfileStore(app.config['PROFILES_STORAGE_DIR'], summarize=slot_summary)
+# In-progress resumable uploads live in the session's upload directory and expire with it
+chunked_uploads = ChunkedUploads(app.config['UPLOAD_FOLDER'], app.config['CHUNKED_UPLOAD_MAX_BYTES'])
+live_streams = LiveStreams(app.config['LIVE_STREAMS_DIR'], app.config['LIVE_MAX_FUNCTIONS'],
+                           app.config['LIVE_MAX_EDGES'], snapshot_seconds=app.config['LIVE_SNAPSHOT_SECONDS'],
+                           idle_seconds=app.config['LIVE_STREAM_IDLE_SECONDS'])
+
+# Job history outlives sessions and is never touched by cleanup
+trend_store = (TrendStore(app.config['TREND_STORE_DIR'], app.config['TREND_FUNCTIONS_PER_RUN'])
+               if app.config['TREND_STORE_DIR'] else None)
+MAX_TREND_POINTS = 5000
+
+# Session data expiry: sessions untouched for SESSION_RETENTION are removed by a
+# background scheduler, CLEANUP_BATCH_SIZE sessions at a time
+SESSION_RETENTION = timedelta(hours=25)
+CLEANUP_INTERVAL_SECONDS = 300
+CLEANUP_BATCH_SIZE = 100
+CLEANUP_MAX_BATCHES = 10
+session_index = SessionExpiryIndex(app.config['SESSION_INDEX_PATH'])
+
+metrics.counter_function('profile_store_lock_wait_seconds_total', 'Time spent waiting for session store locks',
+                         lambda: profile_store.lock_wait_seconds)
+metrics.counter_function('profile_store_bytes_read_total', 'Compressed slot record bytes read from the store',
+                         lambda: profile_store.bytes_read)
+metrics.counter_function('profile_store_bytes_written_total', 'Compressed slot record bytes written to the store',
+                         lambda: profile_store.bytes_written)
+metrics.gauge('profile_parse_jobs_pending', 'Parse and merge jobs queued or running', parse_jobs.pending_count)
+metrics.gauge('profile_parse_cache_bytes', 'Bytes held by the parse cache', lambda: parse_cache.stats()['total_bytes'])
+metrics.gauge('profile_blob_store_bytes', 'Compressed bytes of raw uploads on disk',
+              lambda: blob_store.stats()['stored_bytes'])
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -53,6 +236,8 @@ def allowed_file(filename):
 @app.before_request
 def ensure_unique_session():
     """Ensure each browser/tab gets a unique session automatically"""
+    if request.endpoint in SESSIONLESS_ENDPOINTS:
+        return
     if 'session_id' not in session:
         # Generate cryptographically secure session ID
         session['session_id'] = str(uuid.uuid4())
@@ -62,9 +247,70 @@ def ensure_unique_session():
         
         # Log session creation
         print(f"New session created: {session['session_id']}")
-    
-    # Clean up old sessions periodically
-    cleanup_expired_sessions()
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    start_self_profile()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        request_latency.observe(time.perf_counter() - started, endpoint=endpoint,
+                                method=request.method, status=response.status_code)
+    return response
+
+@app.after_request
+def compress_large_response(response):
+    return compress_response(response, request.accept_encodings, app.config['COMPRESS_MIN_BYTES'])
+
+@app.teardown_request
+def finish_request_self_profile(exc):
+    finish_self_profile()
+
+def start_self_profile():
+    """Profile this request if it is the Nth one and no other request is being profiled"""
+    every = app.config['SELF_PROFILE_EVERY']
+    if every <= 0 or next(self_profile_counter) % every:
+        return
+    if not self_profile_lock.acquire(blocking=False):
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another profiler is already active in this interpreter
+        self_profile_lock.release()
+        return
+    g.self_profiler = profiler
+
+def finish_self_profile():
+    """Save the current request's profile as an uploadable .prof file"""
+    profiler = g.pop('self_profiler', None)
+    if profiler is None:
+        return
+    try:
+        profiler.disable()
+        endpoint = secure_filename(request.endpoint or 'unmatched') or 'request'
+        name = f"{datetime.utcnow().strftime('%Y%m%d_%H%M%S_%f')}_{endpoint}.prof"
+        profiler.dump_stats(os.path.join(app.config['SELF_PROFILE_DIR'], name))
+        self_profiles_written.inc()
+        prune_self_profiles()
+    except Exception as e:
+        print(f"Error saving self-profile: {e}")
+    finally:
+        self_profile_lock.release()
+
+def prune_self_profiles():
+    """Keep only the newest SELF_PROFILE_KEEP dumps"""
+    names = sorted(name for name in os.listdir(app.config['SELF_PROFILE_DIR']) if name.endswith('.prof'))
+    for name in names[:-SELF_PROFILE_KEEP]:
+        try:
+            os.remove(os.path.join(app.config['SELF_PROFILE_DIR'], name))
+        except OSError:
+            pass
 
 def generate_browser_fingerprint():
     """Generate a simple browser fingerprint for additional uniqueness"""
@@ -75,276 +321,356 @@ def generate_browser_fingerprint():
     fingerprint_string = f"{user_agent}:{remote_addr}:{accept_lang}"
     return hashlib.md5(fingerprint_string.encode()).hexdigest()[:16]
 
-def get_session_profile_file():
-    """Get the file path for current session's profile data"""
+def get_session_id():
+    """Get the current session ID"""
     session_id = session.get('session_id')
     if not session_id:
         raise ValueError("No session ID found")
-    return os.path.join(app.config['PROFILES_STORAGE_DIR'], f"{session_id}.json")
+    return session_id
+
+def get_session_table_path(profile_slot):
+    """Get a new file path for the full function table of a slot in the current session"""
+    session_id = session.get('session_id')
+    if not session_id:
+        raise ValueError("No session ID found")
+    return session_table_path(session_id, profile_slot)
+
+def session_table_path(session_id, profile_slot):
+    """A new table file name for a slot.
 
-def cleanup_expired_sessions():
-    """Clean up expired session data"""
+    Every table written gets its own name, kept in the slot record, since
+    readers may still have the previous one mapped and Windows refuses to
+    replace or delete a mapped file.
+    """
+    return os.path.join(app.config['PROFILE_TABLES_DIR'], session_id,
+                        f"{secure_filename(str(profile_slot)) or 'slot'}-{uuid.uuid4().hex[:12]}{TABLE_SUFFIX}")
+
+def release_replaced_tables(replaced, records):
+    """Delete the tables of replaced slot records that the new records no longer use"""
+    for profile_slot, previous in replaced.items():
+        table_path = (previous or {}).get('table_path')
+        if table_path and table_path != (records.get(profile_slot) or {}).get('table_path'):
+            # A table still mapped elsewhere stays until the session's tables are cleared
+            release_table(table_path)
+
+def delete_session_data(session_id):
+    """Remove all stored profiles, uploads and tables of one session"""
+    profile_store.delete_session(session_id)
+    blob_store.release(session_id)
+    comparison_states.discard(session_id)
+    live_streams.close_session(session_id)
+    release_tables(os.path.join(app.config['PROFILE_TABLES_DIR'], session_id))
+    for root in (app.config['UPLOAD_FOLDER'], app.config['PROFILE_TABLES_DIR']):
+        session_path = os.path.join(root, session_id)
+        if os.path.isdir(session_path):
+            shutil.rmtree(session_path, ignore_errors=True)
+
+def touch_session(session_id):
+    """Mark a session as recently written so it is not expired"""
     try:
-        current_time = datetime.utcnow()
-        cutoff_time = current_time - timedelta(hours=25)  # Clean up sessions older than 25 hours
-        
-        # Clean up profile data files
-        profile_dir = app.config['PROFILES_STORAGE_DIR']
-        if os.path.exists(profile_dir):
-            for filename in os.listdir(profile_dir):
-                if filename.endswith('.json'):
-                    filepath = os.path.join(profile_dir, filename)
-                    try:
-                        file_mtime = datetime.fromtimestamp(os.path.getmtime(filepath))
-                        if file_mtime < cutoff_time:
-                            os.remove(filepath)
-                            print(f"Cleaned up expired profile data: {filename}")
-                    except:
-                        pass
-        
-        # Clean up upload directories
-        upload_dir = app.config['UPLOAD_FOLDER']
-        if os.path.exists(upload_dir):
-            for session_dir in os.listdir(upload_dir):
-                session_path = os.path.join(upload_dir, session_dir)
-                if os.path.isdir(session_path):
-                    try:
-                        dir_mtime = datetime.fromtimestamp(os.path.getmtime(session_path))
-                        if dir_mtime < cutoff_time:
-                            shutil.rmtree(session_path)
-                            print(f"Cleaned up expired upload directory: {session_dir}")
-                    except:
-                        pass
-        
-        # Clean up Flask session files
-        session_dir = app.config['SESSION_FILE_DIR']
-        if os.path.exists(session_dir):
-            for filename in os.listdir(session_dir):
-                filepath = os.path.join(session_dir, filename)
-                try:
-                    file_mtime = datetime.fromtimestamp(os.path.getmtime(filepath))
-                    if file_mtime < cutoff_time:
-                        os.remove(filepath)
-                        print(f"Cleaned up expired session file: {filename}")
-                except:
-                    pass
-                    
+        session_index.touch(session_id)
     except Exception as e:
-        print(f"Cleanup error: {e}")
+        print(f"Error updating session index for {session_id}: {e}")
 
-def is_builtin_function(filename, function_name):
-    """Enhanced detection of built-in functions"""
-    builtin_patterns = [
-        '<built-in>',
-        '<method',
-        '~',
-        '<frozen',
-        '<string>',
-        '{built-in method',
-        '{method'
-    ]
-    
-    builtin_names = [
-        'len', 'str', 'int', 'float', 'bool', 'list', 'dict', 'tuple', 'set',
-        'range', 'enumerate', 'zip', 'map', 'filter', 'sorted', 'sum', 'min', 'max',
-        'abs', 'round', 'pow', 'divmod', 'isinstance', 'hasattr', 'getattr', 'setattr',
-        'delattr', 'callable', 'iter', 'next', 'repr', 'ord', 'chr', 'hex', 'oct',
-        'bin', 'hash', 'id', 'type', 'vars', 'dir', 'help', 'print', 'input',
-        'open', 'compile', 'eval', 'exec', 'globals', 'locals'
-    ]
-    
-    # Check filename patterns
-    for pattern in builtin_patterns:
-        if pattern in filename:
-            return True
-    
-    # Check function name patterns
-    if function_name in builtin_names:
-        return True
-        
-    # Check for special method names
-    if function_name.startswith('__') and function_name.endswith('__'):
-        return True
-        
-    return False
-
-def is_standard_library_function(filename):
-    """Check if function is from Python standard library"""
-    stdlib_patterns = [
-        '/python',
-        '\\python',
-        'site-packages',
-        '/usr/lib/python',
-        '/Library/Frameworks/Python',
-        'anaconda',
-        'miniconda',
-        'conda',
-        'importlib',
-        'pkgutil',
-        'encodings',
-        'codecs',
-        'collections',
-        're.py',
-        'json/',
-        'urllib/',
-        'http/',
-        'email/',
-        'xml/',
-        'logging/',
-        'threading.py',
-        'queue.py',
-        'os.py',
-        'sys.py',
-        'time.py',
-        'datetime.py',
-        'random.py',
-        'math.py',
-        'statistics.py',
-        'pathlib.py',
-        'shutil.py',
-        'tempfile.py',
-        'functools.py',
-        'itertools.py',
-        'operator.py'
-    ]
-    
-    filename_lower = filename.lower()
-    return any(pattern.lower() in filename_lower for pattern in stdlib_patterns)
-
-def is_third_party_library_function(filename):
-    """Check if function is from a third-party library"""
-    third_party_patterns = [
-        'site-packages/',
-        'dist-packages/',
-        'lib/python',
-        'flask',
-        'django',
-        'requests',
-        'numpy',
-        'pandas',
-        'scipy',
-        'matplotlib',
-        'seaborn',
-        'sklearn',
-        'tensorflow',
-        'torch',
-        'keras',
-        'pillow',
-        'opencv',
-        'sqlalchemy',
-        'psycopg2',
-        'pymongo',
-        'redis',
-        'celery',
-        'gunicorn',
-        'uwsgi'
-    ]
-    
-    filename_lower = filename.lower()
-    return any(pattern.lower() in filename_lower for pattern in third_party_patterns)
-
-def get_function_category(filename, function_name):
-    """Categorize function into user, builtin, stdlib, or third_party"""
-    if is_builtin_function(filename, function_name):
-        return 'builtin'
-    elif is_standard_library_function(filename):
-        return 'stdlib'
-    elif is_third_party_library_function(filename):
-        return 'third_party'
-    else:
-        return 'user'
+def seed_session_index():
+    """Index session data written before the expiry index existed (one scan at startup)"""
+    last_touched = {}
+    for session_id in profile_store.session_ids():
+        last_touched[session_id] = profile_store.last_modified(session_id) or 0
+    for root in (app.config['UPLOAD_FOLDER'], app.config['PROFILE_TABLES_DIR']):
+        if not os.path.exists(root):
+            continue
+        for entry in os.scandir(root):
+            if entry.is_dir():
+                mtime = entry.stat().st_mtime
+                last_touched[entry.name] = max(last_touched.get(entry.name, 0), mtime)
+    if last_touched:
+        session_index.seed(list(last_touched.items()))
+        print(f"Indexed {len(last_touched)} existing sessions for expiry")
+
+def cleanup_session_files(cutoff, limit):
+    """Remove up to ``limit`` expired Flask session files"""
+    removed = 0
+    session_dir = app.config['SESSION_FILE_DIR']
+    if not os.path.exists(session_dir):
+        return removed
+    for entry in os.scandir(session_dir):
+        if removed >= limit:
+            break
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                removed += 1
+                print(f"Cleaned up expired session file: {entry.name}")
+        except OSError:
+            pass
+    return removed
+
+def cleanup_expired_sessions(batch_size=None, max_batches=None):
+    """Clean up expired session data
 
-def parse_profile_file(filepath):
-    """Parse different types of Python profiling files"""
+    Expired sessions come from the expiry index, oldest first, in bounded
+    batches; anything left over is picked up by the next scheduled run.
+    """
+    batch_size = batch_size or CLEANUP_BATCH_SIZE
+    max_batches = max_batches or CLEANUP_MAX_BATCHES
+    removed = 0
+    started = time.perf_counter()
     try:
-        stats = pstats.Stats(filepath)
+        cutoff = time.time() - SESSION_RETENTION.total_seconds()
         
-        profile_data = {
-            'total_calls': stats.total_calls,
-            'total_time': stats.total_tt,
-            'functions': []
-        }
+        for _ in range(max_batches):
+            expired = session_index.expired(cutoff, batch_size)
+            for session_id in expired:
+                try:
+                    delete_session_data(session_id)
+                    print(f"Cleaned up expired session data: {session_id}")
+                except Exception as e:
+                    print(f"Error cleaning up session {session_id}: {e}")
+            session_index.remove(expired)
+            removed += len(expired)
+            if len(expired) < batch_size:
+                break
         
-        stats.sort_stats('cumulative')
+        # Clean up Flask session files
+        cleanup_session_files(cutoff, batch_size * max_batches)
         
-        for func_name, func_stats in list(stats.stats.items())[:50]:
-            filename, line_num, function_name = func_name
-            full_name = f"{filename}:{line_num}({function_name})"
-            
-            # Enhanced categorization of function types
-            is_builtin = is_builtin_function(filename, function_name)
-            is_stdlib = is_standard_library_function(filename)
-            is_third_party = is_third_party_library_function(filename)
-            
-            profile_data['functions'].append({
-                'name': full_name,
-                'filename': filename,
-                'line_number': line_num,
-                'function_name': function_name,
-                'calls': func_stats[0],
-                'total_time': func_stats[2],
-                'cumulative_time': func_stats[3],
-                'per_call': func_stats[3] / func_stats[0] if func_stats[0] > 0 else 0,
-                'is_builtin': is_builtin,
-                'is_stdlib': is_stdlib,
-                'is_third_party': is_third_party,
-                'category': get_function_category(filename, function_name)
-            })
+        # Job state files left by any server process
+        parse_jobs.prune_state_files()
         
-        return profile_data
-    
+        # Raw uploads no session references any more
+        blob_store.reclaim()
+        
+        # Live streams whose agent stopped posting keep their last snapshot
+        live_streams.expire(save_live_snapshot)
+                    
     except Exception as e:
-        try:
-            with open(filepath, 'rb') as f:
-                data = pickle.load(f)
-                return {
-                    'total_calls': len(data) if isinstance(data, list) else 0,
-                    'total_time': 0,
-                    'functions': [],
-                    'raw_data': str(type(data))
-                }
-        except:
-            return {
-                'error': f'Could not parse profile file: {str(e)}',
-                'total_calls': 0,
-                'total_time': 0,
-                'functions': []
-            }
+        print(f"Cleanup error: {e}")
+    cleanup_duration.observe(time.perf_counter() - started)
+    cleanup_removed.inc(removed)
+    return removed
 
 @app.route('/api/session-info', methods=['GET'])
 def get_session_info():
     """Return current session information for debugging/display"""
-    profiles = get_user_profiles_from_storage()
     return jsonify({
         'session_id': session.get('session_id'),
         'created_at': session.get('created_at'),
         'browser_fingerprint': session.get('browser_fingerprint'),
-        'profiles_count': len(profiles)
+        'profiles_count': count_user_profiles_in_storage(),
+        'storage_bytes': blob_store.usage(session.get('session_id')),
+        'storage_quota_bytes': blob_store.session_quota_bytes
     }), 200
 
 def get_user_profiles_from_storage():
     """Get profiles for current session from file storage"""
     try:
-        with file_lock:
-            profile_file = get_session_profile_file()
-            if os.path.exists(profile_file):
-                with open(profile_file, 'r') as f:
-                    return json.load(f)
-            return {}
+        return profile_store.load_all(get_session_id())
     except Exception as e:
         print(f"Error loading profiles: {e}")
         return {}
 
+def get_user_profile_from_storage(profile_slot):
+    """Get a single slot of the current session, or None"""
+    try:
+        return profile_store.get(get_session_id(), profile_slot)
+    except Exception as e:
+        print(f"Error loading profile {profile_slot}: {e}")
+        return None
+
+def count_user_profiles_in_storage():
+    """Count the current session's profiles without decoding them"""
+    try:
+        return profile_store.count(get_session_id())
+    except Exception as e:
+        print(f"Error counting profiles: {e}")
+        return 0
+
 def save_user_profiles_to_storage(profiles):
     """Save profiles for current session to file storage"""
     try:
-        with file_lock:
-            profile_file = get_session_profile_file()
-            with open(profile_file, 'w') as f:
-                json.dump(profiles, f, indent=2)
+        session_id = get_session_id()
+        profile_store.replace_all(session_id, profiles)
+        touch_session(session_id)
     except Exception as e:
         print(f"Error saving profiles: {e}")
 
+def save_user_profile_to_storage(profile_slot, profile):
+    """Save one slot for current session without rewriting the others"""
+    try:
+        save_session_profile(get_session_id(), profile_slot, profile)
+    except Exception as e:
+        print(f"Error saving profile {profile_slot}: {e}")
+
+def save_session_profile(session_id, profile_slot, profile):
+    """Save one slot for an explicit session (usable outside a request)"""
+    replaced = profile_store.put(session_id, profile_slot, profile)
+    touch_session(session_id)
+    update_session_comparison(session_id, {profile_slot: profile})
+    release_replaced_tables({profile_slot: replaced}, {profile_slot: profile})
+
+def sync_comparison_column(state, profile_slot, profile):
+    """Renumber a slot's table into the session's comparison state if its content changed (hold state.lock)"""
+    content_key = profile_content_key(profile)
+    if state.content_key(profile_slot) != content_key:
+        state.set_column(profile_slot, content_key, load_profile_table(profile))
+
+def update_session_comparison(session_id, changes):
+    """Apply slot changes ({slot: record, or None when removed}) to a session's comparison state, if it has one"""
+    state = comparison_states.get(session_id, create=False)
+    if state is None:
+        return
+    with state.lock:
+        for profile_slot, profile in changes.items():
+            try:
+                if profile is None:
+                    state.drop_column(profile_slot)
+                else:
+                    sync_comparison_column(state, profile_slot, profile)
+            except Exception as e:
+                print(f"Error updating comparison state for slot {profile_slot}: {e}")
+                state.drop_column(profile_slot)
+
+# The epoch to the end of year 3000, which time.gmtime handles on every platform
+MAX_TIMESTAMP = 32535215999.0
+
+def parse_timestamp(value, default=None):
+    """Epoch seconds, or an ISO 8601 time (UTC unless it carries an offset), as epoch seconds"""
+    if value is None or value == '':
+        return default
+    try:
+        timestamp = float(value)
+    except (TypeError, ValueError):
+        parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=timezone.utc)
+        timestamp = parsed.timestamp()
+    if not math.isfinite(timestamp) or not 0 <= timestamp <= MAX_TIMESTAMP:
+        raise ValueError(f'Timestamps must be between 1970-01-01 and 3000-12-31 ({value!r} is not)')
+    return timestamp
+
+def validate_trend_tag(job, run_id, timestamp):
+    """Checked trend tag for an upload, or None when no job is given"""
+    if not job:
+        return None
+    if trend_store is None:
+        raise ValueError('Trend store is disabled; set TREND_STORE_DIR to enable it')
+    tag = {
+        'job': validate_name(job, 'job'),
+        'run_id': validate_name(run_id, 'run_id'),
+        'timestamp': parse_timestamp(timestamp, time.time())
+    }
+    if trend_store.has_run(tag['job'], tag['run_id']):
+        raise TrendRunExists(f"Run {tag['run_id']} is already recorded for job {tag['job']}")
+    return tag
+
+def record_trend_run(tag, table_path, filename, content_hash):
+    """Append a parsed upload to the trend store; returns the run or an error entry"""
+    try:
+        return trend_store.record_run(tag['job'], tag['run_id'], tag['timestamp'],
+                                      load_table(table_path), filename, content_hash)
+    except Exception as e:
+        print(f"Error recording trend run {tag['run_id']} of {tag['job']}: {e}")
+        return dict(tag, error=str(e))
+
+def store_upload_blobs(session_id, uploads):
+    """Keep raw uploads ({slot: (content_hash, size, path)}) in the blob store.
+
+    Returns an error response if the session or the server is out of
+    upload storage, else None. Each blob stays pinned for its slot until
+    set_refs points the slot at it, or unpin gives it up.
+    """
+    pinned = {}
+    try:
+        for profile_slot, (content_hash, size, path) in uploads.items():
+            blob_store.put(session_id, profile_slot, path, content_hash, size)
+            pinned[profile_slot] = content_hash
+    except BlobQuotaExceeded as e:
+        if pinned:
+            blob_store.unpin(session_id, pinned)
+        return jsonify({'error': str(e)}), 413 if e.scope == 'session' else 507
+    return None
+
+def is_async_request():
+    """True when the client asked for a job id instead of waiting (?async=1)"""
+    value = request.args.get('async', request.form.get('async', ''))
+    return value.lower() in ('1', 'true', 'yes')
+
+def ingest_saved_upload(session_id, profile_slot, filename, unique_filename, filepath, content_hash, size,
+                        trend_tag=None):
+    """Store, parse and record a dump saved at ``filepath``; returns the upload response"""
+    blob_error = store_upload_blobs(session_id, {profile_slot: (content_hash, size, filepath)})
+    if blob_error is not None:
+        os.remove(filepath)
+        return blob_error
+    table_path = get_session_table_path(profile_slot)
+    uploaded_at = datetime.utcnow().isoformat()
+    
+    def store_result(profile_data, from_cache=False):
+        if not from_cache and 'error' not in profile_data and os.path.exists(table_path):
+            parse_cache.put(content_hash, profile_data, table_path)
+        record = {
+            'filename': filename,
+            'unique_filename': unique_filename,
+            'filepath': None,
+            'uploaded_at': uploaded_at,
+            'table_path': table_path if os.path.exists(table_path) else None,
+            'content_hash': content_hash,
+            'data': profile_data
+        }
+        if trend_tag and record['table_path']:
+            record['trend'] = record_trend_run(trend_tag, table_path, filename, content_hash)
+        # Save only this slot to session-specific storage
+        save_session_profile(session_id, profile_slot, record)
+        blob_store.set_refs(session_id, {profile_slot: content_hash})
+        # The raw upload now lives in the blob store
+        os.remove(filepath)
+    
+    def discard_upload():
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        blob_store.unpin(session_id, {profile_slot: content_hash})
+    
+    # Reuse an earlier parse of identical content, otherwise parse in the worker pool
+    job_description = {'filename': filename, 'profile_slot': profile_slot}
+    profile_data = parse_cache.get(content_hash, table_path)
+    parse_cache_lookups.inc(result='miss' if profile_data is None else 'hit')
+    if profile_data is not None:
+        store_result(profile_data, from_cache=True)
+        job = parse_jobs.record_completed(session_id, job_description, profile_data)
+    else:
+        try:
+            job = parse_jobs.submit(session_id, job_description, parse_profile_file,
+                                    (filepath, table_path), store_result, discard_upload)
+        except QueueFullError as e:
+            discard_upload()
+            response = jsonify({'error': f'Server busy parsing other uploads, retry shortly ({e})'})
+            response.headers['Retry-After'] = '5'
+            return response, 503
+    
+    if is_async_request():
+        return jsonify(dict(
+            parse_jobs.describe(job),
+            message='File uploaded, parsing queued',
+            session_id=session_id,
+            status_url=f"/api/jobs/{job['job_id']}"
+        )), 202
+    
+    parse_jobs.wait(job, PARSE_TIMEOUT_SECONDS + 5)
+    if job['state'] != 'done':
+        return jsonify({'error': job['error'] or 'Parsing did not finish in time'}), 500
+    
+    response = {
+        'message': 'File uploaded successfully',
+        'filename': filename,
+        'profile_slot': profile_slot,
+        'session_id': session_id,
+        'data': job['result']
+    }
+    if trend_tag:
+        response['trend'] = (get_user_profile_from_storage(profile_slot) or {}).get('trend')
+    return jsonify(response), 200
+
 @app.route('/api/upload', methods=['POST'])
 def upload_profile():
     if 'file' not in request.files:
@@ -357,6 +683,14 @@ def upload_profile():
         return jsonify({'error': 'No file selected'}), 400
     
     if file and allowed_file(file.filename):
+        try:
+            trend_tag = validate_trend_tag(request.form.get('trend_job'), request.form.get('trend_run_id'),
+                                           request.form.get('trend_timestamp'))
+        except TrendRunExists as e:
+            return jsonify({'error': str(e)}), 409
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
         # Create session-specific upload directory
         session_id = session.get('session_id')
         session_upload_dir = os.path.join(app.config['UPLOAD_FOLDER'], session_id)
@@ -368,50 +702,949 @@ def upload_profile():
         unique_filename = f"{timestamp}_{filename}"
         filepath = os.path.join(session_upload_dir, unique_filename)
         
-        file.save(filepath)
-        
-        # Parse the profile file
-        profile_data = parse_profile_file(filepath)
-        
-        # Load existing profiles for this session
-        profiles = get_user_profiles_from_storage()
-        
-        # Store new profile
-        profiles[profile_slot] = {
-            'filename': filename,
-            'unique_filename': unique_filename,
-            'filepath': filepath,
-            'uploaded_at': datetime.utcnow().isoformat(),
-            'data': profile_data
+        # Hash while streaming to disk so duplicate uploads can skip parsing
+        content_hash, size = save_stream_with_hash(file.stream, filepath)
+        upload_bytes.inc(size)
+        return ingest_saved_upload(session_id, profile_slot, filename, unique_filename, filepath,
+                                   content_hash, size, trend_tag)
+    
+    return jsonify({'error': f'Invalid file type. Supported extensions: {", ".join(sorted(ALLOWED_EXTENSIONS))}'}), 400
+
+def chunked_upload_error(e):
+    payload = {'error': str(e)}
+    if e.offset is not None:
+        payload['offset'] = e.offset
+    return jsonify(payload), e.status
+
+@app.route('/api/uploads', methods=['POST'])
+def create_chunked_upload():
+    """Start a resumable upload; chunks follow with PUT /api/uploads/<upload_id>"""
+    body = request.get_json(silent=True) or request.form
+    filename = secure_filename(body.get('filename') or '')
+    if not filename:
+        return jsonify({'error': 'filename is required'}), 400
+    if not allowed_file(decoded_filename(filename)):
+        return jsonify({'error': f'Invalid file type. Supported extensions: {", ".join(sorted(ALLOWED_EXTENSIONS))}'}), 400
+    size = body.get('size')
+    try:
+        size = int(size) if size not in (None, '') else None
+        trend_fields = {name: body.get(name) for name in ('trend_job', 'trend_run_id', 'trend_timestamp')}
+        validate_trend_tag(*trend_fields.values())
+    except TrendRunExists as e:
+        return jsonify({'error': str(e)}), 409
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    session_id = get_session_id()
+    fields = dict(trend_fields, profile_slot=str(body.get('profile_slot') or '1'))
+    try:
+        upload = chunked_uploads.create(session_id, filename, size, body.get('encoding') or 'auto', fields)
+    except ChunkedUploadError as e:
+        return chunked_upload_error(e)
+    touch_session(session_id)
+    return jsonify(dict(
+        upload,
+        chunk_size=app.config['CHUNKED_UPLOAD_CHUNK_BYTES'],
+        upload_url=f"/api/uploads/{upload['upload_id']}"
+    )), 201
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+def get_chunked_upload(upload_id):
+    """Offset to resume from after an interrupted chunk"""
+    try:
+        return jsonify(chunked_uploads.status(get_session_id(), upload_id))
+    except ChunkedUploadError as e:
+        return chunked_upload_error(e)
+
+@app.route('/api/uploads/<upload_id>', methods=['PUT', 'PATCH'])
+def append_chunked_upload(upload_id):
+    """Append the raw request body at the offset given by ?offset= or the Upload-Offset header"""
+    offset = request.headers.get('Upload-Offset', request.args.get('offset'))
+    if offset is None or not offset.isdigit():
+        return jsonify({'error': 'offset is required'}), 400
+    session_id = get_session_id()
+    try:
+        new_offset = chunked_uploads.append(session_id, upload_id, int(offset), request.stream)
+    except ChunkedUploadError as e:
+        return chunked_upload_error(e)
+    upload_bytes.inc(new_offset - int(offset))
+    touch_session(session_id)
+    response = jsonify({'upload_id': upload_id, 'offset': new_offset})
+    response.headers['Upload-Offset'] = str(new_offset)
+    return response, 200
+
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+def abort_chunked_upload(upload_id):
+    try:
+        chunked_uploads.abort(get_session_id(), upload_id)
+    except ChunkedUploadError as e:
+        return chunked_upload_error(e)
+    return jsonify({'message': 'Upload discarded', 'upload_id': upload_id}), 200
+
+@app.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+def complete_chunked_upload(upload_id):
+    """Finish a resumable upload and parse it like POST /api/upload (optional sha256 of the bytes sent)"""
+    body = request.get_json(silent=True) or request.form
+    session_id = get_session_id()
+    session_upload_dir = os.path.join(app.config['UPLOAD_FOLDER'], session_id)
+    try:
+        upload = chunked_uploads.status(session_id, upload_id)
+        fields = upload['fields']
+        trend_tag = validate_trend_tag(fields.get('trend_job'), fields.get('trend_run_id'),
+                                       fields.get('trend_timestamp'))
+        timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
+        unique_filename = f"{timestamp}_{upload_id[:8]}_{decoded_filename(upload['filename'])}"
+        filepath = os.path.join(session_upload_dir, unique_filename)
+        upload = chunked_uploads.complete(session_id, upload_id, filepath, body.get('sha256'))
+    except ChunkedUploadError as e:
+        return chunked_upload_error(e)
+    except TrendRunExists as e:
+        return jsonify({'error': str(e)}), 409
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    touch_session(session_id)
+    return ingest_saved_upload(session_id, fields['profile_slot'], upload['filename'], unique_filename,
+                               filepath, upload['content_hash'], upload['content_size'], trend_tag)
+
+def live_stream_error(e):
+    return jsonify({'error': str(e)}), e.status
+
+def save_live_snapshot(meta, snapshot):
+    """Rebuild a live stream's slot from a LiveSnapshot, as if the profile had just been uploaded"""
+    started = time.perf_counter()
+    session_id, profile_slot = meta['session_id'], meta['profile_slot']
+    table_path = session_table_path(session_id, profile_slot)
+    profile_data = table_profile_data(snapshot.table(), 'live', table_path)
+    profile_data['live'] = snapshot.status
+    save_session_profile(session_id, profile_slot, {
+        'filename': meta['name'],
+        'unique_filename': None,
+        'filepath': None,
+        'uploaded_at': datetime.utcnow().isoformat(),
+        'table_path': table_path,
+        # Changes with every snapshot, so cached views of the slot are recomputed
+        'content_hash': f"live-{meta['stream_id']}-{snapshot.batches}",
+        'data': profile_data
+    })
+    touch_session(session_id)
+    live_snapshot_duration.observe(time.perf_counter() - started)
+
+@app.route('/api/live', methods=['POST'])
+def create_live_stream():
+    """Open a live stream on a slot; the response carries the agent's ingest token"""
+    body = request.get_json(silent=True) or request.form
+    session_id = get_session_id()
+    profile_slot = str(body.get('profile_slot') or next_free_slot(session_id))
+    name = str(body.get('name') or f'live-{profile_slot}')[:200]
+    try:
+        interval = float(body.get('interval') or DEFAULT_SAMPLE_SECONDS)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'interval must be seconds per sample'}), 400
+    if not 0 < interval <= 60:
+        return jsonify({'error': 'interval must be seconds per sample, above 0 and at most 60'}), 400
+    try:
+        stream = live_streams.create(session_id, profile_slot, name, interval)
+    except LiveStreamError as e:
+        return live_stream_error(e)
+    # The slot's previous upload, if any, is replaced by the stream's snapshots
+    blob_store.release(session_id, [profile_slot])
+    touch_session(session_id)
+    return jsonify({
+        'stream_id': stream['stream_id'],
+        'token': stream['token'],
+        'profile_slot': profile_slot,
+        'name': name,
+        'interval': interval,
+        'ingest_url': f"/api/live/{stream['stream_id']}/samples"
+    }), 201
+
+@app.route('/api/live', methods=['GET'])
+def list_live_streams():
+    session_id = get_session_id()
+    return jsonify({'streams': [live_streams.status(meta) for meta in live_streams.session_streams(session_id)]})
+
+@app.route('/api/live/<stream_id>', methods=['GET'])
+def get_live_stream(stream_id):
+    try:
+        return jsonify(live_streams.status(live_streams.owned(get_session_id(), stream_id)))
+    except LiveStreamError as e:
+        return live_stream_error(e)
+
+@app.route('/api/live/<stream_id>/samples', methods=['POST'])
+def ingest_live_samples(stream_id):
+    """Fold a batch of sampled stacks into a stream (token in X-Stream-Token or ?token=; ?snapshot=1 forces a snapshot)"""
+    token = request.headers.get('X-Stream-Token', request.args.get('token'))
+    batch = request.get_json(silent=True)
+    if batch is None:
+        return jsonify({'error': 'Expected a JSON batch of samples'}), 400
+    force_snapshot = request.args.get('snapshot', '').lower() in ('1', 'true', 'yes')
+    try:
+        meta = live_streams.authorize(stream_id, token)
+        added, status = live_streams.ingest(meta, batch, save_live_snapshot, force_snapshot)
+    except LiveStreamError as e:
+        return live_stream_error(e)
+    live_samples.inc(added)
+    return jsonify(dict(status, accepted=added)), 200
+
+@app.route('/api/live/<stream_id>', methods=['DELETE'])
+def close_live_stream(stream_id):
+    """Stop a stream; its slot keeps the final snapshot"""
+    try:
+        status = live_streams.close(live_streams.owned(get_session_id(), stream_id), save_live_snapshot)
+    except LiveStreamError as e:
+        return live_stream_error(e)
+    return jsonify(dict(status, message='Live stream closed')), 200
+
+def next_free_slot(session_id):
+    """One past the highest numbered slot of the session"""
+    numbered = [int(slot) for slot in profile_store.load_summaries(session_id) if str(slot).isdigit()]
+    return max(numbered, default=0) + 1
+
+def batch_file_report(entry):
+    """Per-file status line of a batch upload"""
+    return {
+        'filename': entry['filename'],
+        'archive': entry['archive'],
+        'profile_slot': entry['profile_slot'],
+        'status': entry['status'],
+        'error': entry['data'].get('error'),
+        'size': entry['size'],
+        'save_seconds': round(entry['save_seconds'], 4),
+        'parse_seconds': None if entry['parse_seconds'] is None else round(entry['parse_seconds'], 4),
+        'data': entry['data']
+    }
+
+@app.route('/api/upload/batch', methods=['POST'])
+def upload_profile_batch():
+    """Upload many dumps (files and/or zip/tar archives) into one slot each
+
+    Dumps are streamed to disk, parsed in parallel in the worker pool and
+    every parsed slot is written in one storage transaction. Slots come
+    from ``slots`` (comma separated, one per dump) or count up from
+    ``start_slot``, by default the slot after the highest numbered one.
+    """
+    files = [f for f in request.files.getlist('files') + request.files.getlist('file') if f.filename]
+    if not files:
+        return jsonify({'error': 'No files provided'}), 400
+    
+    session_id = session.get('session_id')
+    started = time.perf_counter()
+    timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
+    batch_dir = os.path.join(app.config['UPLOAD_FOLDER'], session_id, f"batch_{timestamp}_{uuid.uuid4().hex[:8]}")
+    os.makedirs(batch_dir, exist_ok=True)
+    
+    # One entry per dump: plain files in upload order, archive members in archive order
+    entries = []
+    archives = []
+    skipped = []
+    extracted_bytes = 0
+    try:
+        for index, file in enumerate(files):
+            filename = secure_filename(file.filename) or 'upload'
+            filepath = os.path.join(batch_dir, f"{index:05d}_{filename}")
+            save_started = time.perf_counter()
+            if is_archive(file.filename):
+                _, size = save_stream_with_hash(file.stream, filepath)
+                upload_bytes.inc(size)
+                try:
+                    members = extract_profile_members(filepath, os.path.join(batch_dir, f"archive_{index}"),
+                                                      allowed_file, BATCH_MAX_FILES, ARCHIVE_MAX_MEMBER_BYTES,
+                                                      MAX_BATCH_EXTRACT_BYTES - extracted_bytes)
+                except ArchiveTooLarge as e:
+                    shutil.rmtree(batch_dir, ignore_errors=True)
+                    return jsonify({
+                        'error': f'Archive {filename} too large to extract: {e}',
+                        'archives': archives + [{'filename': filename, 'size': size, 'error': str(e)}],
+                        'max_extract_bytes': MAX_BATCH_EXTRACT_BYTES
+                    }), 413
+                os.remove(filepath)
+                member_bytes = sum(member_size for _, _, member_size in members)
+                extracted_bytes += member_bytes
+                archives.append({'filename': filename, 'size': size, 'members': len(members),
+                                 'extracted_bytes': member_bytes,
+                                 'extract_seconds': round(time.perf_counter() - save_started, 4)})
+                for name, member_path, _ in members:
+                    member_started = time.perf_counter()
+                    content_hash, member_size = hash_file(member_path)
+                    entries.append({
+                        'filename': secure_filename(os.path.basename(name.replace('\\', '/'))) or 'profile.prof',
+                        'archive': filename,
+                        'filepath': member_path,
+                        'content_hash': content_hash,
+                        'size': member_size,
+                        'save_seconds': time.perf_counter() - member_started
+                    })
+            elif allowed_file(file.filename):
+                content_hash, size = save_stream_with_hash(file.stream, filepath)
+                upload_bytes.inc(size)
+                entries.append({
+                    'filename': filename,
+                    'archive': None,
+                    'filepath': filepath,
+                    'content_hash': content_hash,
+                    'size': size,
+                    'save_seconds': time.perf_counter() - save_started
+                })
+            else:
+                skipped.append(file.filename)
+            if len(entries) > BATCH_MAX_FILES:
+                raise ValueError(f'More than {BATCH_MAX_FILES} profile files in one batch')
+    except Exception as e:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        return jsonify({'error': f'Could not read uploaded files: {e}'}), 400
+    
+    if not entries:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        return jsonify({'error': 'No supported profile files found', 'skipped_files': skipped}), 400
+    
+    slots_arg = request.form.get('slots', request.args.get('slots', '')).strip()
+    if slots_arg:
+        slots = [slot.strip() for slot in slots_arg.split(',')]
+        if len(slots) != len(entries) or len(set(slots)) != len(slots) or not all(slots):
+            shutil.rmtree(batch_dir, ignore_errors=True)
+            return jsonify({'error': f'slots must list {len(entries)} distinct slots, one per profile file'}), 400
+    else:
+        try:
+            start_slot = int(request.form.get('start_slot') or request.args.get('start_slot') or next_free_slot(session_id))
+        except ValueError:
+            shutil.rmtree(batch_dir, ignore_errors=True)
+            return jsonify({'error': 'start_slot must be an integer'}), 400
+        slots = [str(start_slot + i) for i in range(len(entries))]
+    
+    blob_error = store_upload_blobs(session_id, {
+        profile_slot: (entry['content_hash'], entry['size'], entry['filepath'])
+        for entry, profile_slot in zip(entries, slots)
+    })
+    if blob_error is not None:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        return blob_error
+    
+    # Reuse earlier parses; identical dumps within the batch are parsed once
+    uploaded_at = datetime.utcnow().isoformat()
+    to_parse = []
+    first_by_hash = {}
+    for entry, profile_slot in zip(entries, slots):
+        entry['profile_slot'] = profile_slot
+        entry['table_path'] = get_session_table_path(profile_slot)
+        entry['parse_seconds'] = None
+        entry['data'] = parse_cache.get(entry['content_hash'], entry['table_path'])
+        parse_cache_lookups.inc(result='miss' if entry['data'] is None else 'hit')
+        if entry['data'] is not None:
+            entry['status'] = 'cached'
+        elif entry['content_hash'] not in first_by_hash:
+            first_by_hash[entry['content_hash']] = entry
+            to_parse.append(entry)
+    
+    def parse_batch(submit):
+        results = parse_profile_batch(submit, [(entry['filepath'], entry['table_path']) for entry in to_parse])
+        for entry, (profile_data, parse_seconds) in zip(to_parse, results):
+            entry['data'] = profile_data
+            entry['parse_seconds'] = parse_seconds
+            entry['status'] = 'error' if 'error' in profile_data else 'parsed'
+            if entry['status'] == 'parsed':
+                parse_cache.put(entry['content_hash'], profile_data, entry['table_path'])
+        for entry in entries:
+            if 'status' not in entry:
+                first = first_by_hash[entry['content_hash']]
+                entry['data'] = first['data']
+                entry['status'] = first['status'] if first['status'] == 'error' else 'duplicate'
+                if entry['status'] == 'duplicate':
+                    link_or_copy(first['table_path'], entry['table_path'])
+        # The raw uploads now live in the blob store
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        return [batch_file_report(entry) for entry in entries]
+    
+    def store_result(report):
+        # Failed files get no slot; everything else lands in one transaction
+        stored = [entry for entry in entries if entry['status'] != 'error']
+        records = {
+            entry['profile_slot']: {
+                'filename': entry['filename'],
+                'unique_filename': os.path.basename(entry['filepath']),
+                'filepath': None,
+                'uploaded_at': uploaded_at,
+                'table_path': entry['table_path'],
+                'content_hash': entry['content_hash'],
+                'data': entry['data']
+            }
+            for entry in stored
         }
-        
-        # Save back to session-specific storage
-        save_user_profiles_to_storage(profiles)
-        
-        return jsonify({
-            'message': 'File uploaded successfully',
-            'filename': filename,
-            'profile_slot': profile_slot,
-            'session_id': session_id,
+        replaced = profile_store.put_many(session_id, records)
+        blob_store.set_refs(session_id, {entry['profile_slot']: entry['content_hash'] for entry in stored})
+        blob_store.unpin(session_id, {entry['profile_slot']: entry['content_hash']
+                                      for entry in entries if entry['status'] == 'error'})
+        touch_session(session_id)
+        update_session_comparison(session_id, records)
+        release_replaced_tables(replaced, records)
+    
+    def discard_uploads():
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        blob_store.unpin(session_id, {profile_slot: entry['content_hash']
+                                      for entry, profile_slot in zip(entries, slots)})
+    
+    job_description = {'filename': f"batch ({len(entries)} files)", 'profile_slot': f"{slots[0]}-{slots[-1]}",
+                       'file_count': len(entries)}
+    if not to_parse:
+        report = parse_batch(None)
+        store_result(report)
+        job = parse_jobs.record_completed(session_id, job_description, report)
+    else:
+        try:
+            job = parse_jobs.submit_coordinated(session_id, job_description, parse_batch, (), store_result,
+                                                discard_uploads)
+        except QueueFullError as e:
+            discard_uploads()
+            response = jsonify({'error': f'Server busy parsing other uploads, retry shortly ({e})'})
+            response.headers['Retry-After'] = '5'
+            return response, 503
+    
+    if is_async_request():
+        return jsonify(dict(
+            parse_jobs.describe(job),
+            message='Files uploaded, parsing queued',
+            session_id=session_id,
+            archives=archives,
+            skipped_files=skipped,
+            status_url=f"/api/jobs/{job['job_id']}"
+        )), 202
+    
+    parse_jobs.wait(job, PARSE_TIMEOUT_SECONDS + 5)
+    if job['state'] != 'done':
+        return jsonify({'error': job['error'] or 'Parsing did not finish in time'}), 500
+    
+    report = job['result']
+    return jsonify({
+        'message': 'Files uploaded successfully',
+        'session_id': session_id,
+        'stored_slots': [item['profile_slot'] for item in report if item['status'] != 'error'],
+        'files': report,
+        'archives': archives,
+        'skipped_files': skipped,
+        'total_seconds': round(time.perf_counter() - started, 4)
+    }), 200
+
+@app.route('/api/merge', methods=['POST'])
+def merge_profiles():
+    """Merge many dumps (files and/or zip/tar archives) into one aggregate profile slot"""
+    files = [f for f in request.files.getlist('files') + request.files.getlist('file') if f.filename]
+    if not files:
+        return jsonify({'error': 'No files provided'}), 400
+    
+    profile_slot = request.form.get('profile_slot', '1')
+    session_id = session.get('session_id')
+    timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
+    merge_dir = os.path.join(app.config['UPLOAD_FOLDER'], session_id, f"merge_{timestamp}_{uuid.uuid4().hex[:8]}")
+    os.makedirs(merge_dir, exist_ok=True)
+    
+    dump_paths = []
+    source_hashes = []
+    skipped = []
+    extracted_bytes = 0
+    try:
+        for index, file in enumerate(files):
+            filename = secure_filename(file.filename) or 'upload'
+            filepath = os.path.join(merge_dir, f"{index:05d}_{filename}")
+            if is_archive(file.filename):
+                content_hash, size = save_stream_with_hash(file.stream, filepath)
+                upload_bytes.inc(size)
+                source_hashes.append(content_hash)
+                members = extract_profile_members(filepath, os.path.join(merge_dir, f"archive_{index}"),
+                                                  allowed_file, MERGE_MAX_FILES, ARCHIVE_MAX_MEMBER_BYTES,
+                                                  MERGE_MAX_EXTRACT_BYTES - extracted_bytes)
+                os.remove(filepath)
+                extracted_bytes += sum(size for _, _, size in members)
+                dump_paths.extend(path for _, path, _ in members)
+            elif allowed_file(file.filename):
+                content_hash, size = save_stream_with_hash(file.stream, filepath)
+                upload_bytes.inc(size)
+                source_hashes.append(content_hash)
+                dump_paths.append(filepath)
+            else:
+                skipped.append(file.filename)
+            if len(dump_paths) > MERGE_MAX_FILES:
+                raise ValueError(f'More than {MERGE_MAX_FILES} profile files in one merge')
+    except ArchiveTooLarge as e:
+        shutil.rmtree(merge_dir, ignore_errors=True)
+        return jsonify({'error': f'Archive too large to merge: {e}'}), 413
+    except Exception as e:
+        shutil.rmtree(merge_dir, ignore_errors=True)
+        return jsonify({'error': f'Could not read uploaded files: {e}'}), 400
+    
+    if not dump_paths:
+        shutil.rmtree(merge_dir, ignore_errors=True)
+        return jsonify({'error': 'No supported profile files found to merge'}), 400
+    
+    # The same set of inputs always merges to the same profile
+    content_hash = hashlib.sha256(('merge:' + ','.join(sorted(source_hashes))).encode()).hexdigest()
+    table_path = get_session_table_path(profile_slot)
+    label = f"merged ({len(dump_paths)} files)"
+    uploaded_at = datetime.utcnow().isoformat()
+    
+    def store_result(profile_data, from_cache=False):
+        if not from_cache and os.path.exists(table_path):
+            parse_cache.put(content_hash, profile_data, table_path)
+        save_session_profile(session_id, profile_slot, {
+            'filename': label,
+            'unique_filename': None,
+            'filepath': None,
+            'uploaded_at': uploaded_at,
+            'table_path': table_path,
+            'content_hash': content_hash,
+            'merged_from': len(dump_paths),
             'data': profile_data
-        }), 200
+        })
+        # A merged slot has no single raw upload behind it
+        blob_store.release(session_id, [profile_slot])
+    
+    job_description = {'filename': label, 'profile_slot': profile_slot, 'file_count': len(dump_paths)}
+    profile_data = parse_cache.get(content_hash, table_path)
+    parse_cache_lookups.inc(result='miss' if profile_data is None else 'hit')
+    if profile_data is not None:
+        shutil.rmtree(merge_dir, ignore_errors=True)
+        store_result(profile_data, from_cache=True)
+        job = parse_jobs.record_completed(session_id, job_description, profile_data)
+    else:
+        try:
+            job = parse_jobs.submit_coordinated(session_id, job_description, merge_profile_dumps,
+                                                (dump_paths, merge_dir, table_path, PARSE_WORKERS),
+                                                store_result, lambda: shutil.rmtree(merge_dir, ignore_errors=True))
+        except QueueFullError as e:
+            shutil.rmtree(merge_dir, ignore_errors=True)
+            response = jsonify({'error': f'Server busy parsing other uploads, retry shortly ({e})'})
+            response.headers['Retry-After'] = '5'
+            return response, 503
+    
+    if is_async_request():
+        return jsonify(dict(
+            parse_jobs.describe(job),
+            message='Files uploaded, merge queued',
+            session_id=session_id,
+            skipped_files=skipped,
+            status_url=f"/api/jobs/{job['job_id']}"
+        )), 202
     
-    return jsonify({'error': 'Invalid file type. Please upload .prof, .pstats, or .pkl files'}), 400
+    parse_jobs.wait(job, PARSE_TIMEOUT_SECONDS + 5)
+    if job['state'] != 'done':
+        return jsonify({'error': job['error'] or 'Merge did not finish in time'}), 500
+    
+    return jsonify({
+        'message': 'Profiles merged successfully',
+        'filename': label,
+        'profile_slot': profile_slot,
+        'session_id': session_id,
+        'skipped_files': skipped,
+        'data': job['result']
+    }), 200
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_parse_job(job_id):
+    """Report the state of a parse job, with the parsed summary once done"""
+    job = parse_jobs.get(job_id, session.get('session_id'))
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    
+    status = parse_jobs.describe(job)
+    if job['state'] == 'done':
+        status['data'] = job['result']
+    return jsonify(status), 200
 
 @app.route('/api/profiles', methods=['GET'])
 def get_profiles():
-    """Get profiles for current session only"""
-    profiles = get_user_profiles_from_storage()
+    """Get profiles for current session only
+
+    Returns per-slot summaries by default; ``?detail=full`` returns the full
+    slot records as before. Responses carry an ETag of the slots' content,
+    so unchanged listings revalidate with a 304.
+    """
+    session_id = session.get('session_id')
+    full = request.args.get('detail') == 'full'
+    try:
+        summaries = profile_store.load_summaries(session_id)
+    except Exception as e:
+        print(f"Error loading profile summaries: {e}")
+        summaries = {}
+    
+    etag = slots_etag(session_id, summaries, 'full' if full else 'summary')
+    not_modified = not_modified_response(etag)
+    if not_modified is not None:
+        return not_modified
+    
+    if full:
+        profiles = get_user_profiles_from_storage()
+    else:
+        profiles = {
+            slot: dict(summary, detail_url=f"/api/profiles/{slot}")
+            for slot, summary in summaries.items()
+        }
     session_info = {
-        'session_id': session.get('session_id'),
+        'session_id': session_id,
         'created_at': session.get('created_at')
     }
     
-    return jsonify({
+    return etagged_json({
         'profiles': profiles,
-        'session_info': session_info
+        'session_info': session_info,
+        'detail': 'full' if full else 'summary'
+    }, etag)
+
+@app.route('/api/profiles/<profile_slot>', methods=['GET'])
+def get_profile_detail(profile_slot):
+    """Full record of one slot, including its top functions"""
+    try:
+        summary = profile_store.get_summary(get_session_id(), profile_slot)
+    except Exception as e:
+        print(f"Error loading profile {profile_slot}: {e}")
+        summary = None
+    if summary is None:
+        return jsonify({'error': f'No profile in slot {profile_slot}'}), 404
+    
+    etag = slots_etag(session.get('session_id'), {profile_slot: summary}, 'detail')
+    not_modified = not_modified_response(etag)
+    if not_modified is not None:
+        return not_modified
+    
+    profile = get_user_profile_from_storage(profile_slot)
+    if profile is None:
+        return jsonify({'error': f'No profile in slot {profile_slot}'}), 404
+    return etagged_json({'profile_slot': profile_slot, 'profile': profile}, etag)
+
+@app.route('/api/profiles/<profile_slot>/raw', methods=['GET'])
+def download_raw_profile(profile_slot):
+    """The dump originally uploaded into a slot, decompressed from the blob store"""
+    session_id = session.get('session_id')
+    content_hash = blob_store.ref_hash(session_id, profile_slot)
+    blob = blob_store.open(content_hash) if content_hash else None
+    if blob is None:
+        return jsonify({'error': f'No raw upload stored for slot {profile_slot}'}), 404
+    summary = profile_store.get_summary(session_id, profile_slot) or {}
+    filename = secure_filename(summary.get('filename') or '') or f"{content_hash[:16]}.prof"
+    
+    def generate():
+        with blob:
+            while True:
+                chunk = blob.read(1024 * 1024)
+                if not chunk:
+                    break
+                yield chunk
+    
+    return Response(stream_with_context(generate()), mimetype='application/octet-stream', headers={
+        'Content-Disposition': f'attachment; filename="{filename}"',
+        'ETag': f'"{content_hash}"'
+    })
+
+def slots_etag(session_id, summaries, variant):
+    """ETag derived from which content sits in which slot"""
+    digest = hashlib.sha256(f"{session_id}:{variant}".encode())
+    for slot in sorted(summaries):
+        summary = summaries[slot]
+        digest.update(f"|{slot}:{summary.get('content_hash')}:{summary.get('uploaded_at')}".encode())
+    return digest.hexdigest()[:32]
+
+def not_modified_response(etag):
+    """A 304 response if the client already holds ``etag``, else None"""
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag, weak=True)
+        return response
+    return None
+
+def etagged_json(payload, etag):
+    response = jsonify(payload)
+    response.set_etag(etag, weak=True)
+    # Clients may keep the body but must revalidate it before use
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def load_slot_table(profile_slot):
+    """Return (profile, table, error_response) for a slot of the current session"""
+    profile = get_user_profile_from_storage(profile_slot)
+    if not profile:
+        return None, None, (jsonify({'error': f'No profile in slot {profile_slot}'}), 404)
+    
+    table_path = profile.get('table_path')
+    if not table_path or not os.path.exists(table_path):
+        return profile, None, (jsonify({'error': 'No function table available for this profile'}), 404)
+    
+    return profile, load_table(table_path), None
+
+def get_int_arg(name, default, minimum, maximum):
+    """Read an integer query argument clamped to [minimum, maximum]"""
+    value = int(request.args.get(name, default))
+    return max(minimum, min(value, maximum))
+
+def resolve_function_row(table):
+    """Find the row named by the ``function`` or ``function_id`` query argument"""
+    function_id = request.args.get('function_id')
+    if function_id is not None:
+        row = int(function_id)
+        return row if 0 <= row < len(table) else None
+    return table.find(request.args.get('function'))
+
+def get_graph_query_args():
+    """Parse the shared call-graph query arguments"""
+    direction = request.args.get('direction', 'both')
+    if direction not in ('both', 'callers', 'callees'):
+        raise ValueError("direction must be 'both', 'callers' or 'callees'")
+    return (
+        get_int_arg('hops', 2, 1, MAX_GRAPH_HOPS),
+        direction,
+        get_int_arg('max_nodes', 200, 1, MAX_GRAPH_NODES),
+        get_int_arg('chains', 10, 0, 100),
+        get_int_arg('depth', 8, 1, 32)
+    )
+
+def cached_subgraph_view(profile, table, row, query_args):
+    """Subgraph view of ``row``, cached on the profile's content"""
+    content_key = profile.get('content_hash') or profile.get('table_path')
+    return call_graph_cache.get_or_compute(
+        (content_key, row) + query_args,
+        lambda: subgraph_view(table, row, *query_args)
+    )
+
+@app.route('/api/profiles/<profile_slot>/functions', methods=['GET'])
+def get_profile_functions(profile_slot):
+    """Return a sorted page of the full function table for one slot"""
+    profile, table, error = load_slot_table(profile_slot)
+    if error:
+        return error
+    
+    sort_column = resolve_sort_column(request.args.get('sort', 'cumulative_time'))
+    if sort_column is None:
+        return jsonify({'error': f"Unknown sort column: {request.args.get('sort')}"}), 400
+    
+    order = request.args.get('order', 'desc').lower()
+    if order not in ('asc', 'desc'):
+        return jsonify({'error': "order must be 'asc' or 'desc'"}), 400
+    
+    try:
+        offset = max(0, int(request.args.get('offset', 0)))
+        limit = int(request.args.get('limit', request.args.get('top', SUMMARY_FUNCTION_COUNT)))
+    except ValueError:
+        return jsonify({'error': 'offset and limit must be integers'}), 400
+    limit = max(0, min(limit, MAX_PAGE_SIZE))
+    
+    indices = table.top(sort_column, limit, descending=(order == 'desc'), offset=offset)
+    
+    return jsonify({
+        'profile_slot': profile_slot,
+        'sort': sort_column,
+        'order': order,
+        'offset': offset,
+        'limit': limit,
+        'total': len(table),
+        'functions': table.rows(indices)
     }), 200
 
+def slot_view_etag(profile_slot, variant):
+    """ETag of a derived view of one slot, or None if the slot is empty"""
+    summary = profile_store.get_summary(get_session_id(), profile_slot)
+    if summary is None:
+        return None
+    return slots_etag(session.get('session_id'), {profile_slot: summary}, variant)
+
+@app.route('/api/profiles/<profile_slot>/hotspots', methods=['GET'])
+def get_profile_hotspots(profile_slot):
+    """Top functions by every timing metric plus per-category rollups, from the views saved at ingest"""
+    try:
+        limit = get_int_arg('limit', 10, 1, MAX_HOTSPOT_FUNCTIONS)
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    etag = slot_view_etag(profile_slot, f'hotspots:{limit}')
+    not_modified = not_modified_response(etag) if etag else None
+    if not_modified is not None:
+        return not_modified
+    
+    profile, table, error = load_slot_table(profile_slot)
+    if error:
+        return error
+    
+    def build():
+        views = table_views(table)
+        total_time = float(views.category_total_time.sum())
+        return {
+            'function_count': len(table),
+            'total_time': total_time,
+            'top': {column: table.rows(views.orders[column][:limit]) for column in ORDER_COLUMNS},
+            'categories': [{
+                'category': name,
+                'function_count': int(views.category_functions[i]),
+                'calls': int(views.category_calls[i]),
+                'total_time': float(views.category_total_time[i]),
+                'time_share': float(views.category_total_time[i]) / total_time if total_time > 0 else 0.0,
+                'top': table.rows(views.category_top(i, limit))
+            } for i, name in enumerate(CATEGORIES)]
+        }
+    
+    payload = view_cache.get_or_compute((profile_content_key(profile), 'hotspots', limit), build)
+    return etagged_json(dict(payload, profile_slot=profile_slot), etag)
+
+@app.route('/api/profiles/<profile_slot>/flamegraph', methods=['GET'])
+def get_profile_flamegraph(profile_slot):
+    """Call tree rebuilt from caller edges at ingest, for flamegraph and icicle charts.
+
+    ``root`` zooms into a node's subtree, ``min_fraction`` drops nodes
+    lighter than that share of it, and ``format=collapsed`` returns
+    flamegraph.pl text instead of JSON nodes.
+    """
+    output = request.args.get('format', 'json')
+    if output not in ('json', 'collapsed'):
+        return jsonify({'error': "format must be 'json' or 'collapsed'"}), 400
+    try:
+        root = int(request.args.get('root', 0))
+        min_fraction = float(request.args.get('min_fraction', 0.001))
+        if not math.isfinite(min_fraction):
+            raise ValueError('min_fraction must be finite')
+        min_fraction = min(max(min_fraction, 0.0), 1.0)
+        max_nodes = get_int_arg('max_nodes', MAX_TREE_NODES, 1, MAX_TREE_NODES)
+    except ValueError:
+        return jsonify({'error': 'root, min_fraction and max_nodes must be finite numbers'}), 400
+    etag = slot_view_etag(profile_slot, f'flamegraph:{output}:{root}:{min_fraction}:{max_nodes}')
+    not_modified = not_modified_response(etag) if etag else None
+    if not_modified is not None:
+        return not_modified
+    
+    profile, table, error = load_slot_table(profile_slot)
+    if error:
+        return error
+    views = table_views(table)
+    if not 0 <= root < len(views.tree_row):
+        return jsonify({'error': f'root must be a node id below {len(views.tree_row)}'}), 400
+    
+    cache_key = (profile_content_key(profile), 'flamegraph', output, root, min_fraction, max_nodes)
+    if output == 'collapsed':
+        text = view_cache.get_or_compute(
+            cache_key, lambda: ''.join(line + '\n' for line in collapsed_stacks(table, views, root, min_fraction)))
+        response = Response(text, mimetype='text/plain')
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+    payload = view_cache.get_or_compute(
+        cache_key, lambda: flame_tree_view(table, views, root, min_fraction, max_nodes))
+    return etagged_json(dict(payload, profile_slot=profile_slot), etag)
+
+@app.route('/api/profiles/<profile_slot>/callgraph', methods=['GET'])
+def get_profile_call_graph(profile_slot):
+    """Return the k-hop neighbourhood and heaviest caller chains of one function"""
+    profile, table, error = load_slot_table(profile_slot)
+    if error:
+        return error
+    if table.graph is None:
+        return jsonify({'error': 'No call graph available for this profile; re-upload it'}), 404
+    
+    try:
+        query_args = get_graph_query_args()
+        row = resolve_function_row(table)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if row is None:
+        return jsonify({'error': 'Function not found; pass function=<file:line(name)> or function_id'}), 404
+    
+    view = cached_subgraph_view(profile, table, row, query_args)
+    return jsonify(dict(view, profile_slot=profile_slot)), 200
+
+@app.route('/api/callgraph/diff', methods=['GET'])
+def diff_call_graphs():
+    """Diff the neighbourhood of one function between two slots"""
+    base_slot = request.args.get('base', '1')
+    target_slot = request.args.get('target', '2')
+    function_name = request.args.get('function')
+    if not function_name:
+        return jsonify({'error': 'function=<file:line(name)> is required'}), 400
+    
+    try:
+        query_args = get_graph_query_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    sides = []
+    for slot in (base_slot, target_slot):
+        profile, table, error = load_slot_table(slot)
+        if error:
+            return error
+        if table.graph is None:
+            return jsonify({'error': f'No call graph available for slot {slot}; re-upload it'}), 404
+        row = table.find(function_name)
+        view = cached_subgraph_view(profile, table, row, query_args) if row is not None else None
+        sides.append((table, view))
+    
+    if sides[0][1] is None and sides[1][1] is None:
+        return jsonify({'error': f'Function not found in either slot: {function_name}'}), 404
+    
+    result = diff_subgraphs(sides[0][0], sides[0][1], sides[1][0], sides[1][1])
+    result.update({'function': function_name, 'base': base_slot, 'target': target_slot})
+    return jsonify(result), 200
+
+@app.route('/api/search', methods=['GET'])
+def search_functions():
+    """Find functions across all of the session's profiles
+
+    Query: q (substring of file:line(name), case-insensitive), regex (matched
+    against function names and filenames), category (comma separated),
+    min_tottime, min_cumtime, min_calls, slots (comma separated), limit.
+    """
+    text = request.args.get('q', '').strip()
+    regex = request.args.get('regex', '')
+    categories = [name for name in request.args.get('category', '').split(',') if name]
+    unknown = [name for name in categories if name not in CATEGORIES]
+    if unknown:
+        return jsonify({'error': f"Unknown category: {', '.join(unknown)}"}), 400
+    
+    try:
+        pattern = re.compile(regex.encode('utf-8'), re.MULTILINE) if regex else None
+    except re.error as e:
+        return jsonify({'error': f'Invalid regex: {e}'}), 400
+    try:
+        thresholds = {
+            'min_total_time': float(request.args.get('min_tottime', 0)),
+            'min_cumulative_time': float(request.args.get('min_cumtime', 0)),
+            'min_calls': int(request.args.get('min_calls', 0))
+        }
+        limit = get_int_arg('limit', SUMMARY_FUNCTION_COUNT, 1, MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'error': 'Thresholds and limit must be numbers'}), 400
+    if not (text or pattern or categories or any(thresholds.values())):
+        return jsonify({'error': 'Pass at least one of q, regex, category or a threshold'}), 400
+    
+    session_id = get_session_id()
+    summaries = profile_store.load_summaries(session_id)
+    wanted = [slot for slot in request.args.get('slots', '').split(',') if slot]
+    named_tables = []
+    for slot in sorted(wanted or summaries, key=slot_sort_key):
+        if slot not in summaries:
+            return jsonify({'error': f'No profile in slot {slot}'}), 404
+        if not summaries[slot].get('has_table'):
+            continue
+        table_path = (get_user_profile_from_storage(slot) or {}).get('table_path')
+        if not table_path or not os.path.exists(table_path):
+            continue
+        named_tables.append((slot, load_table(table_path)))
+    
+    result = search_tables(
+        named_tables, text=text or None, pattern=pattern,
+        category_ids=[CATEGORIES.index(name) for name in categories] or None,
+        limit=limit, **thresholds
+    )
+    result.update({
+        'query': {'q': text, 'regex': regex, 'category': categories, **thresholds, 'limit': limit},
+        'profiles': [slot for slot, _ in named_tables]
+    })
+    return jsonify(result), 200
+
+def slot_sort_key(profile_slot):
+    """Order slots numerically where possible ('2' before '10')"""
+    return (0, int(profile_slot), '') if str(profile_slot).isdigit() else (1, 0, str(profile_slot))
+
+def profile_content_key(profile):
+    """Identify a slot's parsed content for memoisation"""
+    return profile.get('content_hash') or f"{profile.get('table_path')}@{profile.get('uploaded_at')}"
+
+def load_profile_table(profile):
+    """Full function table of a stored profile, or an empty one if it has none"""
+    table_path = profile.get('table_path')
+    if table_path and os.path.exists(table_path):
+        return load_table(table_path)
+    return ProfileTable.empty()
+
 @app.route('/api/compare', methods=['POST'])
 def compare_profiles():
     profiles = get_user_profiles_from_storage()
@@ -419,8 +1652,29 @@ def compare_profiles():
     if len(profiles) < 2:
         return jsonify({'error': 'At least 2 profiles are required for comparison'}), 400
     
+    # Optional body: {"slots": [...], "base": "1", "limit": 20}
+    options = request.get_json(silent=True) or {}
+    slots = sorted(profiles, key=slot_sort_key)
+    if options.get('slots'):
+        slots = [str(slot) for slot in options['slots']]
+        missing = [slot for slot in slots if slot not in profiles]
+        if missing:
+            return jsonify({'error': f'No profile in slot(s): {", ".join(missing)}'}), 400
+        if len(slots) < 2:
+            return jsonify({'error': 'At least 2 profiles are required for comparison'}), 400
+    
+    base_slot = str(options.get('base', slots[0]))
+    if base_slot not in slots:
+        return jsonify({'error': f'Base slot {base_slot} is not being compared'}), 400
+    base_index = slots.index(base_slot)
+    
+    try:
+        limit = max(1, min(int(options.get('limit', 20)), MAX_COMPARE_FUNCTIONS))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'limit must be an integer'}), 400
+    
     # Comparison logic
-    profile_list = list(profiles.values())
+    profile_list = [profiles[slot] for slot in slots]
     comparison_data = {
         'session_id': session.get('session_id'),
         'profiles': [],
@@ -434,101 +1688,274 @@ def compare_profiles():
     }
     
     # Add profile summaries
-    for i, profile in enumerate(profile_list):
+    for slot, profile in zip(slots, profile_list):
         comparison_data['profiles'].append({
+            'profile_slot': slot,
             'filename': profile['filename'],
             'uploaded_at': profile['uploaded_at'],
             'total_calls': profile['data'].get('total_calls', 0),
             'total_time': profile['data'].get('total_time', 0),
-            'function_count': len(profile['data'].get('functions', []))
+            'function_count': profile['data'].get('function_count', len(profile['data'].get('functions', [])))
         })
     
     # Performance comparison logic
-    if len(profile_list) >= 2:
-        times = [p['data'].get('total_time', 0) for p in profile_list]
-        calls = [p['data'].get('total_calls', 0) for p in profile_list]
-        
-        comparison_data['comparison']['total_time_comparison'] = times
-        comparison_data['comparison']['total_calls_comparison'] = calls
-        
-        # Function analysis
-        all_functions = {}
-        for i, profile in enumerate(profile_list):
-            functions = profile['data'].get('functions', [])
-            for func in functions:
-                func_name = func['name']
-                if func_name not in all_functions:
-                    all_functions[func_name] = {}
-                all_functions[func_name][f'profile_{i+1}'] = func
-        
-        # Find common and unique functions
-        common_funcs = []
-        unique_funcs = {f'profile_{i+1}': [] for i in range(len(profile_list))}
-        
-        for func_name, func_data in all_functions.items():
-            if len(func_data) == len(profile_list):
-                common_funcs.append({
-                    'name': func_name,
-                    'profiles': func_data
-                })
-            else:
-                for profile_key in func_data:
-                    unique_funcs[profile_key].append({
-                        'name': func_name,
-                        'data': func_data[profile_key]
-                    })
-        
-        comparison_data['comparison']['common_functions'] = common_funcs[:20]
-        comparison_data['comparison']['unique_functions'] = unique_funcs
-        
-        # Performance metrics
-        if len(times) >= 2:
-            fastest_profile = times.index(min(times)) + 1
-            slowest_profile = times.index(max(times)) + 1
-            performance_diff = max(times) - min(times)
-            
-            comparison_data['comparison']['performance_metrics'] = {
-                'fastest_profile': fastest_profile,
-                'slowest_profile': slowest_profile,
-                'time_difference': performance_diff,
-                'speedup_factor': max(times) / min(times) if min(times) > 0 else 0
-            }
+    times = [p['data'].get('total_time', 0) for p in profile_list]
+    calls = [p['data'].get('total_calls', 0) for p in profile_list]
+    
+    comparison_data['comparison']['total_time_comparison'] = times
+    comparison_data['comparison']['total_calls_comparison'] = calls
+    
+    # Function analysis over the full tables, memoised on the slots' content.
+    # Only slots whose content changed since the session's last comparison are renumbered.
+    state = comparison_states.get(session.get('session_id'))
+    
+    def compare_columns():
+        with state.lock:
+            state.retain(profiles)
+            for slot, profile in zip(slots, profile_list):
+                sync_comparison_column(state, slot, profile)
+            return state.compare(slots, base=base_index, limit=limit)
+    
+    cache_key = (tuple(profile_content_key(p) for p in profile_list), base_index, limit)
+    function_analysis = comparison_cache.get_or_compute(cache_key, compare_columns)
+    comparison_data['comparison'].update(function_analysis)
+    
+    # Performance metrics
+    fastest_profile = times.index(min(times)) + 1
+    slowest_profile = times.index(max(times)) + 1
+    performance_diff = max(times) - min(times)
+    
+    comparison_data['comparison']['performance_metrics'] = {
+        'fastest_profile': fastest_profile,
+        'slowest_profile': slowest_profile,
+        'time_difference': performance_diff,
+        'speedup_factor': max(times) / min(times) if min(times) > 0 else 0
+    }
     
     return jsonify(comparison_data), 200
 
+@app.route('/api/regressions', methods=['POST'])
+def detect_profile_regressions():
+    """Find statistically significant per-function changes between two sets of runs
+
+    Body: {"baseline": [slots], "candidate": [slots], "metric": "cumulative_time",
+           "alpha": 0.05, "min_time": 0.001, "min_change_pct": 5, "limit": 50,
+           "correction": "fdr" | "none"}
+    """
+    profiles = get_user_profiles_from_storage()
+    options = request.get_json(silent=True) or {}
+    baseline_slots = [str(slot) for slot in options.get('baseline') or []]
+    candidate_slots = [str(slot) for slot in options.get('candidate') or []]
+    
+    if len(baseline_slots) < 2 or len(candidate_slots) < 2:
+        return jsonify({'error': 'baseline and candidate each need at least 2 slots'}), 400
+    if set(baseline_slots) & set(candidate_slots):
+        return jsonify({'error': 'A slot cannot be in both baseline and candidate'}), 400
+    missing = [slot for slot in baseline_slots + candidate_slots if slot not in profiles]
+    if missing:
+        return jsonify({'error': f'No profile in slot(s): {", ".join(missing)}'}), 400
+    
+    metric = options.get('metric', 'cumulative_time')
+    if metric not in ('cumulative_time', 'total_time'):
+        return jsonify({'error': "metric must be 'cumulative_time' or 'total_time'"}), 400
+    correction = options.get('correction', 'fdr')
+    if correction not in ('fdr', 'none'):
+        return jsonify({'error': "correction must be 'fdr' or 'none'"}), 400
+    try:
+        alpha = float(options.get('alpha', 0.05))
+        min_time = float(options.get('min_time', 0.001))
+        min_change_pct = float(options.get('min_change_pct', 5.0))
+        limit = max(1, min(int(options.get('limit', 50)), MAX_COMPARE_FUNCTIONS))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'alpha, min_time, min_change_pct and limit must be numbers'}), 400
+    
+    baseline_profiles = [profiles[slot] for slot in baseline_slots]
+    candidate_profiles = [profiles[slot] for slot in candidate_slots]
+    cache_key = (
+        'regressions',
+        tuple(profile_content_key(p) for p in baseline_profiles),
+        tuple(profile_content_key(p) for p in candidate_profiles),
+        metric, alpha, min_time, min_change_pct, limit, correction
+    )
+    result = comparison_cache.get_or_compute(cache_key, lambda: detect_regressions(
+        [load_profile_table(p) for p in baseline_profiles],
+        [load_profile_table(p) for p in candidate_profiles],
+        metric=metric, alpha=alpha, min_time=min_time,
+        min_change_pct=min_change_pct, limit=limit, correction=correction
+    ))
+    
+    # Whole-run total time gets the same test
+    baseline_totals = [p['data'].get('total_time', 0) for p in baseline_profiles]
+    candidate_totals = [p['data'].get('total_time', 0) for p in candidate_profiles]
+    _, total_p = mann_whitney(np.array([baseline_totals]), np.array([candidate_totals]))
+    
+    return jsonify(dict(
+        result,
+        session_id=session.get('session_id'),
+        baseline=baseline_slots,
+        candidate=candidate_slots,
+        total_time={
+            'baseline': baseline_totals,
+            'candidate': candidate_totals,
+            'p_value': float(total_p[0])
+        },
+        passed=result['significant_regression_count'] == 0
+    )), 200
+
+def trend_store_disabled():
+    return jsonify({'error': 'Trend store is disabled; set TREND_STORE_DIR to enable it'}), 404
+
+def get_trend_range():
+    """Parse the shared job, start and end query arguments of the trend endpoints"""
+    job = validate_name(request.args.get('job'), 'job')
+    start = parse_timestamp(request.args.get('start'))
+    end = parse_timestamp(request.args.get('end'))
+    return job, start, end
+
+@app.route('/api/trends', methods=['GET'])
+def list_trend_jobs():
+    """Jobs in the trend store with their run counts and time spans"""
+    if trend_store is None:
+        return trend_store_disabled()
+    return jsonify({'jobs': trend_store.jobs()}), 200
+
+@app.route('/api/trends/runs', methods=['POST'])
+def record_trend_run_from_slot():
+    """Record a stored slot of this session as one run of a job
+
+    Body: {"job": "nightly-etl", "run_id": "1234", "timestamp": "2024-05-01T02:00:00Z",
+           "profile_slot": "1"}; timestamp defaults to now.
+    """
+    if trend_store is None:
+        return trend_store_disabled()
+    options = request.get_json(silent=True) or {}
+    if not options.get('job'):
+        return jsonify({'error': 'job is required'}), 400
+    try:
+        tag = validate_trend_tag(options.get('job'), options.get('run_id'), options.get('timestamp'))
+    except TrendRunExists as e:
+        return jsonify({'error': str(e)}), 409
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    profile, table, error = load_slot_table(str(options.get('profile_slot', '1')))
+    if error:
+        return error
+    try:
+        run = trend_store.record_run(tag['job'], tag['run_id'], tag['timestamp'], table,
+                                     profile.get('filename'), profile.get('content_hash'))
+    except TrendRunExists as e:
+        return jsonify({'error': str(e)}), 409
+    return jsonify(run), 201
+
+@app.route('/api/trends/runs', methods=['GET'])
+def list_trend_runs():
+    """Runs of a job with their totals, newest ``limit`` of them (query: job, start, end, limit)"""
+    if trend_store is None:
+        return trend_store_disabled()
+    try:
+        job, start, end = get_trend_range()
+        limit = get_int_arg('limit', 100, 1, MAX_PAGE_SIZE)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    runs = trend_store.runs(job, start, end)
+    return jsonify({'job': job, 'total': len(runs), 'runs': runs[-limit:]}), 200
+
+@app.route('/api/trends/functions', methods=['GET'])
+def list_trend_functions():
+    """Heaviest functions of a job's latest run, to pick series from (query: job, q, metric, limit)"""
+    if trend_store is None:
+        return trend_store_disabled()
+    try:
+        job = validate_name(request.args.get('job'), 'job')
+        limit = get_int_arg('limit', SUMMARY_FUNCTION_COUNT, 1, MAX_PAGE_SIZE)
+        result = trend_store.latest_functions(job, request.args.get('q'),
+                                              request.args.get('metric', 'cumulative_time'), limit)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(dict(result, job=job)), 200
+
+@app.route('/api/trends/series', methods=['GET'])
+def get_trend_series():
+    """Downsampled per-run timings of one function over time, or of whole runs without ``function``
+
+    Query: job, function (file:line(name)), metric (comma separated total_time,
+    cumulative_time, calls), start, end, points (default 500), method (lttb | minmax).
+    """
+    if trend_store is None:
+        return trend_store_disabled()
+    function_name = request.args.get('function')
+    method = request.args.get('method', 'lttb')
+    if method not in ('lttb', 'minmax'):
+        return jsonify({'error': "method must be 'lttb' or 'minmax'"}), 400
+    try:
+        job, start, end = get_trend_range()
+        points = get_int_arg('points', 500, 3, MAX_TREND_POINTS)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    if function_name:
+        series = trend_store.function_series(job, function_name, start, end)
+    else:
+        series = trend_store.totals_series(job, start, end)
+    metrics_wanted = request.args.get('metric', 'total_time,cumulative_time' if function_name else 'total_time')
+    metrics_wanted = [name for name in metrics_wanted.split(',') if name]
+    unknown = [name for name in metrics_wanted if name not in series or name in ('ts', 'run_id')]
+    if unknown:
+        return jsonify({'error': f"Unknown metric: {', '.join(unknown)}"}), 400
+    
+    timestamps = series['ts']
+    result = {}
+    for name in metrics_wanted:
+        values = series[name]
+        if method == 'lttb':
+            keep = lttb(timestamps, values, points)
+            result[name] = {
+                'ts': timestamps[keep].tolist(),
+                'values': values[keep].tolist(),
+                'run_ids': [series['run_id'][i] for i in keep]
+            }
+        else:
+            result[name] = {key: column.tolist() for key, column in min_max_buckets(timestamps, values, points).items()}
+    
+    return jsonify({
+        'job': job,
+        'function': function_name,
+        'method': method,
+        'raw_points': len(timestamps),
+        'series': result
+    }), 200
+
 @app.route('/api/clear', methods=['POST'])
 def clear_profiles():
     """Clear profiles for current session only"""
     try:
         session_id = session.get('session_id')
         
-        # Get current session's profiles
-        profiles = get_user_profiles_from_storage()
+        # Stop live streams first so no snapshot lands after the clear
+        live_streams.close_session(session_id)
         
-        # Delete uploaded files for this session
-        for profile in profiles.values():
-            filepath = profile.get('filepath')
-            if filepath and os.path.exists(filepath):
-                try:
-                    os.remove(filepath)
-                    print(f"Deleted file: {filepath}")
-                except Exception as e:
-                    print(f"Error deleting file {filepath}: {e}")
+        # Raw uploads are shared by content; drop this session's references
+        # and let the blob store reclaim whatever nobody else uses
+        blob_store.release(session_id)
+        blob_store.reclaim()
         
-        # Clear session directory if empty
+        # Uploads still in flight, and files from before the blob store
         session_upload_dir = os.path.join(app.config['UPLOAD_FOLDER'], session_id)
         if os.path.exists(session_upload_dir):
-            try:
-                os.rmdir(session_upload_dir)  # Only removes if empty
-                print(f"Deleted session directory: {session_upload_dir}")
-            except OSError:
-                pass  # Directory not empty or other error
+            shutil.rmtree(session_upload_dir, ignore_errors=True)
+            print(f"Deleted session directory: {session_upload_dir}")
         
-        # Clear profile data file
-        with file_lock:
-            profile_file = get_session_profile_file()
-            if os.path.exists(profile_file):
-                os.remove(profile_file)
+        # Clear function tables, unmapping them first so they can be removed
+        comparison_states.discard(session_id)
+        session_tables_dir = os.path.join(app.config['PROFILE_TABLES_DIR'], session_id)
+        release_tables(session_tables_dir)
+        if os.path.exists(session_tables_dir):
+            shutil.rmtree(session_tables_dir, ignore_errors=True)
+        
+        # Clear profile data
+        profile_store.delete_session(session_id)
+        session_index.remove([session_id])
         
         return jsonify({
             'message': 'All profiles cleared for current session',
@@ -546,23 +1973,17 @@ def debug_all_sessions():
     try:
         all_sessions = {}
         
-        # Check profile data files
-        profile_dir = app.config['PROFILES_STORAGE_DIR']
-        if os.path.exists(profile_dir):
-            for filename in os.listdir(profile_dir):
-                if filename.endswith('.json'):
-                    session_id = filename[:-5]  # Remove .json extension
-                    filepath = os.path.join(profile_dir, filename)
-                    try:
-                        with open(filepath, 'r') as f:
-                            profiles = json.load(f)
-                            all_sessions[session_id] = {
-                                'profile_count': len(profiles),
-                                'profiles': list(profiles.keys()),
-                                'last_modified': os.path.getmtime(filepath)
-                            }
-                    except:
-                        pass
+        # Check stored profile data
+        for session_id in profile_store.session_ids():
+            try:
+                profiles = profile_store.load_all(session_id)
+                all_sessions[session_id] = {
+                    'profile_count': len(profiles),
+                    'profiles': list(profiles.keys()),
+                    'last_modified': profile_store.last_modified(session_id)
+                }
+            except:
+                pass
         
         return jsonify({
             'total_sessions': len(all_sessions),
@@ -581,6 +2002,7 @@ def health_check():
         storage_accessible = (
             os.path.exists(app.config['SESSION_FILE_DIR']) and
             os.path.exists(app.config['PROFILES_STORAGE_DIR']) and
+            os.path.exists(app.config['PROFILE_TABLES_DIR']) and
             os.path.exists(app.config['UPLOAD_FOLDER'])
         )
     except:
@@ -592,24 +2014,63 @@ def health_check():
         'storage_accessible': storage_accessible,
         'storage_type': 'filesystem',
         'timestamp': datetime.utcnow().isoformat(),
-        'active_profiles': len(get_user_profiles_from_storage())
+        'active_profiles': count_user_profiles_in_storage(),
+        'process_id': os.getpid(),
+        'cleanup_leader': cleanup_scheduler.leading,
+        'parse_cache': parse_cache.stats()
     }), 200
 
-# Background cleanup task
-def background_cleanup():
-    """Run cleanup periodically in background"""
-    while True:
-        time.sleep(3600)  # Run every hour
-        try:
-            cleanup_expired_sessions()
-        except Exception as e:
-            print(f"Background cleanup error: {e}")
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus-style metrics of this server process, or of all workers when METRICS_SHARED_DIR is set"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/self-profiles', methods=['GET'])
+def list_self_profiles():
+    """Self-profiling dumps available for download (newest first)"""
+    profile_dir = app.config['SELF_PROFILE_DIR']
+    entries = []
+    for entry in os.scandir(profile_dir):
+        if entry.is_file() and entry.name.endswith('.prof'):
+            stat = entry.stat()
+            entries.append({
+                'name': entry.name,
+                'size': stat.st_size,
+                'created_at': datetime.utcfromtimestamp(stat.st_mtime).isoformat(),
+                'download_url': f"/api/self-profiles/{entry.name}"
+            })
+    entries.sort(key=lambda item: item['name'], reverse=True)
+    return jsonify({
+        'sample_every': app.config['SELF_PROFILE_EVERY'],
+        'profiles': entries
+    }), 200
 
-# Start background cleanup thread
-cleanup_thread = threading.Thread(target=background_cleanup, daemon=True)
-cleanup_thread.start()
+@app.route('/api/self-profiles/<name>', methods=['GET'])
+def download_self_profile(name):
+    """Download one self-profiling dump, ready to upload into a slot"""
+    return send_from_directory(os.path.abspath(app.config['SELF_PROFILE_DIR']), secure_filename(name),
+                               as_attachment=True)
+
+# Background cleanup scheduler
+if len(session_index) == 0:
+    seed_session_index()
+# Every server process runs the scheduler, but only the holder of the cleanup lock cleans up
+cleanup_scheduler = ExpiryScheduler(cleanup_expired_sessions, CLEANUP_INTERVAL_SECONDS,
+                                    leader_lock=ProcessLock(app.config['CLEANUP_LOCK_PATH']))
+# Parse workers started with spawn re-import this module; only server processes clean up
+if multiprocessing.parent_process() is None:
+    cleanup_scheduler.start()
+    metrics.start_publishing()
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Python Profile Comparison Server')
+    parser.add_argument('--host', default=os.environ.get('HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 5000)))
+    parser.add_argument('--debug', dest='debug', action='store_true',
+                        default=os.environ.get('FLASK_DEBUG') == '1', help='auto-reloader and debugger')
+    parser.add_argument('--no-debug', dest='debug', action='store_false')
+    args = parser.parse_args()
+    
     print("Starting Python Profile Comparison Server (No Redis)")
     print("=" * 60)
     print("Session isolation features:")
@@ -624,18 +2085,43 @@ if __name__ == '__main__':
     print("Storage directories:")
     print(f"  Sessions: {app.config['SESSION_FILE_DIR']}")
     print(f"  Profiles: {app.config['PROFILES_STORAGE_DIR']}")
-    print(f"  Uploads: {app.config['UPLOAD_FOLDER']}")
+    print(f"  Function tables: {app.config['PROFILE_TABLES_DIR']}")
+    print(f"  Parse cache: {app.config['PARSE_CACHE_DIR']}")
+    print(f"  Uploads (in flight): {app.config['UPLOAD_FOLDER']}")
+    print(f"  Raw upload blobs: {app.config['BLOB_STORE_DIR']} ({blob_store.codec})")
     print("=" * 60)
     print("Available endpoints:")
-    print("  POST /api/upload - Upload profile file")
-    print("  GET  /api/profiles - Get current session profiles")
+    print("  POST /api/upload - Upload profile file (?async=1 returns a parse job id)")
+    print("  POST /api/upload/batch - Upload many dumps or an archive into consecutive slots")
+    print("  POST /api/uploads - Start a resumable chunked upload (PUT chunks, then POST .../complete)")
+    print("  POST /api/live - Open a live slot fed by a sampling agent (POST /api/live/<id>/samples)")
+    print("  POST /api/merge - Merge many dumps or an archive into one profile slot")
+    print("  GET  /api/jobs/<job_id> - Parse job status and result")
+    print("  GET  /api/profiles - Slot summaries (?detail=full for full records)")
+    print("  GET  /api/profiles/<slot> - Full record of one slot")
+    print("  GET  /api/profiles/<slot>/raw - Originally uploaded dump of a slot")
+    print("  GET  /api/profiles/<slot>/functions - Sorted, paged function table")
+    print("  GET  /api/profiles/<slot>/hotspots - Top functions per metric and category rollups")
+    print("  GET  /api/profiles/<slot>/flamegraph - Call tree for flamegraphs (?format=collapsed)")
+    print("  GET  /api/profiles/<slot>/callgraph - Call-graph neighbourhood of a function")
+    print("  GET  /api/callgraph/diff - Call-graph neighbourhood diffed between two slots")
+    print("  GET  /api/search - Find functions across the session's profiles")
+    print("  GET  /api/trends - Jobs in the trend store (TREND_STORE_DIR)")
+    print("  POST /api/trends/runs - Record a slot as a run of a job")
+    print("  GET  /api/trends/runs - Runs of a job")
+    print("  GET  /api/trends/functions - Heaviest functions of a job's latest run")
+    print("  GET  /api/trends/series - Downsampled per-function or per-run series")
     print("  POST /api/compare - Compare profiles")
+    print("  POST /api/regressions - Significant changes between baseline and candidate runs")
     print("  POST /api/clear - Clear current session")
     print("  GET  /api/session-info - Get session information")
     print("  GET  /api/health - Health check")
+    print("  GET  /api/metrics - Prometheus-style server metrics")
+    print("  GET  /api/self-profiles - Self-profiling dumps (SELF_PROFILE_EVERY=N)")
     print("  GET  /api/debug/all-sessions - Debug all sessions")
     print("=" * 60)
-    print("\nServer starting on http://localhost:5000")
+    print(f"\nServer starting on http://localhost:{args.port}")
     print("No Redis required! Using file-based session storage.")
+    print("For several worker processes run: gunicorn -c gunicorn.conf.py app:app")
     
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    app.run(debug=args.debug, host=args.host, port=args.port, threaded=True)
\ No newline at end of file
@@ -0,0 +1,259 @@
+"""Fake sampling agent for live profile streams.
+
+Opens ``--streams`` live streams and, for ``--duration`` seconds, posts a
+batch of sampled stacks to each every ``--batch-seconds``, the way an
+agent inside a running batch job would. Stacks come from a synthetic
+call tree at ``--rate`` samples per second per stream (``--source
+synthetic``), or from sampling a CPU-bound worker thread of this process
+with sys._current_frames at ``--hz`` (``--source self``). Identical
+stacks are counted once per batch, as a real agent would send them.
+
+Reports samples accepted per second, batch latency percentiles, the
+function and edge counts the aggregates settled at and, in-process, the
+peak RSS of the process; then compares the live slots through
+/api/compare to show they behave like uploaded ones.
+
+By default the app is imported in-process inside a scratch directory;
+with ``--url`` the batches go over HTTP to a running server.
+
+Usage (from the backend directory):
+    python benchmarks/live_agent.py --rate 5000 --duration 20
+    python benchmarks/live_agent.py --url http://localhost:5000 --source self
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+from load_test import HttpClient, InProcessClient, latency_summary  # noqa: E402
+from profile_generator import DEFAULT_MIX, function_key  # noqa: E402
+from run_benchmarks import peak_rss_mb  # noqa: E402
+
+KINDS = ('user', 'stdlib', 'third_party', 'builtin')
+
+
+class SyntheticStacks:
+    """Stacks drawn from a fixed call tree, a few hot paths taking most samples"""
+
+    def __init__(self, functions, distinct_stacks, max_depth, seed):
+        rng = random.Random(seed)
+        self.frames = [function_key(i, rng.choices(KINDS, DEFAULT_MIX)[0], rng, 20) for i in range(functions)]
+        roots = list(range(min(8, functions)))
+        self.stacks = []
+        for _ in range(distinct_stacks):
+            stack = [rng.choice(roots)]
+            for _ in range(rng.randint(1, max_depth - 1)):
+                # Callees have higher indices, so paths look like a real call tree
+                stack.append(rng.randrange(stack[-1] + 1, functions) if stack[-1] + 1 < functions else stack[-1])
+            self.stacks.append(tuple(stack))
+        # Zipf-like weights: a few hot stacks, a long tail
+        self.weights = [1.0 / (rank + 1) for rank in range(distinct_stacks)]
+        self.rng = rng
+
+    def sample(self, count):
+        return Counter(self.rng.choices(self.stacks, self.weights, k=count))
+
+
+def busy_work(stop):
+    """CPU-bound workload for --source self"""
+    def fib(n):
+        return n if n < 2 else fib(n - 1) + fib(n - 2)
+
+    def encode_rows(rows):
+        return json.dumps([{'id': i, 'value': str(i) * 3} for i in range(rows)])
+
+    while not stop.is_set():
+        fib(18)
+        sorted(encode_rows(500))
+
+
+class SelfSampler(threading.Thread):
+    """Samples one thread of this process at ``hz`` into stack counts"""
+
+    def __init__(self, target_ident, hz, stop):
+        super().__init__(daemon=True)
+        self.target_ident = target_ident
+        self.interval = 1.0 / hz
+        self.stop = stop
+        self.frames = {}
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def run(self):
+        while not self.stop.is_set():
+            frame = sys._current_frames().get(self.target_ident)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                key = (code.co_filename, code.co_firstlineno, code.co_name)
+                stack.append(self.frames.setdefault(key, len(self.frames)))
+                frame = frame.f_back
+            if stack:
+                with self.lock:
+                    self.counts[tuple(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def drain(self):
+        with self.lock:
+            counts, self.counts = self.counts, Counter()
+            frames = sorted(self.frames, key=self.frames.get)
+        return frames, counts
+
+
+def make_batch(frames, counts, interval):
+    """Batch body with only the frames these stacks use"""
+    used = {}
+    samples = []
+    for stack, count in counts.items():
+        samples.append([[used.setdefault(index, len(used)) for index in stack], count])
+    frame_list = [None] * len(used)
+    for index, position in used.items():
+        frame_list[position] = list(frames[index])
+    return {'interval': interval, 'frames': frame_list, 'samples': samples}
+
+
+def run_agent(client, stream, source, rate, batch_seconds, deadline, results):
+    headers = {'X-Stream-Token': stream['token']}
+    latencies = []
+    accepted = 0
+    next_batch = time.perf_counter() + batch_seconds
+    while time.perf_counter() < deadline:
+        time.sleep(max(0.0, next_batch - time.perf_counter()))
+        next_batch += batch_seconds
+        if isinstance(source, SyntheticStacks):
+            frames, counts = source.frames, source.sample(int(rate * batch_seconds))
+        else:
+            frames, counts = source.drain()
+        if not counts:
+            continue
+        body = make_batch(frames, counts, stream['interval'])
+        started = time.perf_counter()
+        status, payload = client.request('POST', stream['ingest_url'], json_body=body, headers=headers)
+        latencies.append(('ingest', time.perf_counter() - started, status))
+        if status == 200:
+            accepted += json.loads(payload)['accepted']
+    results[stream['stream_id']] = {'accepted': accepted, 'latencies': latencies}
+
+
+def run_live(client, args):
+    streams = []
+    for index in range(args.streams):
+        status, payload = client.request('POST', '/api/live', json_body={
+            'profile_slot': str(index + 1), 'name': f'agent-{index + 1}', 'interval': 1.0 / args.hz})
+        if status != 201:
+            raise RuntimeError(f'Could not open a live stream: {status} {payload[:200]}')
+        streams.append(json.loads(payload))
+
+    stop = threading.Event()
+    sources = []
+    for index in range(args.streams):
+        if args.source == 'synthetic':
+            sources.append(SyntheticStacks(args.functions, args.distinct_stacks, args.max_depth, args.seed + index))
+        else:
+            worker = threading.Thread(target=busy_work, args=(stop,), daemon=True)
+            worker.start()
+            sampler = SelfSampler(worker.ident, args.hz, stop)
+            sampler.start()
+            sources.append(sampler)
+
+    results = {}
+    started = time.perf_counter()
+    deadline = started + args.duration
+    agents = [threading.Thread(target=run_agent, args=(client, stream, source, args.rate, args.batch_seconds,
+                                                       deadline, results))
+              for stream, source in zip(streams, sources)]
+    for agent in agents:
+        agent.start()
+    for agent in agents:
+        agent.join()
+    stop.set()
+    elapsed = time.perf_counter() - started
+
+    statuses = [json.loads(client.request('DELETE', f"/api/live/{stream['stream_id']}")[1]) for stream in streams]
+    compare_status, compare_body = (client.request('POST', '/api/compare', json_body={'limit': 10})
+                                    if len(streams) >= 2 else (None, b'{}'))
+    compared = json.loads(compare_body)['comparison']['common_functions'] if compare_status == 200 else []
+    latencies = [sample for result in results.values() for sample in result['latencies']]
+    accepted = sum(result['accepted'] for result in results.values())
+    return {
+        'streams': len(streams),
+        'source': args.source,
+        'seconds': elapsed,
+        'samples_accepted': accepted,
+        'samples_per_second': accepted / elapsed,
+        'samples_per_second_per_stream': accepted / elapsed / len(streams),
+        'batch_latency': latency_summary(latencies),
+        'final_streams': statuses,
+        'compare_status': compare_status,
+        'compared_functions': len(compared),
+    }
+
+
+def print_report(report):
+    print(f"{report['streams']} {report['source']} stream(s) for {report['seconds']:.1f}s: "
+          f"{report['samples_accepted']} samples accepted, {report['samples_per_second']:.0f}/s "
+          f"({report['samples_per_second_per_stream']:.0f}/s per stream)")
+    latency = report['batch_latency']
+    if latency.get('count'):
+        print(f"batch latency ms: p50 {latency['p50_ms']:.1f}  p95 {latency['p95_ms']:.1f}  "
+              f"p99 {latency['p99_ms']:.1f}  errors {latency['errors']} {latency['error_statuses'] or ''}")
+    for status in report['final_streams']:
+        print(f"  {status.get('name')}: {status.get('samples')} samples, {status.get('functions')} functions, "
+              f"{status.get('edges')} edges{' (overflowed)' if status.get('overflowed') else ''}")
+    if report['compare_status'] is not None:
+        print(f"compare of the live slots: HTTP {report['compare_status']}, "
+              f"{report['compared_functions']} common functions listed")
+    if 'peak_rss_mb' in report:
+        peak = report['peak_rss_mb']
+        print(f"peak RSS: {peak:.0f} MB" if peak is not None else "peak RSS: unavailable")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake sampling agent for live profile streams')
+    parser.add_argument('--streams', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds')
+    parser.add_argument('--source', choices=('synthetic', 'self'), default='synthetic')
+    parser.add_argument('--rate', type=float, default=5000, help='synthetic samples per second per stream')
+    parser.add_argument('--hz', type=float, default=100, help='sampling frequency; sets seconds per sample')
+    parser.add_argument('--batch-seconds', type=float, default=2.0)
+    parser.add_argument('--functions', type=int, default=5000, help='synthetic functions per stream')
+    parser.add_argument('--distinct-stacks', type=int, default=2000, help='synthetic distinct stacks per stream')
+    parser.add_argument('--max-depth', type=int, default=40)
+    parser.add_argument('--url', help='post to a running server instead of the in-process app')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='also write the report as JSON here')
+    args = parser.parse_args()
+
+    if args.url:
+        report = run_live(HttpClient(args.url), args)
+    else:
+        with tempfile.TemporaryDirectory(prefix='profile-live-') as work_dir:
+            # The app keeps its storage relative to the working directory
+            os.chdir(work_dir)
+            import app as app_module
+            try:
+                report = run_live(InProcessClient(app_module.app), args)
+            finally:
+                app_module.parse_jobs.shutdown()
+                os.chdir(BACKEND_DIR)
+        report['peak_rss_mb'] = peak_rss_mb()
+
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,346 @@
+"""Concurrent-session load test for the profile backend.
+
+Runs ``--users`` independent cookie sessions in parallel, each looping
+over a weighted mix of upload, profiles, compare, clear and health calls
+with generated pstats dumps, for ``--duration`` seconds. Reports p50, p95
+and p99 latency per call and overall, throughput, and from the server's
+own /api/metrics the time spent waiting for session store locks and in
+cleanup_expired_sessions during the run.
+
+By default the app is imported in-process inside a scratch directory and
+driven through Flask test clients; a cleanup thread runs
+cleanup_expired_sessions every ``--cleanup-interval`` seconds against
+``--expired-sessions`` pre-aged sessions so cleanup competes with the
+requests. With ``--url`` the same mix is sent over HTTP to a running
+server instead (lock and cleanup figures then cover every worker when the
+server runs under gunicorn.conf.py, else the one process that answered
+/api/metrics).
+
+Usage (from the backend directory):
+    python benchmarks/load_test.py --users 12 --duration 30
+    python benchmarks/load_test.py --url http://localhost:5000 --users 12
+"""
+import argparse
+import http.cookiejar
+import io
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+from profile_generator import write_profile  # noqa: E402
+
+DEFAULT_MIX = 'upload=30,profiles=30,compare=20,clear=5,health=15'
+SLOTS = ('1', '2', '3', '4')
+DUMP_COUNT = 8
+SERVER_METRICS = {
+    'lock_wait_seconds': 'profile_store_lock_wait_seconds_total',
+    'cleanup_seconds': 'profile_cleanup_duration_seconds_sum',
+    'cleanup_runs': 'profile_cleanup_duration_seconds_count',
+    'cleanup_sessions_removed': 'profile_cleanup_sessions_removed_total',
+}
+METRIC_LINE_RE = re.compile(r'^([A-Za-z_:][A-Za-z0-9_:]*)(?:\{[^}]*\})? (\S+)$')
+
+
+class InProcessClient:
+    """One cookie session against the imported app"""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, json_body=None, files=None, fields=None, headers=None):
+        if files:
+            data = dict(fields or {})
+            data.update((name, (io.BytesIO(content), filename)) for name, (filename, content) in files.items())
+            response = self.client.open(path, method=method, data=data, content_type='multipart/form-data',
+                                        headers=headers)
+        else:
+            response = self.client.open(path, method=method, json=json_body, headers=headers)
+        return response.status_code, response.get_data()
+
+
+class HttpClient:
+    """One cookie session against a server on ``base_url``"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def request(self, method, path, json_body=None, files=None, fields=None, headers=None):
+        headers = dict(headers or {})
+        body = None
+        if files:
+            boundary = uuid.uuid4().hex
+            parts = [
+                f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+                for name, value in (fields or {}).items()
+            ]
+            for name, (filename, content) in files.items():
+                parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; '
+                             f'filename="{filename}"\r\nContent-Type: application/octet-stream\r\n\r\n'.encode())
+                parts.append(content + b'\r\n')
+            parts.append(f'--{boundary}--\r\n'.encode())
+            body = b''.join(parts)
+            headers['Content-Type'] = f'multipart/form-data; boundary={boundary}'
+        elif json_body is not None:
+            body = json.dumps(json_body).encode()
+            headers['Content-Type'] = 'application/json'
+        request = urllib.request.Request(self.base_url + path, data=body, headers=headers, method=method)
+        try:
+            with self.opener.open(request, timeout=300) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in ('upload', 'profiles', 'compare', 'clear', 'health'):
+            raise ValueError(f'unknown call in mix: {name}')
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def server_metrics(client):
+    """Current values of SERVER_METRICS, summed over labels"""
+    status, body = client.request('GET', '/api/metrics')
+    if status != 200:
+        return {}
+    totals = {}
+    for line in body.decode().splitlines():
+        match = METRIC_LINE_RE.match(line)
+        if match:
+            totals[match.group(1)] = totals.get(match.group(1), 0.0) + float(match.group(2))
+    return {key: totals.get(name, 0.0) for key, name in SERVER_METRICS.items()}
+
+
+class VirtualUser(threading.Thread):
+    """Loops over the call mix in its own session until the deadline"""
+
+    def __init__(self, client, dumps, mix, deadline, think_seconds, seed):
+        super().__init__(daemon=True)
+        self.client = client
+        self.dumps = dumps
+        self.calls = list(mix)
+        self.weights = list(mix.values())
+        self.deadline = deadline
+        self.think_seconds = think_seconds
+        self.rng = random.Random(seed)
+        self.filled = set()
+        self.samples = []  # (call, seconds, status)
+
+    def next_call(self):
+        call = self.rng.choices(self.calls, self.weights)[0]
+        # Comparing needs two profiles; an empty session uploads first
+        if call == 'compare' and len(self.filled) < 2:
+            return 'upload'
+        return call
+
+    def perform(self, call):
+        if call == 'upload':
+            slot = self.rng.choice(SLOTS)
+            filename, content = self.rng.choice(self.dumps)
+            status, _ = self.client.request('POST', '/api/upload', files={'file': (filename, content)},
+                                            fields={'profile_slot': slot})
+            if status == 200:
+                self.filled.add(slot)
+            return status
+        if call == 'profiles':
+            return self.client.request('GET', '/api/profiles')[0]
+        if call == 'compare':
+            return self.client.request('POST', '/api/compare', json_body={'limit': 50})[0]
+        if call == 'clear':
+            status = self.client.request('POST', '/api/clear')[0]
+            if status == 200:
+                self.filled.clear()
+            return status
+        return self.client.request('GET', '/api/health')[0]
+
+    def run(self):
+        while time.perf_counter() < self.deadline:
+            call = self.next_call()
+            started = time.perf_counter()
+            try:
+                status = self.perform(call)
+            except Exception as e:
+                print(f"{call} failed: {e}")
+                status = 0
+            self.samples.append((call, time.perf_counter() - started, status))
+            if self.think_seconds:
+                time.sleep(self.rng.expovariate(1.0 / self.think_seconds))
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))]
+
+
+def latency_summary(samples):
+    seconds = sorted(sample[1] for sample in samples)
+    errors = [sample[2] for sample in samples if not 200 <= sample[2] < 300]
+    return {
+        'count': len(seconds),
+        'errors': len(errors),
+        'error_statuses': {str(status): errors.count(status) for status in sorted(set(errors))},
+        'mean_ms': statistics.fmean(seconds) * 1000 if seconds else None,
+        'p50_ms': percentile(seconds, 0.50) * 1000 if seconds else None,
+        'p95_ms': percentile(seconds, 0.95) * 1000 if seconds else None,
+        'p99_ms': percentile(seconds, 0.99) * 1000 if seconds else None,
+        'max_ms': seconds[-1] * 1000 if seconds else None
+    }
+
+
+def generate_dumps(data_dir, functions):
+    """DUMP_COUNT distinct dumps of ``functions`` functions, reused across runs"""
+    os.makedirs(data_dir, exist_ok=True)
+    dumps = []
+    for seed in range(DUMP_COUNT):
+        path = os.path.join(data_dir, f"load_{functions}_{seed}.prof")
+        if not os.path.exists(path):
+            write_profile(path, functions=functions, seed=seed)
+        with open(path, 'rb') as f:
+            dumps.append((os.path.basename(path), f.read()))
+    return dumps
+
+
+def seed_expired_sessions(app_module, count):
+    """Sessions last touched beyond the retention period, each holding one slot"""
+    aged = time.time() - app_module.SESSION_RETENTION.total_seconds() - 3600
+    for _ in range(count):
+        session_id = f"expired-{uuid.uuid4()}"
+        app_module.profile_store.put(session_id, '1', {
+            'filename': 'expired.prof', 'uploaded_at': '2024-01-01T00:00:00', 'table_path': None,
+            'content_hash': None, 'data': {'total_calls': 0, 'total_time': 0, 'functions': []}
+        })
+        app_module.session_index.touch(session_id, when=aged)
+
+
+def run_cleanup_loop(app_module, interval, stop):
+    while not stop.wait(interval):
+        app_module.cleanup_expired_sessions()
+
+
+def run_load(make_client, dumps, mix, users, duration, think_seconds, seed, finish=None):
+    """Drive ``users`` sessions for ``duration`` seconds; ``finish`` runs before the closing metrics are read"""
+    probe = make_client()
+    before = server_metrics(probe)
+    deadline = time.perf_counter() + duration
+    started = time.perf_counter()
+    workers = [VirtualUser(make_client(), dumps, mix, deadline, think_seconds, seed + i) for i in range(users)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    if finish is not None:
+        finish()
+    after = server_metrics(probe)
+
+    samples = [sample for worker in workers for sample in worker.samples]
+    return {
+        'users': users,
+        'duration_s': elapsed,
+        'requests': len(samples),
+        'throughput_rps': len(samples) / elapsed if elapsed else 0.0,
+        'overall': latency_summary(samples),
+        'calls': {call: latency_summary([s for s in samples if s[0] == call]) for call in mix},
+        'server': {key: after.get(key, 0.0) - before.get(key, 0.0) for key in SERVER_METRICS}
+    }
+
+
+def print_report(report):
+    header = f"{'call':<10}{'count':>8}{'errors':>8}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+    print(header)
+    print('-' * len(header))
+    for call, m in list(report['calls'].items()) + [('all', report['overall'])]:
+        if not m['count']:
+            print(f"{call:<10}{0:>8}")
+            continue
+        print(f"{call:<10}{m['count']:>8}{m['errors']:>8}{m['mean_ms']:>10.1f}{m['p50_ms']:>10.1f}"
+              f"{m['p95_ms']:>10.1f}{m['p99_ms']:>10.1f}{m['max_ms']:>10.1f}")
+    server = report['server']
+    print(f"\n{report['requests']} requests from {report['users']} sessions in {report['duration_s']:.1f}s "
+          f"= {report['throughput_rps']:.1f} req/s")
+    for call, m in report['calls'].items():
+        if m['errors']:
+            print(f"{call} errors by status: {m['error_statuses']}")
+    print(f"Session store lock wait: {server['lock_wait_seconds']:.3f}s")
+    print(f"cleanup_expired_sessions: {server['cleanup_seconds']:.3f}s over {server['cleanup_runs']:.0f} runs, "
+          f"{server['cleanup_sessions_removed']:.0f} sessions removed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent-session load test for the profile backend')
+    parser.add_argument('--users', type=int, default=12)
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='call=weight pairs')
+    parser.add_argument('--functions', type=int, default=2000, help='functions per generated dump')
+    parser.add_argument('--think-ms', type=float, default=0.0, help='mean pause between a session\'s calls')
+    parser.add_argument('--url', help='drive a running server instead of the in-process app')
+    parser.add_argument('--cleanup-interval', type=float, default=5.0,
+                        help='in-process only: seconds between cleanup_expired_sessions runs (0 disables)')
+    parser.add_argument('--expired-sessions', type=int, default=200,
+                        help='in-process only: pre-aged sessions for cleanup to remove')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'profile-bench-data'))
+    parser.add_argument('--output', help='also write the report as JSON here')
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    dumps = generate_dumps(args.data_dir, args.functions)
+
+    if args.url:
+        report = run_load(lambda: HttpClient(args.url), dumps, mix, args.users, args.duration,
+                          args.think_ms / 1000, args.seed)
+    else:
+        with tempfile.TemporaryDirectory(prefix='profile-load-') as work_dir:
+            # The app keeps its storage relative to the working directory
+            os.chdir(work_dir)
+            import app as app_module
+            seed_expired_sessions(app_module, args.expired_sessions)
+            stop = threading.Event()
+            cleaner = threading.Thread(target=run_cleanup_loop, daemon=True,
+                                       args=(app_module, args.cleanup_interval, stop))
+            if args.cleanup_interval > 0:
+                cleaner.start()
+
+            def finish():
+                # A cleanup run still going is counted in full
+                stop.set()
+                if cleaner.is_alive():
+                    cleaner.join()
+
+            try:
+                report = run_load(lambda: InProcessClient(app_module.app), dumps, mix, args.users,
+                                  args.duration, args.think_ms / 1000, args.seed, finish)
+            finally:
+                finish()
+                app_module.parse_jobs.shutdown()
+                os.chdir(BACKEND_DIR)
+
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
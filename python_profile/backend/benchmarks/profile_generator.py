@@ -0,0 +1,121 @@
+"""Synthetic pstats dumps for benchmarks and load tests.
+
+Writes the same marshalled dict cProfile produces, with a configurable
+number of functions, call-graph fan-out and mix of user, stdlib,
+third-party and builtin functions. Calls only go from lower to higher
+function indices, so the graph is acyclic and cumulative times are
+consistent: a function's cumulative time is its own time plus its share
+of each callee's cumulative time.
+
+Usage: python benchmarks/profile_generator.py out.prof --functions 100000
+"""
+import argparse
+import marshal
+import random
+
+# Share of functions per kind: user, stdlib, third_party, builtin
+DEFAULT_MIX = (0.5, 0.25, 0.15, 0.1)
+
+STDLIB_ROOT = '/usr/lib/python3.11'
+SITE_PACKAGES = '/usr/lib/python3.11/site-packages'
+PROJECT_ROOT = '/srv/app'
+STDLIB_MODULES = ('json/decoder.py', 're/_parser.py', 'collections/__init__.py',
+                  'threading.py', 'logging/__init__.py', 'os.py', 'socket.py', 'typing.py')
+THIRD_PARTY_PACKAGES = ('numpy', 'requests', 'flask', 'werkzeug', 'sqlalchemy', 'pandas')
+BUILTIN_NAMES = ('len', 'isinstance', 'getattr', 'sorted', 'min', 'max')
+BUILTIN_METHODS = ('append', 'join', 'get', 'items', 'split', 'encode', 'read')
+
+
+def function_key(index, kind, rng, files_per_kind):
+    """A (filename, line, function name) key in the shape cProfile records"""
+    file_index = rng.randrange(files_per_kind)
+    if kind == 'builtin':
+        if index % 2:
+            return ('~', 0, f"<built-in method builtins.{BUILTIN_NAMES[file_index % len(BUILTIN_NAMES)]}_{index}>")
+        method = BUILTIN_METHODS[file_index % len(BUILTIN_METHODS)]
+        return ('~', 0, f"<method '{method}_{index}' of 'object' objects>")
+    if kind == 'stdlib':
+        module = STDLIB_MODULES[file_index % len(STDLIB_MODULES)]
+        filename = f"{STDLIB_ROOT}/{module[:-3]}_{file_index}.py"
+    elif kind == 'third_party':
+        package = THIRD_PARTY_PACKAGES[file_index % len(THIRD_PARTY_PACKAGES)]
+        filename = f"{SITE_PACKAGES}/{package}/module_{file_index}.py"
+    else:
+        filename = f"{PROJECT_ROOT}/pkg_{file_index % 50}/module_{file_index}.py"
+    return (filename, 1 + (index * 7) % 5000, f"func_{index}")
+
+
+def generate_stats(functions=1000, fan_out=4, mix=DEFAULT_MIX, files=200, seed=0):
+    """Return a pstats-style stats dict with ``functions`` entries"""
+    rng = random.Random(seed)
+    kinds = rng.choices(('user', 'stdlib', 'third_party', 'builtin'), weights=mix, k=functions)
+    kinds[0] = 'user'
+    files_per_kind = max(1, files // 3)
+    keys = [function_key(i, kind, rng, files_per_kind) for i, kind in enumerate(kinds)]
+
+    # Outgoing edges; callees are drawn with a bias towards nearby functions
+    callees = [[] for _ in range(functions)]
+    primitive_calls = [1] * functions
+    for caller in range(functions - 1):
+        if kinds[caller] == 'builtin':
+            continue
+        span = functions - caller - 1
+        for _ in range(rng.randint(0, 2 * fan_out)):
+            callee = caller + 1 + min(span - 1, int(rng.expovariate(1.0 / 50)))
+            calls = max(1, int(rng.paretovariate(1.5)))
+            callees[caller].append((callee, calls))
+            primitive_calls[callee] += calls
+
+    own_time = [rng.expovariate(1.0 / 0.0005) for _ in range(functions)]
+    cumulative = [0.0] * functions
+    callers = [{} for _ in range(functions)]
+    for caller in range(functions - 1, -1, -1):
+        total = own_time[caller]
+        for callee, calls in callees[caller]:
+            share = calls / primitive_calls[callee]
+            edge_tt = own_time[callee] * share
+            edge_ct = cumulative[callee] * share
+            total += edge_ct
+            existing = callers[callee].get(keys[caller])
+            if existing:
+                calls += existing[1]
+                edge_tt += existing[2]
+                edge_ct += existing[3]
+            callers[callee][keys[caller]] = (calls, calls, edge_tt, edge_ct)
+        cumulative[caller] = total
+
+    stats = {}
+    for i, key in enumerate(keys):
+        nc = primitive_calls[i]
+        # A few functions recurse, so their total call count exceeds primitive calls
+        total_calls = nc + (rng.randint(1, 5) if i % 37 == 0 else 0)
+        stats[key] = (nc, total_calls, own_time[i], cumulative[i], callers[i])
+    return stats
+
+
+def write_profile(path, **options):
+    """Write a synthetic dump readable by ``pstats.Stats(path)``; returns its function count"""
+    stats = generate_stats(**options)
+    with open(path, 'wb') as f:
+        marshal.dump(stats, f)
+    return len(stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('output')
+    parser.add_argument('--functions', type=int, default=1000)
+    parser.add_argument('--fan-out', type=int, default=4)
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--mix', default=','.join(str(x) for x in DEFAULT_MIX),
+                        help='user,stdlib,third_party,builtin weights')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    count = write_profile(args.output, functions=args.functions, fan_out=args.fan_out,
+                          files=args.files, seed=args.seed,
+                          mix=tuple(float(x) for x in args.mix.split(',')))
+    print(f"Wrote {count} functions to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
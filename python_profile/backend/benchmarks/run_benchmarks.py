@@ -0,0 +1,338 @@
+"""Benchmarks for the parse, store, compare and categorisation hot paths.
+
+Every (case, size) runs in a fresh interpreter inside a scratch directory,
+so peak RSS belongs to that case alone and the app's storage directories
+never touch the working tree. Each case reports the median and minimum
+wall time over ``--repeat`` runs, peak RSS, RSS growth during the runs,
+and the peak traced allocation of one extra run under tracemalloc. Peak
+RSS comes from the resource module, or on Windows from psutil or
+GetProcessMemoryInfo, and is reported as unavailable when none works.
+
+Results can be saved as a baseline and later runs compared against it;
+any metric worse than the baseline by more than ``--threshold`` is
+reported as a regression and the script exits with status 1.
+
+Usage (from the backend directory):
+    python benchmarks/run_benchmarks.py --sizes 1000,10000 --save-baseline
+    python benchmarks/run_benchmarks.py --sizes 1000,10000
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+from profile_generator import generate_stats, write_profile  # noqa: E402
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+DEFAULT_BASELINE = os.path.join(BENCHMARK_DIR, 'baseline.json')
+STORED_SLOTS = 4
+# Differences below these floors are noise, whatever the ratio
+NOISE_FLOORS = {'wall_median_s': 0.002, 'rss_growth_mb': 2.0, 'alloc_peak_mb': 1.0}
+
+
+def _windows_peak_rss_mb():
+    import ctypes
+    from ctypes import wintypes
+
+    class ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD)] + [
+            (name, ctypes.c_size_t) for name in (
+                'PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage',
+                'QuotaPagedPoolUsage', 'QuotaPeakNonPagedPoolUsage', 'QuotaNonPagedPoolUsage',
+                'PagefileUsage', 'PeakPagefileUsage')]
+
+    counters = ProcessMemoryCounters()
+    counters.cb = ctypes.sizeof(counters)
+    kernel32 = ctypes.windll.kernel32
+    kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+    psapi = ctypes.windll.psapi
+    psapi.GetProcessMemoryInfo.argtypes = [wintypes.HANDLE, ctypes.POINTER(ProcessMemoryCounters), wintypes.DWORD]
+    if not psapi.GetProcessMemoryInfo(kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+        return None
+    return counters.PeakWorkingSetSize / (1024 * 1024)
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, or None if the platform won't say"""
+    if resource is not None:
+        # ru_maxrss is kilobytes on Linux and bytes on macOS
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        # peak_wset only exists on Windows
+        return getattr(info, 'peak_wset', info.rss) / (1024 * 1024)
+    if sys.platform == 'win32':
+        try:
+            return _windows_peak_rss_mb()
+        except (AttributeError, OSError):
+            return None
+    return None
+
+
+def _mb(value, width):
+    return f"{value:>{width}.1f}" if value is not None else f"{'n/a':>{width}}"
+
+
+def _app_session(app_module, session_id):
+    """A request context whose session belongs to ``session_id``"""
+    context = app_module.app.test_request_context()
+    context.push()
+    app_module.session['session_id'] = session_id
+    return context
+
+
+def setup_parse_profile_file(data_dir, size):
+    from profile_parser import parse_profile_file
+    dump = os.path.join(data_dir, f"profile_{size}_0.prof")
+    return lambda: parse_profile_file(dump, 'bench_table.ptab')
+
+
+def _stored_profiles(data_dir, size):
+    from profile_parser import parse_profile_file
+    profiles = {}
+    for slot in range(1, STORED_SLOTS + 1):
+        dump = os.path.join(data_dir, f"profile_{size}_{(slot - 1) % 2}.prof")
+        table_path = os.path.abspath(f"table_{slot}.ptab")
+        profiles[str(slot)] = {
+            'filename': os.path.basename(dump),
+            'unique_filename': os.path.basename(dump),
+            'filepath': dump,
+            'uploaded_at': '2024-01-01T00:00:00',
+            'table_path': table_path,
+            'content_hash': f"bench-{size}-{slot}",
+            'data': parse_profile_file(dump, table_path)
+        }
+    return profiles
+
+
+def setup_save_user_profiles_to_storage(data_dir, size):
+    import app as app_module
+    profiles = _stored_profiles(data_dir, size)
+    _app_session(app_module, 'bench-session')
+    return lambda: app_module.save_user_profiles_to_storage(profiles)
+
+
+def setup_get_user_profiles_from_storage(data_dir, size):
+    import app as app_module
+    profiles = _stored_profiles(data_dir, size)
+    _app_session(app_module, 'bench-session')
+    app_module.save_user_profiles_to_storage(profiles)
+    return app_module.get_user_profiles_from_storage
+
+
+def setup_compare_profiles(data_dir, size):
+    import app as app_module
+    profiles = _stored_profiles(data_dir, size)
+    _app_session(app_module, 'bench-session')
+    app_module.save_user_profiles_to_storage(profiles)
+    client = app_module.app.test_client()
+    with client.session_transaction() as client_session:
+        client_session['session_id'] = 'bench-session'
+
+    def run():
+        # Measure a cold comparison, not the memoised or incrementally kept one
+        app_module.comparison_cache.clear()
+        app_module.comparison_states.clear()
+        response = client.post('/api/compare', json={'limit': 50})
+        assert response.status_code == 200, response.get_data(as_text=True)
+    return run
+
+
+def setup_categorize_functions(data_dir, size):
+    from function_categories import categorize_function, classify_filename
+    keys = list(generate_stats(functions=size, seed=0))
+
+    def run():
+        classify_filename.cache_clear()
+        for filename, _, function_name in keys:
+            categorize_function(filename, function_name)
+    return run
+
+
+CASES = {
+    'parse_profile_file': setup_parse_profile_file,
+    'save_user_profiles_to_storage': setup_save_user_profiles_to_storage,
+    'get_user_profiles_from_storage': setup_get_user_profiles_from_storage,
+    'compare_profiles': setup_compare_profiles,
+    'categorize_functions': setup_categorize_functions,
+}
+
+
+def run_case(case, size, data_dir, repeat):
+    """Measure one case in this process (called in the child interpreter)"""
+    run = CASES[case](data_dir, size)
+    run()  # warm-up: imports, lazily built caches
+    rss_before = peak_rss_mb()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    rss_after = peak_rss_mb()
+
+    tracemalloc.start()
+    run()
+    _, alloc_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'wall_median_s': statistics.median(timings),
+        'wall_min_s': min(timings),
+        'rss_peak_mb': rss_after,
+        'rss_growth_mb': rss_after - rss_before if rss_after is not None else None,
+        'alloc_peak_mb': alloc_peak / (1024 * 1024),
+        'repeat': repeat
+    }
+
+
+def measure(case, size, data_dir, repeat):
+    """Run one case in a fresh interpreter inside a scratch directory"""
+    with tempfile.TemporaryDirectory(prefix='profile-bench-') as work_dir:
+        result_path = os.path.join(work_dir, 'result.json')
+        command = [sys.executable, os.path.abspath(__file__), '--child', case, str(size),
+                   '--data-dir', data_dir, '--repeat', str(repeat), '--result-file', result_path]
+        completed = subprocess.run(command, cwd=work_dir, stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.PIPE, text=True)
+        if completed.returncode != 0:
+            raise RuntimeError(f"{case}[{size}] failed:\n{completed.stderr}")
+        with open(result_path) as f:
+            return json.load(f)
+
+
+def prepare_data(data_dir, sizes, fan_out):
+    """Generate the dumps each size needs, reusing earlier ones"""
+    os.makedirs(data_dir, exist_ok=True)
+    for size in sizes:
+        for seed in (0, 1):
+            path = os.path.join(data_dir, f"profile_{size}_{seed}.prof")
+            if not os.path.exists(path):
+                print(f"Generating {path}")
+                write_profile(path, functions=size, fan_out=fan_out, seed=seed)
+
+
+def environment():
+    import numpy
+    return {
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count()
+    }
+
+
+def find_regressions(results, baseline, threshold):
+    """(key, metric, baseline value, current value) for every metric past the threshold"""
+    regressions = []
+    for key, metrics in results.items():
+        previous = baseline.get(key)
+        if not previous:
+            continue
+        for metric, floor in NOISE_FLOORS.items():
+            old, new = previous.get(metric), metrics.get(metric)
+            if old is None or new is None:
+                continue
+            if new > old * (1 + threshold) and new - old > floor:
+                regressions.append((key, metric, old, new))
+    return regressions
+
+
+def print_results(results, baseline):
+    header = f"{'case':<46}{'median s':>10}{'min s':>10}{'rss MB':>9}{'+rss MB':>9}{'alloc MB':>10}{'vs base':>9}"
+    print(header)
+    print('-' * len(header))
+    for key, m in results.items():
+        previous = baseline.get(key, {}).get('wall_median_s')
+        change = f"{(m['wall_median_s'] / previous - 1) * 100:+.0f}%" if previous else '-'
+        print(f"{key:<46}{m['wall_median_s']:>10.4f}{m['wall_min_s']:>10.4f}{_mb(m['rss_peak_mb'], 9)}"
+              f"{_mb(m['rss_growth_mb'], 9)}{m['alloc_peak_mb']:>10.1f}{change:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the profile backend hot paths')
+    parser.add_argument('--sizes', default=','.join(str(s) for s in DEFAULT_SIZES),
+                        help='comma separated function counts (1000 to 500000)')
+    parser.add_argument('--cases', default=','.join(CASES), help='comma separated case names')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--fan-out', type=int, default=4)
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'profile-bench-data'))
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help='store these results as the baseline')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed relative slowdown (0.2 = 20%%)')
+    parser.add_argument('--output', help='also write results as JSON here')
+    parser.add_argument('--child', nargs=2, metavar=('CASE', 'SIZE'), help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        case, size = args.child[0], int(args.child[1])
+        result = run_case(case, size, args.data_dir, args.repeat)
+        with open(args.result_file, 'w') as f:
+            json.dump(result, f)
+        return 0
+
+    sizes = [int(s) for s in args.sizes.split(',') if s]
+    cases = [c for c in args.cases.split(',') if c]
+    unknown = [c for c in cases if c not in CASES]
+    if unknown:
+        parser.error(f"unknown case(s): {', '.join(unknown)}")
+    prepare_data(args.data_dir, sizes, args.fan_out)
+
+    results = {}
+    for size in sizes:
+        for case in cases:
+            print(f"Running {case}[{size}]")
+            results[f"{case}[{size}]"] = measure(case, size, args.data_dir, args.repeat)
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            stored = json.load(f)
+        baseline = stored.get('results', {})
+        if stored.get('environment') != environment():
+            print(f"Warning: baseline was recorded on {stored.get('environment')}")
+
+    print_results(results, baseline)
+    report = {'environment': environment(), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    regressions = find_regressions(results, baseline, args.threshold)
+    for key, metric, old, new in regressions:
+        # Growth metrics are often exactly 0 in the baseline, where a ratio means nothing
+        change = f"{(new / old - 1) * 100:+.0f}%" if old > 0 else f"{new - old:+.4f}"
+        print(f"REGRESSION {key} {metric}: {old:.4f} -> {new:.4f} ({change})")
+    if baseline and not regressions:
+        print(f"No regressions beyond {args.threshold:.0%} of the baseline")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
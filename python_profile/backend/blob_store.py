@@ -0,0 +1,324 @@
+"""Content-addressed store for raw uploaded dumps.
+
+Every distinct upload is kept once, under its SHA-256, compressed with
+zstd (gzip when the optional ``zstandard`` package is missing). Sessions
+reference blobs by slot and a blob's reference count is the number of
+slots pointing at it, plus pins: an upload pins its blob, in the same
+transaction that stores it and checks the quotas, until its parse
+finishes and the slot points at it, so the blob cannot be evicted in
+between. Sessions are charged the raw size of the distinct
+blobs they reference, against a per-session quota; the compressed bytes
+on disk are held to a global quota. Unreferenced blobs are kept for
+re-uploads until they have been idle for a while or their space is
+needed, then removed least recently used first, a bounded batch at a
+time.
+
+The index is one SQLite database shared by all server processes; blob
+files are only created or removed inside its write transactions.
+"""
+import gzip
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from contextlib import closing, contextmanager
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS blobs ("
+    " hash TEXT PRIMARY KEY, size INTEGER NOT NULL, stored_size INTEGER NOT NULL,"
+    " codec TEXT NOT NULL, refcount INTEGER NOT NULL, last_used REAL NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS blobs_unreferenced ON blobs (last_used) WHERE refcount = 0",
+    "CREATE TABLE IF NOT EXISTS refs ("
+    " session_id TEXT NOT NULL, ref TEXT NOT NULL, hash TEXT NOT NULL,"
+    " PRIMARY KEY (session_id, ref))",
+    "CREATE INDEX IF NOT EXISTS refs_by_hash ON refs (hash)",
+    "CREATE TABLE IF NOT EXISTS pins ("
+    " session_id TEXT NOT NULL, ref TEXT NOT NULL, hash TEXT NOT NULL, count INTEGER NOT NULL,"
+    " created REAL NOT NULL, PRIMARY KEY (session_id, ref, hash))",
+)
+INDEX_FILE = 'blobs.db'
+CODEC_SUFFIXES = {'zstd': '.zst', 'gzip': '.gz'}
+ZSTD_LEVEL = 3
+GZIP_LEVEL = 6
+CHUNK_SIZE = 1024 * 1024
+RECLAIM_BATCH = 100
+
+
+class BlobQuotaExceeded(Exception):
+    """Storing an upload would exceed the session (``scope='session'``) or global quota"""
+
+    def __init__(self, message, scope):
+        super().__init__(message)
+        self.scope = scope
+
+
+def default_codec():
+    return 'zstd' if zstandard is not None else 'gzip'
+
+
+class BlobStore:
+    """Deduplicated, compressed, reference-counted raw uploads"""
+
+    def __init__(self, root, session_quota_bytes, global_quota_bytes, unreferenced_ttl_seconds=3600):
+        self.root = root
+        self.session_quota_bytes = session_quota_bytes
+        self.global_quota_bytes = global_quota_bytes
+        self.unreferenced_ttl_seconds = unreferenced_ttl_seconds
+        self.codec = default_codec()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+        with closing(self._connect()) as conn:
+            for statement in SCHEMA:
+                conn.execute(statement)
+
+    def _connect(self):
+        return sqlite3.connect(os.path.join(self.root, INDEX_FILE), timeout=30, isolation_level=None)
+
+    @contextmanager
+    def _write(self):
+        """Exclusive write transaction across threads and processes"""
+        with self._lock, closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def _path(self, content_hash, codec):
+        return os.path.join(self.root, 'objects', content_hash[:2], content_hash + CODEC_SUFFIXES[codec])
+
+    def _compress(self, src, dst):
+        with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+            if self.codec == 'zstd':
+                zstandard.ZstdCompressor(level=ZSTD_LEVEL).copy_stream(fin, fout, read_size=CHUNK_SIZE)
+            else:
+                with gzip.GzipFile(fileobj=fout, mode='wb', compresslevel=GZIP_LEVEL, mtime=0) as out:
+                    shutil.copyfileobj(fin, out, CHUNK_SIZE)
+
+    def _session_refs(self, conn, session_id):
+        """ref -> (hash, raw size) for every slot the session references"""
+        return {
+            ref: (content_hash, size) for ref, content_hash, size in conn.execute(
+                "SELECT r.ref, r.hash, b.size FROM refs r JOIN blobs b ON b.hash = r.hash WHERE r.session_id = ?",
+                (session_id,)
+            )
+        }
+
+    def _session_charge(self, conn, session_id, content_hash=None, size=0):
+        """Raw bytes of the distinct blobs a session references or has pinned, plus one more blob"""
+        charged = {content_hash: size} if content_hash else {}
+        charged.update(self._session_refs(conn, session_id).values())
+        charged.update(conn.execute(
+            "SELECT p.hash, b.size FROM pins p JOIN blobs b ON b.hash = p.hash WHERE p.session_id = ?",
+            (session_id,)
+        ))
+        return sum(charged.values())
+
+    def _check_session_quota(self, conn, session_id, content_hash, size):
+        charged = self._session_charge(conn, session_id, content_hash, size)
+        if charged > self.session_quota_bytes:
+            raise BlobQuotaExceeded(
+                f'Session storage quota exceeded ({charged} of {self.session_quota_bytes} bytes); '
+                'clear some profiles first', 'session')
+
+    def _pin(self, conn, session_id, ref, content_hash):
+        """Pin a stored blob for a session's ref; False if no such blob exists"""
+        now = time.time()
+        if not conn.execute("UPDATE blobs SET refcount = refcount + 1, last_used = ? WHERE hash = ?",
+                            (now, content_hash)).rowcount:
+            return False
+        conn.execute(
+            "INSERT INTO pins (session_id, ref, hash, count, created) VALUES (?, ?, ?, 1, ?) "
+            "ON CONFLICT (session_id, ref, hash) DO UPDATE SET count = count + 1, created = excluded.created",
+            (session_id, ref, content_hash, now)
+        )
+        return True
+
+    def _take_pin(self, conn, session_id, ref, content_hash):
+        """Remove one pin, keeping the reference it holds; False if there was none"""
+        row = conn.execute("SELECT count FROM pins WHERE session_id = ? AND ref = ? AND hash = ?",
+                           (session_id, ref, content_hash)).fetchone()
+        if row is None:
+            return False
+        if row[0] > 1:
+            conn.execute("UPDATE pins SET count = count - 1 WHERE session_id = ? AND ref = ? AND hash = ?",
+                         (session_id, ref, content_hash))
+        else:
+            conn.execute("DELETE FROM pins WHERE session_id = ? AND ref = ? AND hash = ?",
+                         (session_id, ref, content_hash))
+        return True
+
+    def put(self, session_id, ref, path, content_hash, size):
+        """Store the file at ``path`` for a session's ``ref`` and pin it.
+
+        The session quota is checked, and the blob stored or found and
+        pinned, in one transaction, so neither a concurrent upload nor
+        eviction can get in between. The pin becomes the ref's reference
+        in set_refs, or is dropped with unpin. Unreferenced blobs are
+        evicted to make room under the global quota. Raises
+        BlobQuotaExceeded; returns True if the blob was new.
+        """
+        with self._write() as conn:
+            self._check_session_quota(conn, session_id, content_hash, size)
+            if self._pin(conn, session_id, ref, content_hash):
+                return False
+
+        # Compress outside the transaction; another process may store the same blob meanwhile
+        final_path = self._path(content_hash, self.codec)
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        tmp_path = f"{final_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            self._compress(path, tmp_path)
+            stored_size = os.path.getsize(tmp_path)
+            with self._write() as conn:
+                self._check_session_quota(conn, session_id, content_hash, size)
+                if self._pin(conn, session_id, ref, content_hash):
+                    return False
+                stored_total = conn.execute("SELECT COALESCE(SUM(stored_size), 0) FROM blobs").fetchone()[0]
+                overflow = stored_total + stored_size - self.global_quota_bytes
+                if overflow > 0:
+                    freed = self._evict(conn, until_bytes=overflow)
+                    if freed < overflow:
+                        raise BlobQuotaExceeded('Server upload storage is full, try again later', 'global')
+                conn.execute(
+                    "INSERT INTO blobs (hash, size, stored_size, codec, refcount, last_used) VALUES (?, ?, ?, ?, 0, ?)",
+                    (content_hash, size, stored_size, self.codec, time.time())
+                )
+                os.replace(tmp_path, final_path)
+                self._pin(conn, session_id, ref, content_hash)
+            return True
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def set_refs(self, session_id, refs):
+        """Point the session's ``refs`` ({ref: hash}) at stored blobs, in one transaction.
+
+        A pin taken by put for the same ref and blob becomes the reference.
+        """
+        with self._write() as conn:
+            for ref, content_hash in refs.items():
+                self._drop_ref(conn, session_id, ref)
+                conn.execute("INSERT INTO refs (session_id, ref, hash) VALUES (?, ?, ?)",
+                             (session_id, ref, content_hash))
+                if not self._take_pin(conn, session_id, ref, content_hash):
+                    conn.execute("UPDATE blobs SET refcount = refcount + 1, last_used = ? WHERE hash = ?",
+                                 (time.time(), content_hash))
+
+    def unpin(self, session_id, refs):
+        """Drop the pins put took for ``refs`` ({ref: hash}) whose uploads were not stored"""
+        with self._write() as conn:
+            for ref, content_hash in refs.items():
+                if self._take_pin(conn, session_id, ref, content_hash):
+                    conn.execute("UPDATE blobs SET refcount = refcount - 1, last_used = ? WHERE hash = ?",
+                                 (time.time(), content_hash))
+
+    def _drop_ref(self, conn, session_id, ref):
+        row = conn.execute("SELECT hash FROM refs WHERE session_id = ? AND ref = ?", (session_id, ref)).fetchone()
+        if row:
+            conn.execute("DELETE FROM refs WHERE session_id = ? AND ref = ?", (session_id, ref))
+            conn.execute("UPDATE blobs SET refcount = refcount - 1, last_used = ? WHERE hash = ?",
+                         (time.time(), row[0]))
+
+    def release(self, session_id, refs=None):
+        """Drop the given refs of a session, or all of them and its pins"""
+        with self._write() as conn:
+            if refs is None:
+                refs = [row[0] for row in conn.execute("SELECT ref FROM refs WHERE session_id = ?", (session_id,))]
+                self._drop_pins(conn, "session_id = ?", (session_id,))
+            for ref in refs:
+                self._drop_ref(conn, session_id, ref)
+
+    def _drop_pins(self, conn, where, args):
+        pins = conn.execute(f"SELECT hash, count FROM pins WHERE {where}", args).fetchall()
+        conn.execute(f"DELETE FROM pins WHERE {where}", args)
+        for content_hash, count in pins:
+            conn.execute("UPDATE blobs SET refcount = refcount - ?, last_used = ? WHERE hash = ?",
+                         (count, time.time(), content_hash))
+
+    def _evict(self, conn, until_bytes=None, idle_before=None, limit=RECLAIM_BATCH):
+        """Remove unreferenced blobs, least recently used first.
+
+        With ``until_bytes``, removes just enough to free that many bytes, or
+        nothing at all if that is impossible; otherwise removes up to
+        ``limit`` blobs idle since before ``idle_before``. Returns bytes freed.
+        """
+        if until_bytes is not None:
+            query, args = "SELECT hash, codec, stored_size FROM blobs WHERE refcount = 0 ORDER BY last_used", ()
+        else:
+            query = ("SELECT hash, codec, stored_size FROM blobs WHERE refcount = 0 AND last_used < ? "
+                     "ORDER BY last_used LIMIT ?")
+            args = (idle_before, limit)
+        victims = []
+        freed = 0
+        for content_hash, codec, stored_size in conn.execute(query, args):
+            if until_bytes is not None and freed >= until_bytes:
+                break
+            victims.append((content_hash, codec))
+            freed += stored_size
+        if until_bytes is not None and freed < until_bytes:
+            return 0
+        for content_hash, codec in victims:
+            conn.execute("DELETE FROM blobs WHERE hash = ?", (content_hash,))
+            try:
+                os.remove(self._path(content_hash, codec))
+            except FileNotFoundError:
+                pass
+        return freed
+
+    def reclaim(self, limit=RECLAIM_BATCH):
+        """Remove one batch of unreferenced blobs idle past the TTL; returns bytes freed.
+
+        Pins older than the TTL belong to uploads whose server went away
+        before storing them, and are dropped first.
+        """
+        with self._write() as conn:
+            self._drop_pins(conn, "created < ?", (time.time() - self.unreferenced_ttl_seconds,))
+            return self._evict(conn, idle_before=time.time() - self.unreferenced_ttl_seconds, limit=limit)
+
+    def ref_hash(self, session_id, ref):
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT hash FROM refs WHERE session_id = ? AND ref = ?", (session_id, ref)).fetchone()
+        return row[0] if row else None
+
+    def open(self, content_hash):
+        """Readable, decompressed file object of a blob, or None if it is not stored"""
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT codec FROM blobs WHERE hash = ?", (content_hash,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE blobs SET last_used = ? WHERE hash = ?", (time.time(), content_hash))
+        path = self._path(content_hash, row[0])
+        if row[0] == 'zstd':
+            if zstandard is None:
+                raise RuntimeError('Blob is zstd compressed but the zstandard package is not installed')
+            return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+        return gzip.open(path, 'rb')
+
+    def usage(self, session_id):
+        """Raw bytes charged to a session"""
+        with closing(self._connect()) as conn:
+            return self._session_charge(conn, session_id)
+
+    def stats(self):
+        with closing(self._connect()) as conn:
+            blobs, referenced, raw_bytes, stored_bytes = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(refcount > 0), 0), COALESCE(SUM(size), 0), "
+                "COALESCE(SUM(stored_size), 0) FROM blobs"
+            ).fetchone()
+        return {
+            'blobs': blobs,
+            'referenced_blobs': referenced,
+            'raw_bytes': raw_bytes,
+            'stored_bytes': stored_bytes,
+            'global_quota_bytes': self.global_quota_bytes,
+            'codec': self.codec
+        }
@@ -0,0 +1,238 @@
+"""Caller/callee graph of a profile in CSR form.
+
+Edges come from the callers dict pstats keeps for every function. They
+are stored once, sorted by callee, so the callers of row ``r`` are the
+edge slice ``callers_offsets[r]:callers_offsets[r + 1]``; a second
+permutation sorted by caller gives the callees the same way.
+"""
+import heapq
+
+import numpy as np
+
+EDGE_ARRAYS = (
+    'caller', 'callee', 'calls', 'total_time', 'cumulative_time',
+    'callers_offsets', 'callees_order', 'callees_offsets'
+)
+ARRAY_PREFIX = 'graph_'
+
+
+def _csr_offsets(keys, count):
+    offsets = np.zeros(count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=count), out=offsets[1:])
+    return offsets
+
+
+class CallGraph:
+    """Edges between rows of a ProfileTable"""
+
+    def __init__(self, caller, callee, calls, total_time, cumulative_time,
+                 callers_offsets, callees_order, callees_offsets):
+        self.caller = caller
+        self.callee = callee
+        self.calls = calls
+        self.total_time = total_time
+        self.cumulative_time = cumulative_time
+        self.callers_offsets = callers_offsets
+        self.callees_order = callees_order
+        self.callees_offsets = callees_offsets
+
+    @classmethod
+    def from_stats(cls, entries, row_of):
+        """Build from ``pstats.Stats.stats``; ``row_of`` maps function keys to rows"""
+        caller, callee, calls, total_time, cumulative_time = [], [], [], [], []
+        for callee_key, func_stats in entries.items():
+            callee_row = row_of[callee_key]
+            for caller_key, edge_stats in func_stats[4].items():
+                caller_row = row_of.get(caller_key)
+                if caller_row is None:
+                    continue
+                if isinstance(edge_stats, tuple):
+                    edge_calls, edge_tt, edge_ct = edge_stats[1], edge_stats[2], edge_stats[3]
+                else:
+                    # The pure-Python profile module records only a call count
+                    edge_calls, edge_tt, edge_ct = edge_stats, 0.0, 0.0
+                caller.append(caller_row)
+                callee.append(callee_row)
+                calls.append(edge_calls)
+                total_time.append(edge_tt)
+                cumulative_time.append(edge_ct)
+        return cls.from_edges(len(row_of), caller, callee, calls, total_time, cumulative_time)
+
+    @classmethod
+    def from_edges(cls, count, caller, callee, calls, total_time, cumulative_time):
+        caller = np.asarray(caller, dtype=np.int32)
+        callee = np.asarray(callee, dtype=np.int32)
+        order = np.argsort(callee, kind='stable')
+        caller, callee = caller[order], callee[order]
+        calls = np.asarray(calls, dtype=np.int64)[order]
+        total_time = np.asarray(total_time, dtype=np.float64)[order]
+        cumulative_time = np.asarray(cumulative_time, dtype=np.float64)[order]
+        callees_order = np.argsort(caller, kind='stable').astype(np.int64)
+        return cls(caller, callee, calls, total_time, cumulative_time,
+                   _csr_offsets(callee, count), callees_order, _csr_offsets(caller, count))
+
+    def __len__(self):
+        return len(self.caller)
+
+    def arrays(self):
+        return {f"{ARRAY_PREFIX}{name}": getattr(self, name) for name in EDGE_ARRAYS}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Rebuild from saved arrays, or return None if the table has no graph"""
+        if f"{ARRAY_PREFIX}caller" not in arrays:
+            return None
+        return cls(**{name: arrays[f"{ARRAY_PREFIX}{name}"] for name in EDGE_ARRAYS})
+
+    def caller_edges(self, row):
+        return np.arange(self.callers_offsets[row], self.callers_offsets[row + 1])
+
+    def callee_edges(self, row):
+        return self.callees_order[self.callees_offsets[row]:self.callees_offsets[row + 1]]
+
+    def edge(self, index):
+        index = int(index)
+        return {
+            'caller': int(self.caller[index]),
+            'callee': int(self.callee[index]),
+            'calls': int(self.calls[index]),
+            'total_time': float(self.total_time[index]),
+            'cumulative_time': float(self.cumulative_time[index])
+        }
+
+
+def neighbourhood(graph, row, hops, direction='both', max_nodes=200):
+    """Rows within ``hops`` edges of ``row`` and the edges between them.
+
+    Heavier edges (by cumulative time) are followed first, so when
+    ``max_nodes`` cuts the walk short the hottest neighbours are kept.
+    Returns ``({row: hop}, edge_indices)``.
+    """
+    distance = {int(row): 0}
+    frontier = [int(row)]
+    for hop in range(1, hops + 1):
+        candidates = []
+        for node in frontier:
+            if direction in ('both', 'callers'):
+                for edge in graph.caller_edges(node):
+                    candidates.append((graph.cumulative_time[edge], int(graph.caller[edge])))
+            if direction in ('both', 'callees'):
+                for edge in graph.callee_edges(node):
+                    candidates.append((graph.cumulative_time[edge], int(graph.callee[edge])))
+        candidates.sort(key=lambda item: -item[0])
+        frontier = []
+        for _, neighbour in candidates:
+            if len(distance) >= max_nodes:
+                break
+            if neighbour not in distance:
+                distance[neighbour] = hop
+                frontier.append(neighbour)
+        if not frontier:
+            break
+
+    nodes = np.fromiter(distance.keys(), dtype=np.int32, count=len(distance))
+    mask = np.isin(graph.caller, nodes) & np.isin(graph.callee, nodes)
+    return distance, np.flatnonzero(mask)
+
+
+def heaviest_caller_chains(graph, row, max_depth=8, limit=10):
+    """Caller chains ending at ``row``, heaviest first.
+
+    A chain's weight is the smallest edge cumulative time along it, so a
+    heavy chain is one where every hop carries a lot of time. Chains stop
+    at a root (no callers), at ``max_depth`` or where they would loop.
+    The search keeps the best ``limit`` partial chains at each depth.
+    """
+    row = int(row)
+    beam = [(float('inf'), [row], [])]
+    finished = []
+    for _ in range(max_depth):
+        extended = []
+        for weight, path, edges in beam:
+            caller_edges = [edge for edge in graph.caller_edges(path[-1])
+                            if int(graph.caller[edge]) not in path]
+            if not caller_edges:
+                finished.append((weight, path, edges))
+                continue
+            for edge in caller_edges:
+                extended.append((min(weight, float(graph.cumulative_time[edge])),
+                                 path + [int(graph.caller[edge])], edges + [int(edge)]))
+        beam = heapq.nlargest(limit, extended, key=lambda item: item[0])
+        if not beam:
+            break
+    finished.extend(beam)
+    finished = [chain for chain in finished if chain[2]]
+    return heapq.nlargest(limit, finished, key=lambda item: item[0])
+
+
+def subgraph_view(table, row, hops=2, direction='both', max_nodes=200,
+                  chain_limit=10, chain_depth=8):
+    """JSON-ready neighbourhood and heaviest caller chains of one function"""
+    graph = table.graph
+    distance, edges = neighbourhood(graph, row, hops, direction, max_nodes)
+    nodes = []
+    for node_row, hop in distance.items():
+        node = table.row(node_row)
+        node['hop'] = hop
+        nodes.append(node)
+
+    chains = []
+    for weight, path, chain_edges in heaviest_caller_chains(graph, row, chain_depth, chain_limit):
+        chains.append({
+            'weight': weight,
+            'ids': path,
+            'functions': [table.full_name(r) for r in path],
+            'edges': [graph.edge(e) for e in chain_edges]
+        })
+
+    return {
+        'function': table.row(row),
+        'nodes': nodes,
+        'edges': [graph.edge(e) for e in edges],
+        'caller_chains': chains
+    }
+
+
+def _edge_key(table, edge):
+    return table.full_name(edge['caller']), table.full_name(edge['callee'])
+
+
+def _timings(item):
+    if item is None:
+        return None
+    return {key: item[key] for key in ('calls', 'total_time', 'cumulative_time')}
+
+
+def diff_subgraphs(base_table, base_view, target_table, target_view):
+    """Match two subgraph views by function name and report per-node and per-edge deltas"""
+    nodes = {}
+    for side, view in (('base', base_view), ('target', target_view)):
+        if view is None:
+            continue
+        for node in view['nodes']:
+            entry = nodes.setdefault(node['name'], {'name': node['name'], 'base': None, 'target': None})
+            entry[side] = _timings(node)
+
+    edges = {}
+    for side, table, view in (('base', base_table, base_view), ('target', target_table, target_view)):
+        if view is None:
+            continue
+        for edge in view['edges']:
+            caller, callee = _edge_key(table, edge)
+            entry = edges.setdefault((caller, callee), {
+                'caller': caller, 'callee': callee, 'base': None, 'target': None
+            })
+            entry[side] = _timings(edge)
+
+    for entry in list(nodes.values()) + list(edges.values()):
+        base_time = entry['base']['cumulative_time'] if entry['base'] else 0.0
+        target_time = entry['target']['cumulative_time'] if entry['target'] else 0.0
+        entry['cumulative_time_delta'] = target_time - base_time
+
+    def by_delta(entries):
+        return sorted(entries, key=lambda entry: -abs(entry['cumulative_time_delta']))
+
+    return {
+        'nodes': by_delta(nodes.values()),
+        'edges': by_delta(edges.values())
+    }
@@ -0,0 +1,380 @@
+"""Resumable uploads sent in chunks.
+
+An upload is created with its filename and optional total size, appended
+to chunk by chunk at explicit byte offsets, then completed. Chunks are
+streamed straight to disk, so a transfer that breaks off resumes from
+the offset the server reports instead of from zero. gzip dumps (and zstd
+dumps, with the optional ``zstandard`` package) are decompressed on the
+fly, and the SHA-256 of both the bytes sent and the decoded dump is
+updated as the data arrives.
+
+All state is on disk in the upload's directory, so any server process
+can take the next chunk. A process keeps the running hashes and decoder
+of an upload only while it has seen every chunk; once another process
+has taken one, later chunks are just stored, and completing the upload
+decodes and hashes everything received in one pass. Appends therefore
+never replay earlier chunks, and an upload spread over several workers
+costs one extra read of its bytes at completion.
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+
+from process_coordination import ProcessLock
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+STATE_FILE = 'upload.json'
+RECEIVED_FILE = 'received'
+DECODED_FILE = 'decoded'
+LOCK_FILE = 'append.lock'
+CHUNK_SIZE = 1024 * 1024
+# A zstd block takes at least 4 bytes and decodes to at most 128 KB, so
+# one slice this size decodes to at most 8 MB
+ZSTD_INPUT_SLICE = 256
+ENCODINGS = ('auto', 'identity', 'gzip', 'zstd')
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+COMPRESSED_SUFFIXES = {'gzip': ('.gz', '.gzip'), 'zstd': ('.zst', '.zstd')}
+UPLOAD_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+# Running hashes and decoders kept per process, most recently used last
+MAX_PIPELINES = 256
+
+
+class ChunkedUploadError(Exception):
+    """An upload request that cannot be applied; ``status`` is the HTTP status to answer with"""
+
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+def detect_encoding(head):
+    if head.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if head.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    return 'identity'
+
+
+def decoded_filename(filename, encoding=None):
+    """``profile.prof.gz`` -> ``profile.prof``; strips any compressed suffix when ``encoding`` is None"""
+    suffixes = COMPRESSED_SUFFIXES.get(encoding, ()) if encoding else sum(COMPRESSED_SUFFIXES.values(), ())
+    for suffix in suffixes:
+        if filename.lower().endswith(suffix) and len(filename) > len(suffix):
+            return filename[:-len(suffix)]
+    return filename
+
+
+class GzipDecoder:
+    """Incremental gzip decoding with bounded output per step; handles concatenated members"""
+
+    def __init__(self):
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._in_member = False
+
+    def feed(self, data, sink):
+        while data:
+            self._in_member = True
+            out = self._decompressor.decompress(data, CHUNK_SIZE)
+            if out:
+                sink(out)
+            if self._decompressor.eof:
+                data = self._decompressor.unused_data
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                self._in_member = False
+            else:
+                data = self._decompressor.unconsumed_tail
+        # Output still buffered once all input is taken
+        while self._in_member:
+            out = self._decompressor.decompress(b'', CHUNK_SIZE)
+            if not out:
+                break
+            sink(out)
+
+    def finish(self):
+        if self._in_member:
+            raise ChunkedUploadError('Compressed data ends in the middle of a gzip stream')
+
+
+class ZstdDecoder:
+    """Incremental zstd decoding fed in small slices so each step's output stays bounded; handles concatenated frames"""
+
+    def __init__(self):
+        if zstandard is None:
+            raise ChunkedUploadError('zstd uploads need the zstandard package on the server', 415)
+        self._decompressor = zstandard.ZstdDecompressor().decompressobj()
+        self._in_frame = False
+
+    def feed(self, data, sink):
+        for start in range(0, len(data), ZSTD_INPUT_SLICE):
+            piece = data[start:start + ZSTD_INPUT_SLICE]
+            while piece:
+                self._in_frame = True
+                out = self._decompressor.decompress(piece)
+                if out:
+                    sink(out)
+                if not self._decompressor.eof:
+                    break
+                piece = self._decompressor.unused_data
+                self._decompressor = zstandard.ZstdDecompressor().decompressobj()
+                self._in_frame = False
+
+    def finish(self):
+        if self._in_frame:
+            raise ChunkedUploadError('Compressed data ends in the middle of a zstd frame')
+
+
+class IdentityDecoder:
+    def feed(self, data, sink):
+        sink(data)
+
+    def finish(self):
+        pass
+
+
+DECODERS = {'identity': IdentityDecoder, 'gzip': GzipDecoder, 'zstd': ZstdDecoder}
+
+
+class UploadPipeline:
+    """Running state of one upload: bytes received, their hash, the decoder and the decoded hash"""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.received = 0
+        self.received_hash = hashlib.sha256()
+        self.decoder = DECODERS[encoding]()
+        self.decoded = 0
+        self.decoded_hash = hashlib.sha256()
+
+
+class ChunkedUploads:
+    """Resumable uploads kept under ``<root>/<session>/chunked_<upload id>``"""
+
+    def __init__(self, root, max_bytes):
+        """``max_bytes`` caps both the bytes sent and the decoded dump"""
+        self.root = root
+        self.max_bytes = max_bytes
+        self._pipelines = OrderedDict()  # upload dir -> UploadPipeline
+        self._lock = threading.Lock()
+
+    def _dir(self, session_id, upload_id):
+        if not UPLOAD_ID_RE.match(upload_id or ''):
+            raise ChunkedUploadError('Unknown upload', 404)
+        return os.path.join(self.root, session_id, f"chunked_{upload_id}")
+
+    def _read_state(self, upload_dir):
+        try:
+            with open(os.path.join(upload_dir, STATE_FILE)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise ChunkedUploadError('Unknown upload', 404)
+
+    def _write_state(self, upload_dir, state):
+        tmp_path = os.path.join(upload_dir, f"{STATE_FILE}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, os.path.join(upload_dir, STATE_FILE))
+
+    def _describe(self, upload_dir, state):
+        return dict(state, offset=os.path.getsize(os.path.join(upload_dir, RECEIVED_FILE)))
+
+    def _locked(self, upload_dir):
+        lock = ProcessLock(os.path.join(upload_dir, LOCK_FILE))
+        if not lock.acquire(blocking=False):
+            raise ChunkedUploadError('Another request is writing this upload, retry shortly', 423)
+        return lock
+
+    def create(self, session_id, filename, size=None, encoding='auto', fields=None):
+        """Start an upload; ``fields`` are kept with it and returned on completion"""
+        if encoding not in ENCODINGS:
+            raise ChunkedUploadError(f'encoding must be one of {", ".join(ENCODINGS)}')
+        if size is not None and not 0 <= size <= self.max_bytes:
+            raise ChunkedUploadError(f'Uploads are limited to {self.max_bytes} bytes', 413)
+        upload_id = uuid.uuid4().hex
+        upload_dir = self._dir(session_id, upload_id)
+        os.makedirs(upload_dir)
+        open(os.path.join(upload_dir, RECEIVED_FILE), 'wb').close()
+        now = time.time()
+        state = {
+            'upload_id': upload_id,
+            'filename': filename,
+            'size': size,
+            'encoding': encoding,
+            'fields': fields or {},
+            'created_at': now,
+            'updated_at': now
+        }
+        self._write_state(upload_dir, state)
+        return self._describe(upload_dir, state)
+
+    def status(self, session_id, upload_id):
+        upload_dir = self._dir(session_id, upload_id)
+        return self._describe(upload_dir, self._read_state(upload_dir))
+
+    def _pipeline(self, upload_dir, state, received):
+        """This process's pipeline for the upload, or None if it has not seen every byte received"""
+        with self._lock:
+            pipeline = self._pipelines.pop(upload_dir, None)
+        if pipeline is not None and pipeline.received != received:
+            # Another process took a chunk; the rest waits for complete
+            pipeline = None
+        if pipeline is None and received == 0:
+            pipeline = UploadPipeline(state['encoding'])
+        if pipeline is not None:
+            self._keep(upload_dir, pipeline)
+        return pipeline
+
+    def _keep(self, upload_dir, pipeline):
+        with self._lock:
+            self._pipelines[upload_dir] = pipeline
+            while len(self._pipelines) > MAX_PIPELINES:
+                self._pipelines.popitem(last=False)
+
+    def _replay(self, upload_dir, state, received):
+        """A pipeline rebuilt from the bytes received, rewriting the decoded file"""
+        pipeline = UploadPipeline(state['encoding'])
+        decoded_path = os.path.join(upload_dir, DECODED_FILE)
+        with open(os.path.join(upload_dir, RECEIVED_FILE), 'rb') as source, \
+                open(decoded_path, 'wb') if state['encoding'] != 'identity' else _NoFile() as decoded:
+            while pipeline.received < received:
+                data = source.read(min(CHUNK_SIZE, received - pipeline.received))
+                if not data:
+                    break
+                self._feed(pipeline, data, decoded)
+        return pipeline
+
+    def _feed(self, pipeline, data, decoded):
+        if pipeline.received + len(data) > self.max_bytes:
+            raise ChunkedUploadError(f'Uploads are limited to {self.max_bytes} bytes', 413)
+
+        def sink(out):
+            if pipeline.decoded + len(out) > self.max_bytes:
+                raise ChunkedUploadError(f'Decompressed dumps are limited to {self.max_bytes} bytes', 413)
+            pipeline.decoded_hash.update(out)
+            pipeline.decoded += len(out)
+            decoded.write(out)
+
+        try:
+            pipeline.decoder.feed(data, sink)
+        except zlib.error as e:
+            raise ChunkedUploadError(f'Data is not valid {pipeline.encoding}: {e}')
+        except Exception as e:
+            if zstandard is not None and isinstance(e, zstandard.ZstdError):
+                raise ChunkedUploadError(f'Data is not valid zstd: {e}')
+            raise
+        pipeline.received_hash.update(data)
+        pipeline.received += len(data)
+
+    def append(self, session_id, upload_id, offset, stream):
+        """Append ``stream`` at byte ``offset``; returns the new offset.
+
+        The offset must equal the bytes received so far, otherwise the
+        error carries the server's offset for the client to resume from.
+        """
+        upload_dir = self._dir(session_id, upload_id)
+        state = self._read_state(upload_dir)
+        lock = self._locked(upload_dir)
+        try:
+            received_path = os.path.join(upload_dir, RECEIVED_FILE)
+            received = os.path.getsize(received_path)
+            if offset != received:
+                raise ChunkedUploadError(f'Upload is at offset {received}, not {offset}', 409, received)
+
+            first = stream.read(CHUNK_SIZE)
+            if state['encoding'] == 'auto':
+                if received:
+                    state['encoding'] = detect_encoding(open(received_path, 'rb').read(4))
+                else:
+                    state['encoding'] = detect_encoding(first)
+            pipeline = self._pipeline(upload_dir, state, received)
+            try:
+                with open(received_path, 'ab') as out, \
+                        open(os.path.join(upload_dir, DECODED_FILE), 'ab') \
+                        if pipeline is not None and state['encoding'] != 'identity' else _NoFile() as decoded:
+                    data = first
+                    while data:
+                        if state['size'] is not None and received + len(data) > state['size']:
+                            raise ChunkedUploadError(f"Upload declared {state['size']} bytes", 413)
+                        if pipeline is not None:
+                            self._feed(pipeline, data, decoded)
+                        elif received + len(data) > self.max_bytes:
+                            raise ChunkedUploadError(f'Uploads are limited to {self.max_bytes} bytes', 413)
+                        out.write(data)
+                        received += len(data)
+                        data = stream.read(CHUNK_SIZE)
+            except BaseException:
+                # Leave the rest to complete rather than trust a half-applied step
+                with self._lock:
+                    self._pipelines.pop(upload_dir, None)
+                raise
+            state['updated_at'] = time.time()
+            self._write_state(upload_dir, state)
+            return received
+        finally:
+            lock.release()
+
+    def complete(self, session_id, upload_id, destination, sha256=None):
+        """Finish an upload, moving the decoded dump to ``destination``.
+
+        ``sha256`` optionally checks the bytes sent. Returns the upload's
+        state with ``content_hash`` and ``content_size`` of the decoded dump.
+        """
+        upload_dir = self._dir(session_id, upload_id)
+        state = self._read_state(upload_dir)
+        lock = self._locked(upload_dir)
+        try:
+            received_path = os.path.join(upload_dir, RECEIVED_FILE)
+            received = os.path.getsize(received_path)
+            if state['size'] is not None and received != state['size']:
+                raise ChunkedUploadError(f"Upload is at offset {received} of {state['size']} bytes", 409, received)
+            if state['encoding'] == 'auto':
+                state['encoding'] = 'identity'
+            pipeline = self._pipeline(upload_dir, state, received) or self._replay(upload_dir, state, received)
+            pipeline.decoder.finish()
+            if sha256 and sha256.lower() != pipeline.received_hash.hexdigest():
+                raise ChunkedUploadError('sha256 does not match the bytes received', 422)
+
+            source = received_path if state['encoding'] == 'identity' else os.path.join(upload_dir, DECODED_FILE)
+            os.makedirs(os.path.dirname(destination) or '.', exist_ok=True)
+            os.replace(source, destination)
+            with self._lock:
+                self._pipelines.pop(upload_dir, None)
+            result = dict(state, offset=received, content_hash=pipeline.decoded_hash.hexdigest(),
+                          content_size=pipeline.decoded,
+                          filename=decoded_filename(state['filename'], state['encoding']))
+        finally:
+            lock.release()
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        return result
+
+    def abort(self, session_id, upload_id):
+        upload_dir = self._dir(session_id, upload_id)
+        self._read_state(upload_dir)
+        with self._lock:
+            self._pipelines.pop(upload_dir, None)
+        shutil.rmtree(upload_dir, ignore_errors=True)
+
+
+class _NoFile:
+    """Stands in for the decoded file of uncompressed uploads, which are their own output"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def write(self, data):
+        pass
@@ -0,0 +1,279 @@
+"""Vectorised N-way comparison of profile tables.
+
+All tables are aligned into one functions x profiles matrix per metric,
+keyed by (filename, line, function name), so per-function deltas for
+every profile against a baseline come out of a few NumPy operations
+instead of nested dict loops. A session keeps its slots numbered on one
+function axis, so replacing a slot only renumbers that slot's table.
+"""
+import itertools
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+METRICS = ('total_time', 'cumulative_time', 'calls')
+# (filename id << 32 | name id, line) packed into one 16-byte value per function
+KEY_DTYPE = np.dtype('V16')
+# Rebuild a session's function axis once dropped columns leave it this much larger than needed
+AXIS_COMPACT_FACTOR = 2
+AXIS_COMPACT_MIN = 10000
+
+
+class FunctionAxis:
+    """Append-only numbering of functions, keyed by (filename, line, function name).
+
+    Strings are interned once and the packed keys are kept sorted, so
+    numbering a table costs one pass over that table's strings plus a
+    sorted merge, whatever else is on the axis.
+    """
+
+    def __init__(self):
+        self.string_ids = {}
+        self.sorted_keys = np.empty(0, dtype=KEY_DTYPE)
+        self.sorted_ids = np.empty(0, dtype=np.int64)
+        self.function_count = 0
+
+    def __len__(self):
+        return self.function_count
+
+    def function_ids(self, table):
+        """Function id of every row of ``table``, adding functions not seen before"""
+        # Interned as raw utf-8 bytes straight from the packed string table
+        blob = table.strings.data.tobytes()
+        offsets = table.strings.offsets.tolist()
+        strings = [blob[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+        string_ids = self.string_ids
+        unseen = dict.fromkeys(itertools.filterfalse(string_ids.__contains__, strings))
+        string_ids.update(zip(unseen, itertools.count(len(string_ids))))
+        mapping = np.fromiter(map(string_ids.__getitem__, strings), dtype=np.int64, count=len(strings))
+        packed = np.empty((len(table), 2), dtype=np.int64)
+        packed[:, 0] = (mapping[table.filename_id] << 32) | mapping[table.name_id]
+        packed[:, 1] = table.line_number
+        keys, inverse = np.unique(packed.view(KEY_DTYPE).reshape(-1), return_inverse=True)
+
+        position = np.searchsorted(self.sorted_keys, keys)
+        known = position < len(self.sorted_keys)
+        known[known] = self.sorted_keys[position[known]] == keys[known]
+        ids = np.empty(len(keys), dtype=np.int64)
+        ids[known] = self.sorted_ids[position[known]]
+        added = np.flatnonzero(~known)
+        if len(added):
+            ids[added] = self.function_count + np.arange(len(added))
+            self.function_count += len(added)
+            self.sorted_keys = np.insert(self.sorted_keys, position[added], keys[added])
+            self.sorted_ids = np.insert(self.sorted_ids, position[added], ids[added])
+        return ids[inverse.reshape(-1)]
+
+
+class AlignedProfiles:
+    """Function metrics of several tables on a shared row axis"""
+
+    def __init__(self, tables, function_ids=None):
+        """``function_ids`` numbers each table's rows on a shared FunctionAxis;
+        a fresh axis is built from the tables when it is omitted"""
+        self.tables = tables
+        if function_ids is None:
+            axis = FunctionAxis()
+            function_ids = [axis.function_ids(table) for table in tables]
+
+        sizes = np.array([len(table) for table in tables], dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)])
+        all_ids = np.concatenate(function_ids) if function_ids else np.empty(0, dtype=np.int64)
+        # Renumber densely over just the functions these tables contain
+        _, first, inverse = np.unique(all_ids, return_index=True, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        count = len(first)
+
+        # Which profile/row first mentions each aligned function, for names
+        self.source_profile = np.searchsorted(self.offsets, first, side='right') - 1
+        self.source_row = first - self.offsets[self.source_profile]
+
+        self.present = np.zeros((count, len(tables)), dtype=bool)
+        self.rows = np.full((count, len(tables)), -1, dtype=np.int64)
+        self.values = {metric: np.zeros((count, len(tables)), dtype=np.float64) for metric in METRICS}
+        for p, table in enumerate(tables):
+            index = inverse[self.offsets[p]:self.offsets[p + 1]]
+            self.present[index, p] = True
+            self.rows[index, p] = np.arange(len(table))
+            for metric in METRICS:
+                self.values[metric][index, p] = getattr(table, metric)
+
+    def __len__(self):
+        return len(self.present)
+
+    def name(self, function):
+        return self.tables[self.source_profile[function]].full_name(self.source_row[function])
+
+    def function_in(self, function, profile):
+        """The function's row dict in one profile, or None if it is absent there"""
+        row = self.rows[function, profile]
+        return self.tables[profile].row(row) if row >= 0 else None
+
+
+class SessionComparison:
+    """One session's profiles numbered on a shared function axis, one column per slot.
+
+    Replacing or removing a slot only renumbers that slot's table, so a
+    comparison after an upload costs one profile's worth of work plus the
+    vectorised ranking. Hold ``lock`` around updates and comparisons.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.axis = FunctionAxis()
+        self.columns = {}  # slot -> (content key, table, function ids)
+
+    def content_key(self, slot):
+        column = self.columns.get(slot)
+        return column[0] if column else None
+
+    def set_column(self, slot, content_key, table):
+        self.columns[slot] = (content_key, table, self.axis.function_ids(table))
+
+    def drop_column(self, slot):
+        if self.columns.pop(slot, None) is not None:
+            self._compact()
+
+    def retain(self, slots):
+        """Drop the columns of every slot not in ``slots``"""
+        for slot in [slot for slot in self.columns if slot not in slots]:
+            self.columns.pop(slot)
+        self._compact()
+
+    def _compact(self):
+        """Renumber from scratch once removed columns have bloated the axis"""
+        live = sum(len(ids) for _, _, ids in self.columns.values())
+        if len(self.axis) <= max(AXIS_COMPACT_MIN, AXIS_COMPACT_FACTOR * live):
+            return
+        self.axis = FunctionAxis()
+        for slot, (content_key, table, _) in list(self.columns.items()):
+            self.set_column(slot, content_key, table)
+
+    def compare(self, slots, base=0, limit=20, unique_limit=50):
+        """compare_tables over the given slots' columns"""
+        columns = [self.columns[slot] for slot in slots]
+        aligned = AlignedProfiles([table for _, table, _ in columns], [ids for _, _, ids in columns])
+        return compare_aligned(aligned, base, limit, unique_limit)
+
+
+class SessionComparisons:
+    """LRU of SessionComparison per session id"""
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id, create=True):
+        with self._lock:
+            state = self._states.get(session_id)
+            if state is not None:
+                self._states.move_to_end(session_id)
+            elif create:
+                state = self._states[session_id] = SessionComparison()
+                while len(self._states) > self.maxsize:
+                    self._states.popitem(last=False)
+            return state
+
+    def discard(self, session_id):
+        with self._lock:
+            self._states.pop(session_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._states.clear()
+
+
+def _relative(delta, base):
+    return np.divide(delta, base, out=np.full_like(delta, np.nan), where=base > 0)
+
+
+def compare_tables(tables, base=0, limit=20, unique_limit=50):
+    """Rank per-function regressions and improvements of every profile against ``base``.
+
+    Returns the comparison fields of the /api/compare response: common and
+    unique functions (same shapes as before) plus ``function_deltas``.
+    """
+    return compare_aligned(AlignedProfiles(tables), base, limit, unique_limit)
+
+
+def compare_aligned(aligned, base=0, limit=20, unique_limit=50):
+    """compare_tables over already aligned profiles"""
+    profile_count = len(aligned.tables)
+    profile_keys = [f'profile_{i + 1}' for i in range(profile_count)]
+
+    deltas = {metric: aligned.values[metric] - aligned.values[metric][:, [base]] for metric in METRICS}
+    others = np.array([p for p in range(profile_count) if p != base], dtype=np.int64)
+    cumulative_delta = deltas['cumulative_time'][:, others] if len(others) else np.zeros((len(aligned), 0))
+    if cumulative_delta.shape[1]:
+        worst = cumulative_delta.max(axis=1)
+        best = cumulative_delta.min(axis=1)
+    else:
+        worst = best = np.zeros(len(aligned))
+
+    def describe(function):
+        item = {
+            'name': aligned.name(function),
+            'profiles': {},
+            'deltas': {}
+        }
+        for p, key in enumerate(profile_keys):
+            data = aligned.function_in(function, p)
+            if data is not None:
+                item['profiles'][key] = data
+            if p == base:
+                continue
+            delta = {}
+            for metric in METRICS:
+                value = float(deltas[metric][function, p])
+                base_value = float(aligned.values[metric][function, base])
+                delta[metric] = value
+                delta[f'{metric}_pct'] = (value / base_value * 100) if base_value > 0 else None
+            item['deltas'][key] = delta
+        return item
+
+    def ranked(scores, mask, count, descending=True):
+        candidates = np.flatnonzero(mask)
+        keys = -scores[candidates] if descending else scores[candidates]
+        if len(candidates) > count:
+            # Only the top ``count`` (plus ties at the cut) need the stable sort
+            keep = keys <= np.partition(keys, count - 1)[count - 1]
+            candidates, keys = candidates[keep], keys[keep]
+        order = np.argsort(keys, kind='stable')
+        return candidates[order[:count]]
+
+    all_present = aligned.present.all(axis=1)
+    regressions = ranked(worst, worst > 0, limit)
+    improvements = ranked(best, best < 0, limit, descending=False)
+    magnitude = np.maximum(np.abs(worst), np.abs(best))
+    common = ranked(magnitude, all_present, limit)
+
+    unique_functions = {}
+    for p, key in enumerate(profile_keys):
+        mask = aligned.present[:, p] & ~all_present
+        top = ranked(aligned.values['cumulative_time'][:, p], mask, unique_limit)
+        unique_functions[key] = [
+            {'name': aligned.name(f), 'data': aligned.function_in(f, p)} for f in top
+        ]
+
+    cumulative_rel = _relative(deltas['cumulative_time'], aligned.values['cumulative_time'][:, [base]])
+    return {
+        'common_functions': [describe(f) for f in common],
+        'unique_functions': unique_functions,
+        'function_deltas': {
+            'base_profile': base + 1,
+            'function_count': len(aligned),
+            'common_function_count': int(all_present.sum()),
+            'regressed_function_count': int((worst > 0).sum()),
+            'improved_function_count': int((best < 0).sum()),
+            'median_cumulative_time_change_pct': _nan_median(cumulative_rel[:, others] * 100) if len(others) else None,
+            'regressions': [describe(f) for f in regressions],
+            'improvements': [describe(f) for f in improvements]
+        }
+    }
+
+
+def _nan_median(values):
+    finite = values[np.isfinite(values)]
+    return float(np.median(finite)) if len(finite) else None
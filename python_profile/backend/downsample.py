@@ -0,0 +1,65 @@
+"""Server-side downsampling of time series for charting.
+
+``lttb`` keeps the points that best preserve the visual shape of a line
+(Largest-Triangle-Three-Buckets), so spikes survive. ``min_max_buckets``
+splits the time range into equal-width buckets and reports the min, max
+and mean of each, which suits range bands.
+"""
+import numpy as np
+
+
+def lttb(x, y, threshold):
+    """Indices of the ``threshold`` points kept by Largest-Triangle-Three-Buckets.
+
+    ``x`` must be sorted. The first and last points are always kept; the
+    rest are split into equal buckets and from each the point forming the
+    largest triangle with the previously kept point and the mean of the
+    next bucket is chosen.
+    """
+    count = len(x)
+    if threshold >= count or threshold < 3:
+        return np.arange(count)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    edges = np.linspace(1, count - 1, threshold - 1).astype(np.int64)
+    keep = np.empty(threshold, dtype=np.int64)
+    keep[0], keep[-1] = 0, count - 1
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        if bucket + 2 < len(edges):
+            next_start, next_end = edges[bucket + 1], edges[bucket + 2]
+            next_x, next_y = x[next_start:next_end].mean(), y[next_start:next_end].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+        areas = np.abs(
+            (x[previous] - next_x) * (y[start:end] - y[previous]) -
+            (x[previous] - x[start:end]) * (next_y - y[previous])
+        )
+        previous = start + int(np.argmax(areas))
+        keep[bucket + 1] = previous
+    return keep
+
+
+def min_max_buckets(x, y, buckets):
+    """Equal-width time buckets over sorted ``x`` with (start, min, max, mean, count) each.
+
+    Empty buckets are left out. Returns a dict of parallel arrays.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if not len(x):
+        return {name: np.empty(0) for name in ('start', 'min', 'max', 'mean', 'count')}
+    buckets = max(1, buckets)
+    width = (x[-1] - x[0]) / buckets or 1.0
+    bucket_of = np.minimum(((x - x[0]) // width).astype(np.int64), buckets - 1)
+    # x is sorted, so each bucket is one contiguous run
+    starts = np.flatnonzero(np.concatenate(([True], bucket_of[1:] != bucket_of[:-1])))
+    counts = np.diff(np.append(starts, len(x)))
+    return {
+        'start': x[0] + bucket_of[starts] * width,
+        'min': np.minimum.reduceat(y, starts),
+        'max': np.maximum.reduceat(y, starts),
+        'mean': np.add.reduceat(y, starts) / counts,
+        'count': counts
+    }
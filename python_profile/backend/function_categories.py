@@ -0,0 +1,172 @@
+"""Function categorisation: user, builtin, stdlib or third_party.
+
+The pattern lists are compiled once into combined regular expressions and
+the filename-dependent part of the result is memoised, so classifying a
+profile costs one regex pass per distinct filename rather than one scan
+of every pattern list per function.
+"""
+import re
+import sys
+from functools import lru_cache
+
+BUILTIN_PATTERNS = [
+    '<built-in>',
+    '<method',
+    '~',
+    '<frozen',
+    '<string>',
+    '{built-in method',
+    '{method'
+]
+
+BUILTIN_NAMES = frozenset([
+    'len', 'str', 'int', 'float', 'bool', 'list', 'dict', 'tuple', 'set',
+    'range', 'enumerate', 'zip', 'map', 'filter', 'sorted', 'sum', 'min', 'max',
+    'abs', 'round', 'pow', 'divmod', 'isinstance', 'hasattr', 'getattr', 'setattr',
+    'delattr', 'callable', 'iter', 'next', 'repr', 'ord', 'chr', 'hex', 'oct',
+    'bin', 'hash', 'id', 'type', 'vars', 'dir', 'help', 'print', 'input',
+    'open', 'compile', 'eval', 'exec', 'globals', 'locals'
+])
+
+STDLIB_PATTERNS = [
+    '/python',
+    '\\python',
+    '/usr/lib/python',
+    '/Library/Frameworks/Python',
+    'anaconda',
+    'miniconda',
+    'conda',
+    'importlib',
+    'pkgutil',
+    'encodings',
+    'codecs',
+    'collections',
+    're.py',
+    'json/',
+    'urllib/',
+    'http/',
+    'email/',
+    'xml/',
+    'logging/',
+    'threading.py',
+    'queue.py',
+    'os.py',
+    'sys.py',
+    'time.py',
+    'datetime.py',
+    'random.py',
+    'math.py',
+    'statistics.py',
+    'pathlib.py',
+    'shutil.py',
+    'tempfile.py',
+    'functools.py',
+    'itertools.py',
+    'operator.py'
+]
+
+THIRD_PARTY_PATTERNS = [
+    'site-packages/',
+    'dist-packages/',
+    'lib/python',
+    'flask',
+    'django',
+    'requests',
+    'numpy',
+    'pandas',
+    'scipy',
+    'matplotlib',
+    'seaborn',
+    'sklearn',
+    'tensorflow',
+    'torch',
+    'keras',
+    'pillow',
+    'opencv',
+    'sqlalchemy',
+    'psycopg2',
+    'pymongo',
+    'redis',
+    'celery',
+    'gunicorn',
+    'uwsgi'
+]
+
+STDLIB_MODULE_NAMES = frozenset(getattr(sys, 'stdlib_module_names', ()))
+
+
+def _compile_patterns(patterns, lower=True):
+    return re.compile('|'.join(re.escape(p.lower() if lower else p) for p in patterns))
+
+
+_BUILTIN_RE = _compile_patterns(BUILTIN_PATTERNS, lower=False)
+_STDLIB_RE = _compile_patterns(STDLIB_PATTERNS)
+_THIRD_PARTY_RE = _compile_patterns(THIRD_PARTY_PATTERNS)
+# Installed packages live here; they are third-party even though the path contains "/python"
+_SITE_PACKAGES_RE = re.compile(r'[\\/](?:site|dist)-packages[\\/]')
+# <prefix>/lib/python3.11/<module>... (or <prefix>\Python311\Lib\<module>... on Windows),
+# resolved against sys.stdlib_module_names
+_STDLIB_MODULE_RE = re.compile(
+    r'[\\/](?:lib[\\/]python\d+(?:\.\d+)?|python\d*[\\/]lib)[\\/](?:lib-dynload[\\/])?([a-z_][a-z0-9_]*)'
+)
+
+
+@lru_cache(maxsize=65536)
+def classify_filename(filename):
+    """Return (builtin_by_filename, is_stdlib, is_third_party) for a filename"""
+    filename_lower = filename.lower()
+    in_site_packages = _SITE_PACKAGES_RE.search(filename_lower) is not None
+
+    is_stdlib = False
+    if not in_site_packages:
+        match = _STDLIB_MODULE_RE.search(filename_lower) if STDLIB_MODULE_NAMES else None
+        if match is not None:
+            # Inside an interpreter's lib directory the module name decides,
+            # before the broad '/python' patterns would claim every file there
+            is_stdlib = match.group(1) in STDLIB_MODULE_NAMES
+        else:
+            is_stdlib = _STDLIB_RE.search(filename_lower) is not None
+
+    is_third_party = in_site_packages or _THIRD_PARTY_RE.search(filename_lower) is not None
+    return _BUILTIN_RE.search(filename) is not None, is_stdlib, is_third_party
+
+
+def _is_builtin_name(function_name):
+    return function_name in BUILTIN_NAMES or (
+        function_name.startswith('__') and function_name.endswith('__')
+    )
+
+
+def is_builtin_function(filename, function_name):
+    """Enhanced detection of built-in functions"""
+    return classify_filename(filename)[0] or _is_builtin_name(function_name)
+
+
+def is_standard_library_function(filename):
+    """Check if function is from Python standard library"""
+    return classify_filename(filename)[1]
+
+
+def is_third_party_library_function(filename):
+    """Check if function is from a third-party library"""
+    return classify_filename(filename)[2]
+
+
+def categorize_function(filename, function_name):
+    """Return (category, is_builtin, is_stdlib, is_third_party) for a function"""
+    builtin_by_filename, is_stdlib, is_third_party = classify_filename(filename)
+    is_builtin = builtin_by_filename or _is_builtin_name(function_name)
+    if is_builtin:
+        category = 'builtin'
+    elif is_stdlib:
+        category = 'stdlib'
+    elif is_third_party:
+        category = 'third_party'
+    else:
+        category = 'user'
+    return category, is_builtin, is_stdlib, is_third_party
+
+
+def get_function_category(filename, function_name):
+    """Categorize function into user, builtin, stdlib, or third_party"""
+    return categorize_function(filename, function_name)[0]
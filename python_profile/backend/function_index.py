@@ -0,0 +1,328 @@
+"""Inverted index from function name tokens to table rows, and search across slots.
+
+Filenames, line numbers and function names are split into lower-cased
+alphanumeric tokens ("/app/db.py:12(execute)" -> app, db, py, 12,
+execute). The distinct tokens of a table are sorted and newline-joined
+into one blob, and each token owns a sorted slice of rows (CSR, the same
+shape as the call graph). A substring query scans only the token blob,
+intersects the row lists of its tokens and verifies the few survivors,
+so it costs what it matches rather than the size of the table. Whole
+tokens are found by binary search over the sorted vocabulary, and single
+functions by their (filename, line, name) key, without rescanning the
+blob. The index is built at ingest and saved inside the table file.
+"""
+import bisect
+import re
+
+import numpy as np
+
+TOKEN_RE = re.compile(r'[^\W_]+')
+INDEX_ARRAYS = ('token_data', 'token_offsets', 'posting_offsets', 'posting_rows')
+ARRAY_PREFIX = 'index_'
+# Candidate sets this small are checked against full names rather than narrowed further
+VERIFY_DIRECTLY_ROWS = 256
+
+
+def tokenize(text):
+    """Lower-cased alphanumeric runs of ``text``"""
+    return TOKEN_RE.findall(text.lower())
+
+
+def _query_tokens(text):
+    """Tokens of a substring query, each with how it must match an indexed token.
+
+    A token cut off by the start of the query may be the tail of a longer
+    token, one cut off by the end may be its head, one touching both may
+    sit anywhere inside, and one touching neither must be a whole token.
+    """
+    tokens = []
+    for match in TOKEN_RE.finditer(text):
+        at_start, at_end = match.start() == 0, match.end() == len(text)
+        if at_start and at_end:
+            mode = 'contains'
+        elif at_start:
+            mode = 'suffix'
+        elif at_end:
+            mode = 'prefix'
+        else:
+            mode = 'exact'
+        tokens.append((match.group(), mode))
+    return tokens
+
+
+class FunctionIndex:
+    """Token -> rows postings of one ProfileTable"""
+
+    def __init__(self, token_data, token_offsets, posting_offsets, posting_rows):
+        self.token_data = token_data
+        self.token_offsets = token_offsets
+        self.posting_offsets = posting_offsets
+        self.posting_rows = posting_rows
+        self._blob = None
+        self._vocabulary = None
+        self._rows_by_key = None
+
+    @classmethod
+    def build(cls, table):
+        count = len(table)
+        string_tokens = [tokenize(table.strings.get(i)) for i in range(len(table.strings))]
+        lines = np.unique(table.line_number)
+        line_tokens = [tokenize(str(int(line))) for line in lines]
+        vocabulary = sorted({token for tokens in string_tokens + line_tokens for token in tokens})
+        token_id = {token: i for i, token in enumerate(vocabulary)}
+
+        def expand(per_key_tokens, keys):
+            """(row, token id) pairs for rows whose key has the given token lists"""
+            lengths = np.array([len(tokens) for tokens in per_key_tokens], dtype=np.int64)
+            offsets = np.zeros(len(per_key_tokens) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            flat = np.fromiter((token_id[token] for tokens in per_key_tokens for token in tokens),
+                               dtype=np.int64, count=int(offsets[-1]))
+            counts = lengths[keys]
+            rows = np.repeat(np.arange(count, dtype=np.int64), counts)
+            within = np.arange(int(counts.sum()), dtype=np.int64) - np.repeat(np.cumsum(counts) - counts, counts)
+            return rows, flat[np.repeat(offsets[keys], counts) + within]
+
+        pairs = [
+            expand(string_tokens, table.filename_id),
+            expand(string_tokens, table.name_id),
+            expand(line_tokens, np.searchsorted(lines, table.line_number))
+        ]
+        rows = np.concatenate([pair[0] for pair in pairs])
+        tokens = np.concatenate([pair[1] for pair in pairs])
+        keys = np.sort(tokens * max(count, 1) + rows)
+        keys = keys[np.concatenate(([True], keys[1:] != keys[:-1]))] if len(keys) else keys
+        posting_tokens = keys // max(count, 1)
+
+        posting_offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(posting_tokens, minlength=len(vocabulary)), out=posting_offsets[1:])
+        encoded = [token.encode('utf-8') for token in vocabulary]
+        token_offsets = np.ones(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(token) + 1 for token in encoded], out=token_offsets[1:])
+        token_offsets[1:] += 1
+        blob = b'\n' + b''.join(token + b'\n' for token in encoded)
+        return cls(np.frombuffer(blob, dtype=np.uint8), token_offsets,
+                   posting_offsets, (keys % max(count, 1)).astype(np.int32))
+
+    def arrays(self):
+        return {f"{ARRAY_PREFIX}{name}": getattr(self, name) for name in INDEX_ARRAYS}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Rebuild from saved arrays, or return None if the table was saved without an index"""
+        if f"{ARRAY_PREFIX}token_data" not in arrays:
+            return None
+        return cls(**{name: arrays[f"{ARRAY_PREFIX}{name}"] for name in INDEX_ARRAYS})
+
+    def _token_ids(self, token, mode):
+        """Ids of indexed tokens matching ``token`` under ``mode`` (see _query_tokens)"""
+        if self._blob is None:
+            self._blob = bytes(self.token_data)
+        needle = token.encode('utf-8')
+        if mode == 'exact':
+            # The vocabulary is sorted, and utf-8 keeps code point order
+            if self._vocabulary is None:
+                self._vocabulary = self._blob[1:-1].split(b'\n') if len(self._blob) > 1 else []
+            position = bisect.bisect_left(self._vocabulary, needle)
+            found = position < len(self._vocabulary) and self._vocabulary[position] == needle
+            return np.array([position] if found else [], dtype=np.int64)
+        shift = 0
+        if mode in ('exact', 'prefix'):
+            needle = b'\n' + needle
+            shift = 1
+        if mode in ('exact', 'suffix'):
+            needle = needle + b'\n'
+        positions = [match.start() + shift for match in re.finditer(re.escape(needle), self._blob)]
+        # Positions are increasing, so repeats of a token are adjacent
+        ids = np.searchsorted(self.token_offsets, positions, side='right') - 1
+        return ids[np.concatenate(([True], ids[1:] != ids[:-1]))] if len(ids) else ids
+
+    def _postings(self, token_ids):
+        """Concatenated posting rows of ``token_ids``"""
+        starts = self.posting_offsets[token_ids]
+        lengths = self.posting_offsets[token_ids + 1] - starts
+        total = int(lengths.sum())
+        within = np.arange(total, dtype=np.int64) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return self.posting_rows[np.repeat(starts, lengths) + within]
+
+    def _row_mask(self, token_ids, count):
+        mask = np.zeros(count, dtype=bool)
+        mask[self._postings(token_ids)] = True
+        return mask
+
+    def _rows_with_tokens(self, token_ids, count):
+        """Sorted rows holding any of ``token_ids``"""
+        if len(token_ids) == 1:
+            offsets = self.posting_offsets
+            return self.posting_rows[offsets[token_ids[0]]:offsets[token_ids[0] + 1]].astype(np.int64)
+        return np.flatnonzero(self._row_mask(token_ids, count))
+
+    def search(self, table, text):
+        """Rows whose full name ``filename:line(function)`` contains ``text``, ignoring case"""
+        text = text.lower()
+        tokens = _query_tokens(text)
+        if not tokens:
+            # Only punctuation; nothing to narrow by
+            return np.flatnonzero(_full_names_contain(table, np.arange(len(table)), text))
+
+        matches = []
+        for token, mode in tokens:
+            token_ids = self._token_ids(token, mode)
+            size = int((self.posting_offsets[token_ids + 1] - self.posting_offsets[token_ids]).sum())
+            matches.append((size, token_ids))
+        matches.sort(key=lambda match: match[0])
+        rows = self._rows_with_tokens(matches[0][1], len(table))
+        for _, token_ids in matches[1:]:
+            if len(rows) <= VERIFY_DIRECTLY_ROWS:
+                break
+            rows = rows[self._row_mask(token_ids, len(table))[rows]]
+        if tokens[0][0] == text:
+            # A single bare token: every posting is a match
+            return rows
+        return rows[_full_names_contain(table, rows, text)]
+
+    def lookup(self, table, filename, line, function_name):
+        """Row of one function by its (filename, line, name) key; None if absent"""
+        filename_id = table.strings.index_of(filename)
+        name_id = table.strings.index_of(function_name)
+        if filename_id is None or name_id is None:
+            return None
+        if self._rows_by_key is None:
+            keys = zip(table.filename_id.tolist(), table.line_number.tolist(), table.name_id.tolist())
+            rows_by_key = {}
+            for row, key in enumerate(keys):
+                # The first row wins, as in ProfileTable.find
+                rows_by_key.setdefault(key, row)
+            self._rows_by_key = rows_by_key
+        return self._rows_by_key.get((filename_id, int(line), name_id))
+
+
+# Above this many rows to verify, the whole string table is decoded in one pass
+BULK_DECODE_ROWS = 2000
+
+
+def _joined_strings(table):
+    """Every string of the table as bytes joined by newlines"""
+    offsets = table.strings.offsets
+    return np.insert(table.strings.data, offsets[1:-1], ord('\n')).tobytes()
+
+
+def _full_names_contain(table, rows, text):
+    """Mask of ``rows`` whose lower-cased full name contains ``text``"""
+    if len(rows) > BULK_DECODE_ROWS:
+        strings = _joined_strings(table).decode('utf-8', 'surrogateescape').lower().split('\n')
+        filenames = names = strings
+    else:
+        filenames = {i: table.strings.get(i).lower() for i in table.filename_id[rows].tolist()}
+        names = {i: table.strings.get(i).lower() for i in table.name_id[rows].tolist()}
+    return np.fromiter(
+        (text in f"{filenames[f]}:{line}({names[n]})" for f, line, n in zip(
+            table.filename_id[rows].tolist(), table.line_number[rows].tolist(), table.name_id[rows].tolist())),
+        dtype=bool, count=len(rows)
+    )
+
+
+def function_index(table):
+    """The table's saved index, or one built and kept on the table for older files"""
+    if table.index is None:
+        table.index = FunctionIndex.build(table)
+    return table.index
+
+
+def regex_rows(table, pattern):
+    """Rows whose function name or filename matches the compiled bytes ``pattern``.
+
+    The pattern runs over every distinct string of the table joined by
+    newlines, so one C-level scan covers the whole table; compile it with
+    re.MULTILINE for ``^`` and ``$`` to anchor at each string. Patterns
+    that match across the separator fall back to one search per string.
+    """
+    offsets = table.strings.offsets
+    if len(offsets) < 2:
+        return np.empty(0, dtype=np.int64)
+    text = _joined_strings(table)
+    # Where each string starts once a separator precedes every string but the first
+    starts = offsets[:-1] + np.arange(len(offsets) - 1)
+    matched = []
+    position = 0
+    while position <= len(text):
+        match = pattern.search(text, position)
+        if match is None:
+            break
+        string_id = int(np.searchsorted(starts, match.start(), side='right') - 1)
+        end = int(starts[string_id] + offsets[string_id + 1] - offsets[string_id])
+        if match.end() > end:
+            matched = [i for i, value in enumerate(text.split(b'\n')) if pattern.search(value)]
+            break
+        matched.append(string_id)
+        position = end + 1
+    if not matched:
+        return np.empty(0, dtype=np.int64)
+    matched = np.array(matched, dtype=np.int64)
+    return np.flatnonzero(np.isin(table.name_id, matched) | np.isin(table.filename_id, matched))
+
+
+def search_tables(named_tables, text=None, pattern=None, category_ids=None,
+                  min_total_time=0.0, min_cumulative_time=0.0, min_calls=0, limit=100):
+    """Find functions across several slots.
+
+    ``named_tables`` is a list of (slot, table). Functions are matched by
+    substring ``text`` and/or compiled bytes regex ``pattern``, restricted
+    to ``category_ids`` and kept when they pass every threshold in at
+    least one slot. Each match reports its timings in every slot that has
+    it, so changes across uploads can be read off directly.
+    """
+    matched_counts = {}
+    candidates = {}
+    for slot, table in named_tables:
+        if text:
+            rows = function_index(table).search(table, text)
+        else:
+            rows = np.arange(len(table), dtype=np.int64)
+        if pattern is not None and len(rows):
+            rows = np.intersect1d(rows, regex_rows(table, pattern), assume_unique=True)
+        if category_ids is not None:
+            rows = rows[np.isin(table.category[rows], category_ids)]
+        rows = rows[
+            (table.total_time[rows] >= min_total_time) &
+            (table.cumulative_time[rows] >= min_cumulative_time) &
+            (table.calls[rows] >= min_calls)
+        ]
+        matched_counts[slot] = len(rows)
+        # Only the heaviest rows of each slot can make the page
+        top = rows[np.argsort(-table.cumulative_time[rows], kind='stable')[:limit]]
+        for row in top:
+            key = (table.strings.get(table.filename_id[row]), int(table.line_number[row]),
+                   table.strings.get(table.name_id[row]))
+            candidates[key] = max(candidates.get(key, 0.0), float(table.cumulative_time[row]))
+
+    keys = sorted(candidates, key=lambda key: -candidates[key])[:limit]
+    matches = []
+    for filename, line, function_name in keys:
+        per_slot = {}
+        category = None
+        for slot, table in named_tables:
+            row = function_index(table).lookup(table, filename, line, function_name)
+            if row is None:
+                continue
+            function = table.row(row)
+            category = function['category']
+            per_slot[slot] = {
+                'row': row,
+                'calls': function['calls'],
+                'total_time': function['total_time'],
+                'cumulative_time': function['cumulative_time']
+            }
+        present = list(per_slot.values())
+        matches.append({
+            'name': f"{filename}:{line}({function_name})",
+            'filename': filename,
+            'line_number': line,
+            'function_name': function_name,
+            'category': category,
+            'profiles': per_slot,
+            'cumulative_time_change': (present[-1]['cumulative_time'] - present[0]['cumulative_time']
+                                       if len(present) > 1 else None)
+        })
+
+    return {'matched_rows': matched_counts, 'matches': matches}
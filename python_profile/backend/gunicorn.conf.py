@@ -0,0 +1,32 @@
+"""gunicorn settings for running the backend on every core.
+
+    gunicorn -c gunicorn.conf.py app:app
+
+Workers share sessions through the key file (or SECRET_KEY), slot data
+through the per-session SQLite stores, and parse job status through
+job_state/. Exactly one worker per host runs the expiry cleanup. Metrics
+are published to metrics_state/, which is cleared on each start so
+counters begin at zero.
+"""
+import multiprocessing
+import os
+import shutil
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 4))
+# Synchronous uploads wait for parsing (PARSE_TIMEOUT_SECONDS) before answering
+timeout = 330
+graceful_timeout = 30
+# Each worker must import the app itself so its parse pool and threads are its own
+preload_app = False
+
+# Split the cores between the workers' parse pools instead of giving each a full pool
+os.environ.setdefault('PARSE_WORKERS', str(max(1, multiprocessing.cpu_count() // workers)))
+# Counters and histograms summed over workers, so /api/metrics covers the host whichever worker answers
+os.environ.setdefault('METRICS_SHARED_DIR', os.path.abspath('metrics_state'))
+
+
+def on_starting(server):
+    shutil.rmtree(os.environ['METRICS_SHARED_DIR'], ignore_errors=True)
@@ -0,0 +1,501 @@
+"""Live profiles built from stack samples posted while a process runs.
+
+A stream is opened on a session slot and gets an ingest token, which an
+agent inside the profiled process uses to post batches of sampled
+stacks every few seconds. Batches are folded into the stream's
+StatsAccumulator, the same functions-and-edges aggregate the sampled
+file formats build, so memory grows with the distinct functions and
+call edges seen rather than with the number of samples. Past
+``max_functions`` functions or ``max_edges`` edges, new frames are
+folded into a single overflow frame.
+
+The aggregate is cached per process and kept on disk in the stream's
+directory as a checkpoint plus a log of the batches folded in since, so
+a batch costs its own size rather than the aggregate's; the checkpoint
+is rewritten every ``CHECKPOINT_BATCHES`` batches. Batches may reach any
+server process: a process replays whatever another one appended to the
+log since it last looked. Snapshots are copied under the stream's lock
+but built into a table outside it.
+
+Batch format::
+
+    {"interval": 0.01,
+     "frames": [["app.py", 12, "main"], ["app.py", 40, "work"]],
+     "samples": [[[0, 1], 250], [[0], 3, 0.05]]}
+
+``samples`` are (frame indices outermost first, sample count[, seconds]);
+without seconds a sample stands for ``interval`` seconds.
+"""
+import hashlib
+import hmac
+import json
+import marshal
+import math
+import os
+import re
+import secrets
+import shutil
+import struct
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from function_categories import categorize_function
+from process_coordination import ProcessLock
+from profile_formats import DEFAULT_SAMPLE_SECONDS, StatsAccumulator
+from profile_table import ProfileTable
+
+META_FILE = 'stream.json'
+AGGREGATE_FILE = 'aggregate.marshal'
+LOG_FILE = 'batches.log'
+LOCK_FILE = 'stream.lock'
+SNAPSHOT_LOCK_FILE = 'snapshot.lock'
+LOG_RECORD_HEADER = struct.Struct('<I')
+# The whole aggregate is written out again after this many logged batches, or log bytes
+CHECKPOINT_BATCHES = 200
+CHECKPOINT_LOG_BYTES = 32 * 1024 * 1024
+STREAM_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+OVERFLOW_KEY = ('<live>', 0, '<other functions>')
+MAX_STACK_DEPTH = 1024
+MAX_BATCH_SAMPLES = 200000
+MAX_BATCH_FRAMES = 200000
+# Line numbers must fit the table's int32 column; counts and seconds are
+# capped so that totals stay within int64 and finite
+MAX_SAMPLE_COUNT = 2 ** 31 - 1
+MAX_FRAME_LINE = 2 ** 31 - 1
+MAX_SAMPLE_SECONDS = 365 * 24 * 3600.0
+# A sample counts a recursive function up to MAX_STACK_DEPTH times, so this
+# keeps every per-function total within the table's int64 columns
+MAX_STREAM_SAMPLES = 2 ** 63 // (MAX_STACK_DEPTH * 2)
+# Aggregates kept in memory per process, most recently used last
+MAX_CACHED_STREAMS = 64
+
+
+class LiveStreamError(Exception):
+    """A stream request that cannot be applied; ``status`` is the HTTP status to answer with"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class LiveAggregate:
+    """Running totals of one stream"""
+
+    def __init__(self, state=None):
+        state = state or {}
+        self.stats = StatsAccumulator()
+        self.stats.functions = state.get('functions', {})
+        self.stats.edges = state.get('edges', {})
+        self.samples = state.get('samples', 0)
+        self.sampled_seconds = state.get('sampled_seconds', 0.0)
+        self.batches = state.get('batches', 0)
+        self.updated_at = state.get('updated_at')
+        self.snapshot_batches = state.get('snapshot_batches', 0)
+        self.snapshot_at = state.get('snapshot_at', 0.0)
+        self.checkpoint_batches = state.get('checkpoint_batches', self.batches)
+
+    def state(self):
+        return {
+            'functions': self.stats.functions,
+            'edges': self.stats.edges,
+            'samples': self.samples,
+            'sampled_seconds': self.sampled_seconds,
+            'batches': self.batches,
+            'updated_at': self.updated_at,
+            'snapshot_batches': self.snapshot_batches,
+            'snapshot_at': self.snapshot_at,
+            'checkpoint_batches': self.checkpoint_batches
+        }
+
+    def _bounded(self, frames, max_functions, max_edges):
+        """Frames with those that would grow the aggregate past its limits replaced by OVERFLOW_KEY"""
+        functions, edges = self.stats.functions, self.stats.edges
+        bounded = []
+        caller = None
+        for key in frames[-MAX_STACK_DEPTH:]:
+            if key not in functions and len(functions) >= max_functions:
+                key = OVERFLOW_KEY
+            if caller is not None and (caller, key) not in edges and len(edges) >= max_edges:
+                key = OVERFLOW_KEY
+            bounded.append(key)
+            caller = key
+        return bounded
+
+    def fold(self, frames, samples, interval, max_functions, max_edges):
+        """Add one batch checked by parse_batch; returns the number of samples in it"""
+        added = 0
+        for indices, count, seconds in samples:
+            stack = self._bounded([frames[i] for i in indices], max_functions, max_edges)
+            if seconds is None:
+                seconds = count * interval
+            self.stats.add_stack(stack, seconds, samples=count)
+            added += count
+            self.sampled_seconds += seconds
+        self.samples += added
+        self.batches += 1
+        self.updated_at = time.time()
+        return added
+
+    def table(self):
+        return ProfileTable.from_entries(self.stats.entries(), categorize_function)
+
+
+class LiveSnapshot:
+    """A stream's totals as of one batch, copied under the stream's lock and turned into a table outside it"""
+
+    def __init__(self, aggregate, status):
+        self.entries = aggregate.stats.entries()
+        self.batches = aggregate.batches
+        self.status = status
+
+    def table(self):
+        return ProfileTable.from_entries(self.entries, categorize_function)
+
+
+def parse_batch(batch, default_interval):
+    """Checked (frames, [(indices, count, seconds or None)], interval) of a posted batch"""
+    if not isinstance(batch, dict):
+        raise LiveStreamError('Batch must be a JSON object')
+    interval = batch.get('interval', default_interval)
+    if not isinstance(interval, (int, float)) or not 0 < interval <= 60:
+        raise LiveStreamError('interval must be seconds per sample, above 0 and at most 60')
+    raw_frames = batch.get('frames') or []
+    raw_samples = batch.get('samples') or []
+    if not isinstance(raw_frames, list) or not isinstance(raw_samples, list):
+        raise LiveStreamError('frames and samples must be lists')
+    if len(raw_frames) > MAX_BATCH_FRAMES or len(raw_samples) > MAX_BATCH_SAMPLES:
+        raise LiveStreamError(f'Batches are limited to {MAX_BATCH_FRAMES} frames and {MAX_BATCH_SAMPLES} stacks')
+
+    frames = []
+    for frame in raw_frames:
+        if not (isinstance(frame, list) and len(frame) == 3 and isinstance(frame[0], str)
+                and isinstance(frame[1], int) and isinstance(frame[2], str)):
+            raise LiveStreamError('Each frame must be [filename, line, function name]')
+        if not 0 <= frame[1] <= MAX_FRAME_LINE:
+            raise LiveStreamError(f'Frame line numbers must be between 0 and {MAX_FRAME_LINE}')
+        frames.append((frame[0], frame[1], frame[2]))
+
+    samples = []
+    for sample in raw_samples:
+        if not isinstance(sample, list) or len(sample) not in (2, 3) or not isinstance(sample[0], list):
+            raise LiveStreamError('Each sample must be [frame indices, count] or [frame indices, count, seconds]')
+        indices, count = sample[0], sample[1]
+        if not isinstance(count, int) or not 1 <= count <= MAX_SAMPLE_COUNT:
+            raise LiveStreamError(f'Sample counts must be integers from 1 to {MAX_SAMPLE_COUNT}')
+        if not all(isinstance(i, int) and 0 <= i < len(frames) for i in indices):
+            raise LiveStreamError('Sample frame index out of range')
+        seconds = sample[2] if len(sample) == 3 else None
+        if seconds is not None and (not isinstance(seconds, (int, float)) or not math.isfinite(seconds)
+                                    or not 0 <= seconds <= MAX_SAMPLE_SECONDS):
+            raise LiveStreamError(f'Sample seconds must be a finite number from 0 to {MAX_SAMPLE_SECONDS:.0f}')
+        samples.append((indices, count, seconds))
+    return frames, samples, float(interval)
+
+
+class LiveStreams:
+    """Open live streams under ``root``, one directory each"""
+
+    def __init__(self, root, max_functions=50000, max_edges=250000, max_streams_per_session=8,
+                 snapshot_seconds=2.0, idle_seconds=3600):
+        self.root = root
+        self.max_functions = max_functions
+        self.max_edges = max_edges
+        self.max_streams_per_session = max_streams_per_session
+        self.snapshot_seconds = snapshot_seconds
+        self.idle_seconds = idle_seconds
+        self._cache = OrderedDict()  # stream id -> (aggregate file stat, LiveAggregate)
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _dir(self, stream_id):
+        if not STREAM_ID_RE.match(stream_id or ''):
+            raise LiveStreamError('Unknown live stream', 404)
+        return os.path.join(self.root, stream_id)
+
+    def _meta(self, stream_id):
+        try:
+            with open(os.path.join(self._dir(stream_id), META_FILE)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise LiveStreamError('Unknown live stream', 404)
+
+    def _streams(self):
+        for stream_id in os.listdir(self.root):
+            try:
+                yield self._meta(stream_id)
+            except (LiveStreamError, ValueError):
+                continue
+
+    def create(self, session_id, profile_slot, name, interval=DEFAULT_SAMPLE_SECONDS):
+        """Open a stream on a slot; the returned meta carries the ingest ``token``, shown only here"""
+        owned = [meta for meta in self._streams() if meta['session_id'] == session_id]
+        if len(owned) >= self.max_streams_per_session:
+            raise LiveStreamError(f'At most {self.max_streams_per_session} live streams per session; '
+                                  'close one first', 429)
+        if any(meta['profile_slot'] == profile_slot for meta in owned):
+            raise LiveStreamError(f'Slot {profile_slot} already has a live stream', 409)
+        stream_id = uuid.uuid4().hex
+        token = secrets.token_urlsafe(24)
+        meta = {
+            'stream_id': stream_id,
+            'session_id': session_id,
+            'profile_slot': profile_slot,
+            'name': name,
+            'interval': interval,
+            'token_sha256': hashlib.sha256(token.encode()).hexdigest(),
+            'created_at': time.time()
+        }
+        stream_dir = self._dir(stream_id)
+        os.makedirs(stream_dir)
+        tmp_path = os.path.join(stream_dir, f"{META_FILE}.tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, os.path.join(stream_dir, META_FILE))
+        return dict(meta, token=token)
+
+    def owned(self, session_id, stream_id):
+        """Meta of a stream of ``session_id``; other sessions' streams look unknown"""
+        meta = self._meta(stream_id)
+        if meta['session_id'] != session_id:
+            raise LiveStreamError('Unknown live stream', 404)
+        return meta
+
+    def authorize(self, stream_id, token):
+        meta = self._meta(stream_id)
+        digest = hashlib.sha256((token or '').encode()).hexdigest()
+        if not hmac.compare_digest(digest, meta['token_sha256']):
+            raise LiveStreamError('Invalid stream token', 403)
+        return meta
+
+    @contextmanager
+    def _locked(self, stream_dir):
+        """Hold the stream's lock; a stream closed meanwhile raises 404"""
+        lock = ProcessLock(os.path.join(stream_dir, LOCK_FILE))
+        # Fails only once the stream's directory is gone
+        if not lock.acquire():
+            raise LiveStreamError('Live stream was closed', 404)
+        try:
+            if not os.path.exists(os.path.join(stream_dir, META_FILE)):
+                raise LiveStreamError('Live stream was closed', 404)
+            yield
+        finally:
+            lock.release()
+
+    @staticmethod
+    def _file_key(path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _load(self, stream_dir, stream_id):
+        """The stream's aggregate and how far into the log it is (hold the stream's lock).
+
+        This process's cached copy is reused while the checkpoint is
+        unchanged, replaying only batches logged since by other processes.
+        """
+        checkpoint_path = os.path.join(stream_dir, AGGREGATE_FILE)
+        checkpoint_key = self._file_key(checkpoint_path)
+        with self._lock:
+            cached = self._cache.get(stream_id)
+        if cached is not None and cached[0] == checkpoint_key:
+            aggregate, offset = cached[1], cached[2]
+        elif checkpoint_key is None:
+            aggregate, offset = LiveAggregate(), 0
+        else:
+            with open(checkpoint_path, 'rb') as f:
+                aggregate, offset = LiveAggregate(marshal.load(f)), 0
+        return aggregate, self._replay(stream_dir, aggregate, offset)
+
+    def _replay(self, stream_dir, aggregate, offset):
+        """Apply log records past ``offset``; returns the offset after the last whole record"""
+        try:
+            with open(os.path.join(stream_dir, LOG_FILE), 'rb') as f:
+                f.seek(offset)
+                data = f.read()
+        except FileNotFoundError:
+            return 0
+        position = 0
+        while position + LOG_RECORD_HEADER.size <= len(data):
+            length, = LOG_RECORD_HEADER.unpack_from(data, position)
+            end = position + LOG_RECORD_HEADER.size + length
+            if end > len(data):
+                # Torn write of a process that died mid-append
+                break
+            record = marshal.loads(data[position + LOG_RECORD_HEADER.size:end])
+            if record[0] == 'batch':
+                # A crash between checkpoint and log truncation leaves batches the checkpoint has
+                if record[1] > aggregate.batches:
+                    aggregate.fold(record[3], record[4], record[2], self.max_functions, self.max_edges)
+            else:
+                aggregate.snapshot_batches = max(aggregate.snapshot_batches, record[1])
+                aggregate.snapshot_at = record[2]
+            position = end
+        return offset + position
+
+    def _append(self, stream_dir, record):
+        """Add a record to the stream's log (hold the stream's lock); returns the new log size"""
+        payload = marshal.dumps(record)
+        with open(os.path.join(stream_dir, LOG_FILE), 'ab') as f:
+            f.write(LOG_RECORD_HEADER.pack(len(payload)) + payload)
+            return f.tell()
+
+    def _keep(self, stream_dir, stream_id, aggregate, offset):
+        """Cache the aggregate, writing a checkpoint once the log has grown long enough"""
+        if (aggregate.batches - aggregate.checkpoint_batches >= CHECKPOINT_BATCHES
+                or offset >= CHECKPOINT_LOG_BYTES):
+            aggregate.checkpoint_batches = aggregate.batches
+            path = os.path.join(stream_dir, AGGREGATE_FILE)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                marshal.dump(aggregate.state(), f)
+            os.replace(tmp_path, path)
+            open(os.path.join(stream_dir, LOG_FILE), 'wb').close()
+            offset = 0
+        with self._lock:
+            self._cache[stream_id] = (self._file_key(os.path.join(stream_dir, AGGREGATE_FILE)), aggregate, offset)
+            self._cache.move_to_end(stream_id)
+            while len(self._cache) > MAX_CACHED_STREAMS:
+                self._cache.popitem(last=False)
+
+    def _forget(self, stream_id):
+        with self._lock:
+            self._cache.pop(stream_id, None)
+
+    def _snapshot_due(self, aggregate, force):
+        if aggregate.samples == 0 or aggregate.batches == aggregate.snapshot_batches:
+            return False
+        return force or time.time() - aggregate.snapshot_at >= self.snapshot_seconds
+
+    def ingest(self, meta, batch, snapshot, force_snapshot=False):
+        """Fold a batch into the stream, then call ``snapshot(meta, LiveSnapshot)`` when one is due.
+
+        Snapshots are taken at most every ``snapshot_seconds``, one at a
+        time per stream and each from a later batch than the one before,
+        so a slot never goes back to an older one.
+        """
+        stream_id = meta['stream_id']
+        stream_dir = self._dir(stream_id)
+        frames, samples, interval = parse_batch(batch, meta['interval'])
+        with self._locked(stream_dir):
+            aggregate, offset = self._load(stream_dir, stream_id)
+            if aggregate.samples + sum(count for _, count, _ in samples) > MAX_STREAM_SAMPLES:
+                raise LiveStreamError(f'A stream holds at most {MAX_STREAM_SAMPLES} samples', 413)
+            try:
+                added = aggregate.fold(frames, samples, interval, self.max_functions, self.max_edges)
+                offset = self._append(stream_dir, ('batch', aggregate.batches, interval, frames, samples))
+                self._keep(stream_dir, stream_id, aggregate, offset)
+            except BaseException:
+                # Drop the partly updated copy; the log still ends at the last whole batch
+                self._forget(stream_id)
+                raise
+            status = self.describe(meta, aggregate)
+            due = self._snapshot_due(aggregate, force_snapshot)
+        if due:
+            try:
+                self._snapshot(meta, snapshot, force_snapshot)
+            except LiveStreamError:
+                # Closed after the batch was folded; close took the final snapshot
+                pass
+        return added, status
+
+    def _snapshot(self, meta, snapshot, force):
+        stream_id = meta['stream_id']
+        stream_dir = self._dir(stream_id)
+        snapshot_lock = ProcessLock(os.path.join(stream_dir, SNAPSHOT_LOCK_FILE))
+        # Another snapshot is being built; the next batch finds this one due again
+        if not snapshot_lock.acquire(blocking=False):
+            return
+        try:
+            with self._locked(stream_dir):
+                aggregate, offset = self._load(stream_dir, stream_id)
+                if not self._snapshot_due(aggregate, force):
+                    self._keep(stream_dir, stream_id, aggregate, offset)
+                    return
+                frozen = LiveSnapshot(aggregate, self.describe(meta, aggregate))
+                aggregate.snapshot_batches = aggregate.batches
+                aggregate.snapshot_at = time.time()
+                offset = self._append(stream_dir, ('snapshot', aggregate.snapshot_batches, aggregate.snapshot_at))
+                self._keep(stream_dir, stream_id, aggregate, offset)
+            snapshot(meta, frozen)
+        finally:
+            snapshot_lock.release()
+
+    def close(self, meta, snapshot=None):
+        """Remove a stream, first taking a final snapshot if ``snapshot`` is given"""
+        stream_id = meta['stream_id']
+        stream_dir = self._dir(stream_id)
+        # Wait for a snapshot in progress, so it cannot land after the final one
+        snapshot_lock = ProcessLock(os.path.join(stream_dir, SNAPSHOT_LOCK_FILE))
+        if not snapshot_lock.acquire():
+            raise LiveStreamError('Live stream was closed', 404)
+        try:
+            with self._locked(stream_dir):
+                aggregate, _ = self._load(stream_dir, stream_id)
+                frozen = None
+                if snapshot is not None and self._snapshot_due(aggregate, True):
+                    frozen = LiveSnapshot(aggregate, self.describe(meta, aggregate))
+                # Ingests waiting on the lock see the stream gone
+                os.remove(os.path.join(stream_dir, META_FILE))
+            if frozen is not None:
+                snapshot(meta, frozen)
+        finally:
+            snapshot_lock.release()
+            self._forget(stream_id)
+            shutil.rmtree(stream_dir, ignore_errors=True)
+        return self.describe(meta, aggregate)
+
+    def status(self, meta):
+        stream_dir = self._dir(meta['stream_id'])
+        with self._locked(stream_dir):
+            aggregate, offset = self._load(stream_dir, meta['stream_id'])
+            self._keep(stream_dir, meta['stream_id'], aggregate, offset)
+            return self.describe(meta, aggregate)
+
+    def describe(self, meta, aggregate):
+        return {
+            'stream_id': meta['stream_id'],
+            'profile_slot': meta['profile_slot'],
+            'name': meta['name'],
+            'interval': meta['interval'],
+            'created_at': meta['created_at'],
+            'updated_at': aggregate.updated_at,
+            'samples': aggregate.samples,
+            'sampled_seconds': aggregate.sampled_seconds,
+            'batches': aggregate.batches,
+            'functions': len(aggregate.stats.functions),
+            'edges': len(aggregate.stats.edges),
+            'overflowed': OVERFLOW_KEY in aggregate.stats.functions
+        }
+
+    def session_streams(self, session_id):
+        return [meta for meta in self._streams() if meta['session_id'] == session_id]
+
+    def close_session(self, session_id):
+        """Drop a session's streams without snapshots, e.g. when the session is deleted"""
+        for meta in self.session_streams(session_id):
+            self.close(meta)
+
+    def expire(self, snapshot):
+        """Close streams that have had no batch for ``idle_seconds``; returns how many"""
+        cutoff = time.time() - self.idle_seconds
+        closed = 0
+        for meta in list(self._streams()):
+            stream_dir = self._dir(meta['stream_id'])
+            last_write = meta['created_at']
+            for name in (AGGREGATE_FILE, LOG_FILE):
+                try:
+                    last_write = max(last_write, os.path.getmtime(os.path.join(stream_dir, name)))
+                except FileNotFoundError:
+                    pass
+            if last_write < cutoff:
+                try:
+                    self.close(meta, snapshot)
+                    closed += 1
+                except Exception as e:
+                    print(f"Error closing idle live stream {meta['stream_id']}: {e}")
+        return closed
@@ -0,0 +1,220 @@
+"""In-process metrics rendered in the Prometheus text format.
+
+Counters and histograms are updated by the app as work happens; gauges
+read a callback at scrape time, for values other components already
+track (such as the store's lock wait). Values are kept per process; with
+a shared directory every server process also publishes them there, so a
+scrape answered by any worker covers the whole host.
+"""
+import bisect
+import json
+import math
+import os
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    parts = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{name}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic totals per label set"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in sorted(self._values.items())]
+
+
+class Histogram:
+    """Cumulative-bucket histogram per label set"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0}
+            series['counts'][index] += 1
+            series['sum'] += value
+
+    def samples(self):
+        result = []
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                running = 0
+                for bound, count in zip(self.buckets + (math.inf,), series['counts']):
+                    running += count
+                    result.append((f"{self.name}_bucket", key + (('le', _format_value(bound)),), running))
+                result.append((f"{self.name}_sum", key, series['sum']))
+                result.append((f"{self.name}_count", key, running))
+        return result
+
+
+class Gauge:
+    """Value read from a callback at scrape time; ``kind`` is 'counter' for running totals"""
+
+    def __init__(self, name, help_text, read, kind='gauge'):
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+        self.kind = kind
+
+    def samples(self):
+        return [(self.name, (), self.read())]
+
+
+class MetricsRegistry:
+    """Named metrics of this process, optionally merged with the host's other server processes"""
+
+    def __init__(self, shared_dir=None, publish_seconds=10.0):
+        """With a ``shared_dir``, counters and histograms are rendered summed
+        over every process that published there, including exited ones so
+        totals never go backwards, and gauges once per live process with a
+        ``pid`` label. A process counts as live while its file is younger
+        than three ``publish_seconds``.
+        """
+        self._metrics = []
+        self.shared_dir = shared_dir
+        self.publish_seconds = publish_seconds
+        self._publisher = None
+        if shared_dir:
+            os.makedirs(shared_dir, exist_ok=True)
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text):
+        return self._register(Counter(name, help_text))
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, buckets))
+
+    def gauge(self, name, help_text, read):
+        return self._register(Gauge(name, help_text, read))
+
+    def counter_function(self, name, help_text, read):
+        """A counter whose running total is kept elsewhere and read at scrape time"""
+        return self._register(Gauge(name, help_text, read, kind='counter'))
+
+    def _collect(self):
+        """{metric name: samples} of this process; metrics that fail to read are left out"""
+        collected = {}
+        for metric in self._metrics:
+            try:
+                collected[metric.name] = metric.samples()
+            except Exception as e:
+                print(f"Error reading metric {metric.name}: {e}")
+        return collected
+
+    def publish(self, collected=None):
+        """Write this process's values to the shared directory"""
+        collected = self._collect() if collected is None else collected
+        path = os.path.join(self.shared_dir, f"{os.getpid()}.json")
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'pid': os.getpid(), 'metrics': collected}, f, separators=(',', ':'))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Error publishing metrics: {e}")
+        return collected
+
+    def start_publishing(self):
+        """Publish every ``publish_seconds`` from a background thread (no-op without a shared_dir)"""
+        if not self.shared_dir or self._publisher is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(self.publish_seconds)
+                self.publish()
+
+        self._publisher = threading.Thread(target=run, name='metrics-publisher', daemon=True)
+        self._publisher.start()
+
+    def _published(self, own):
+        """(pid, live, {metric name: samples}) of every process, this one first"""
+        processes = [(os.getpid(), True, own)]
+        own_file = f"{os.getpid()}.json"
+        cutoff = time.time() - 3 * self.publish_seconds
+        for entry in os.scandir(self.shared_dir):
+            if not entry.name.endswith('.json') or entry.name == own_file:
+                continue
+            try:
+                live = entry.stat().st_mtime >= cutoff
+                with open(entry.path) as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                continue
+            processes.append((state['pid'], live, {
+                name: [(sample, tuple(tuple(label) for label in labels), value) for sample, labels, value in samples]
+                for name, samples in state['metrics'].items()
+            }))
+        return processes
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        own = self._collect()
+        processes = self._published(self.publish(own)) if self.shared_dir else None
+        lines = []
+        for metric in self._metrics:
+            if processes is None:
+                if metric.name not in own:
+                    continue
+                samples = own[metric.name]
+            elif metric.kind == 'gauge':
+                samples = [
+                    (name, (('pid', pid),) + labels, value)
+                    for pid, live, published in processes if live
+                    for name, labels, value in published.get(metric.name, ())
+                ]
+            else:
+                totals = {}
+                for _, _, published in processes:
+                    for name, labels, value in published.get(metric.name, ()):
+                        totals[name, labels] = totals.get((name, labels), 0) + value
+                samples = [(name, labels, value) for (name, labels), value in totals.items()]
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in samples:
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
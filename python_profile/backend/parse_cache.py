@@ -0,0 +1,188 @@
+"""Content-addressed cache of parsed profiles.
+
+Entries are keyed by the SHA-256 of the uploaded bytes, so the same dump
+uploaded into any slot of any session is parsed only once. Each entry is
+a directory holding the JSON summary and the function table; the least
+recently used entries are evicted once the cache grows past its byte
+budget.
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+SUMMARY_FILE = 'summary.json'
+TABLE_FILE = 'table.ptab'
+CHUNK_SIZE = 1024 * 1024
+
+
+def save_stream_with_hash(stream, filepath, chunk_size=CHUNK_SIZE):
+    """Copy ``stream`` to ``filepath`` chunk by chunk, returning its SHA-256 and size"""
+    digest = hashlib.sha256()
+    size = 0
+    with open(filepath, 'wb') as out:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            out.write(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+
+def hash_file(filepath, chunk_size=CHUNK_SIZE):
+    """SHA-256 and size of a file already on disk"""
+    digest = hashlib.sha256()
+    size = 0
+    with open(filepath, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+
+def link_or_copy(src, dst):
+    """Hard-link ``src`` to ``dst`` when possible, copying otherwise"""
+    os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+    tmp_path = f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
+    # Never copy through a leftover link: that would rewrite the file it shares an inode with
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+    # rename() does nothing when both names already link the same file
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+
+
+class ParseCache:
+    """On-disk LRU cache of parse results keyed by content hash"""
+
+    def __init__(self, root, max_bytes, version=1):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.version = version
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> size in bytes, oldest first
+        self._total_bytes = 0
+        self._index_loaded = False
+        os.makedirs(root, exist_ok=True)
+
+    def _key(self, content_hash):
+        return f"v{self.version}-{content_hash}"
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root, key)
+
+    def _load_index(self):
+        """Rebuild the in-memory LRU order from the entries already on disk (once, on first use)"""
+        if self._index_loaded:
+            return
+        self._index_loaded = True
+        found = []
+        for key in os.listdir(self.root):
+            if key.endswith('.tmp'):
+                continue
+            entry_dir = self._entry_dir(key)
+            summary_path = os.path.join(entry_dir, SUMMARY_FILE)
+            if not os.path.isfile(summary_path):
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                continue
+            size = sum(
+                os.path.getsize(os.path.join(entry_dir, name))
+                for name in os.listdir(entry_dir)
+            )
+            found.append((os.path.getmtime(summary_path), key, size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._total_bytes += size
+
+    def get(self, content_hash, table_path=None):
+        """Return the cached summary, linking the cached table to ``table_path``"""
+        key = self._key(content_hash)
+        with self._lock:
+            self._load_index()
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+
+        entry_dir = self._entry_dir(key)
+        try:
+            with open(os.path.join(entry_dir, SUMMARY_FILE), 'r') as f:
+                profile_data = json.load(f)
+            if table_path:
+                link_or_copy(os.path.join(entry_dir, TABLE_FILE), table_path)
+            now = time.time()
+            os.utime(os.path.join(entry_dir, SUMMARY_FILE), (now, now))
+        except (OSError, ValueError) as e:
+            print(f"Parse cache entry {key} unreadable, dropping: {e}")
+            self._drop(key)
+            return None
+        return profile_data
+
+    def put(self, content_hash, profile_data, table_path):
+        """Store a successful parse result"""
+        key = self._key(content_hash)
+        entry_dir = self._entry_dir(key)
+        tmp_dir = f"{entry_dir}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(tmp_dir, exist_ok=True)
+            link_or_copy(table_path, os.path.join(tmp_dir, TABLE_FILE))
+            with open(os.path.join(tmp_dir, SUMMARY_FILE), 'w') as f:
+                json.dump(profile_data, f, separators=(',', ':'))
+            size = sum(
+                os.path.getsize(os.path.join(tmp_dir, name))
+                for name in os.listdir(tmp_dir)
+            )
+            with self._lock:
+                self._load_index()
+                if key in self._entries:
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+                    self._entries.move_to_end(key)
+                    return
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                os.replace(tmp_dir, entry_dir)
+                self._entries[key] = size
+                self._total_bytes += size
+        except OSError as e:
+            print(f"Error writing parse cache entry {key}: {e}")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        self._evict()
+
+    def _drop(self, key):
+        with self._lock:
+            size = self._entries.pop(key, None)
+            if size is not None:
+                self._total_bytes -= size
+        shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+
+    def _evict(self):
+        """Remove least recently used entries until the cache fits its budget"""
+        while True:
+            with self._lock:
+                if self._total_bytes <= self.max_bytes or len(self._entries) <= 1:
+                    return
+                key, size = self._entries.popitem(last=False)
+                self._total_bytes -= size
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            print(f"Evicted parse cache entry: {key}")
+
+    def stats(self):
+        with self._lock:
+            self._load_index()
+            return {
+                'entries': len(self._entries),
+                'total_bytes': self._total_bytes,
+                'max_bytes': self.max_bytes
+            }
@@ -0,0 +1,448 @@
+"""Background parse jobs on a bounded process pool.
+
+Parsing a large pstats dump is CPU bound and holds the GIL, so it runs in
+worker processes. The queue refuses new work once ``max_pending`` jobs are
+waiting or running, and every job has a timeout. Job state lives in the
+web process; completion callbacks run there too, so they can write to the
+session store directly. Jobs made of many pool tasks (such as merges) run
+a coordinator thread in the web process that fans work out to the pool.
+With a ``state_dir`` every job's state is also written to a small JSON
+file, so any server process on the host can answer a status poll.
+
+Workers report when they pick a job up, so 'parsing' means the job is
+really running. Where SIGALRM is missing a timed-out worker cannot be
+interrupted; its pool is retired instead and the stuck worker killed once
+the pool's other tasks have finished (or had one more timeout to do so).
+"""
+import json
+import multiprocessing
+import os
+import signal
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+ACTIVE_STATES = ('queued', 'parsing', 'storing')
+PERSISTED_FIELDS = ('job_id', 'owner', 'state', 'description', 'submitted_at',
+                    'started_at', 'finished_at', 'result', 'error')
+
+
+class QueueFullError(Exception):
+    """Raised when the parse queue is at capacity"""
+
+
+def _raise_timeout(signum, frame):
+    raise TimeoutError('Parse job timed out')
+
+
+_started_queue = None
+
+
+def _init_worker(started_queue):
+    global _started_queue
+    _started_queue = started_queue
+
+
+def run_job(job_id, fn, timeout_seconds, *args):
+    """Pool entry point: report that ``job_id`` started in this worker, then run it"""
+    if job_id is not None and _started_queue is not None:
+        _started_queue.put((job_id, os.getpid(), time.time()))
+    return run_with_timeout(fn, timeout_seconds, *args)
+
+
+def run_with_timeout(fn, timeout_seconds, *args):
+    """Run ``fn(*args)`` in a worker, interrupting it after ``timeout_seconds`` where SIGALRM exists"""
+    if not timeout_seconds or not hasattr(signal, 'SIGALRM'):
+        return fn(*args)
+    previous = signal.signal(signal.SIGALRM, _raise_timeout)
+    signal.setitimer(signal.ITIMER_REAL, timeout_seconds)
+    try:
+        return fn(*args)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def _cancel(futures):
+    # Executor.shutdown(cancel_futures=True) needs Python 3.9
+    for future in futures:
+        future.cancel()
+
+
+class ParseJobQueue:
+    """Tracks parse jobs submitted to a shared process pool"""
+
+    def __init__(self, max_workers, max_pending, timeout_seconds, retention_seconds=3600, on_finished=None,
+                 state_dir=None):
+        self.max_workers = max_workers
+        self.state_dir = state_dir
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+        # Called with each job once it reaches 'done' or 'failed' (e.g. to record metrics)
+        self.on_finished = on_finished
+        self.max_pending = max_pending
+        self.timeout_seconds = timeout_seconds
+        self.retention_seconds = retention_seconds
+        self._pool = None
+        self._started = None
+        self._coordinators = None
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        """The current pool: its executor, its unfinished futures and its stuck workers"""
+        with self._lock:
+            # Created lazily so importing the app never forks workers
+            if self._pool is None:
+                if self._started is None:
+                    self._started = multiprocessing.SimpleQueue()
+                    threading.Thread(target=self._watch_started, name='parse-job-starts', daemon=True).start()
+                executor = ProcessPoolExecutor(max_workers=self.max_workers, initializer=_init_worker,
+                                               initargs=(self._started,))
+                self._pool = {'executor': executor, 'futures': set(), 'stuck': {}, 'state': 'active'}
+            return self._pool
+
+    def _watch_started(self):
+        while True:
+            message = self._started.get()
+            if message is None:
+                return
+            job_id, pid, started_at = message
+            with self._lock:
+                job = self._jobs.get(job_id)
+            if job is not None:
+                self._mark_started(job, started_at, pid)
+
+    def _mark_started(self, job, started_at, pid=None):
+        with self._lock:
+            if job['state'] != 'queued':
+                return
+            job['state'] = 'parsing'
+            job['started_at'] = started_at
+            job['pid'] = pid
+        self._persist(job)
+        # Platforms without SIGALRM cannot interrupt the worker; give up on it instead
+        if pid is not None and not hasattr(signal, 'SIGALRM') and self.timeout_seconds:
+            remaining = max(0.0, started_at + self.timeout_seconds - time.time())
+            timer = threading.Timer(remaining, self._expire, args=(job,))
+            timer.daemon = True
+            timer.start()
+
+    def _prune(self, now):
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job['state'] not in ACTIVE_STATES and now - job['finished_at'] > self.retention_seconds
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+            self._remove_state(job_id)
+
+    def _state_path(self, job_id):
+        return os.path.join(self.state_dir, f"{job_id}.json")
+
+    def _persist(self, job):
+        """Write a job's state for other processes (no-op without a state_dir)"""
+        if not self.state_dir:
+            return
+        state = {key: job[key] for key in PERSISTED_FIELDS}
+        path = self._state_path(job['job_id'])
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f, separators=(',', ':'))
+            os.replace(tmp_path, path)
+        except (OSError, TypeError, ValueError) as e:
+            print(f"Error persisting job {job['job_id']}: {e}")
+
+    def _remove_state(self, job_id):
+        if self.state_dir:
+            try:
+                os.remove(self._state_path(job_id))
+            except OSError:
+                pass
+
+    def _load_persisted(self, job_id):
+        """A job owned by another process, rebuilt from its state file, or None"""
+        if not self.state_dir or not job_id.replace('-', '').isalnum():
+            return None
+        try:
+            with open(self._state_path(job_id)) as f:
+                job = json.load(f)
+        except (OSError, ValueError):
+            return None
+        job['future'] = None
+        job['done'] = threading.Event()
+        if job['state'] not in ACTIVE_STATES:
+            job['done'].set()
+        return job
+
+    def prune_state_files(self):
+        """Remove state files of jobs finished longer than the retention ago, whichever process wrote them"""
+        if not self.state_dir:
+            return 0
+        cutoff = time.time() - self.retention_seconds
+        removed = 0
+        for entry in os.scandir(self.state_dir):
+            try:
+                if entry.stat().st_mtime >= cutoff:
+                    continue
+                os.remove(entry.path)
+                removed += 1
+            except OSError:
+                pass
+        return removed
+
+    def pending_count(self):
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if job['state'] in ACTIVE_STATES)
+
+    def _new_job(self, owner, description, state):
+        now = time.time()
+        return {
+            'job_id': str(uuid.uuid4()),
+            'owner': owner,
+            'state': state,
+            'description': description,
+            'submitted_at': now,
+            'started_at': None,
+            'finished_at': None,
+            'result': None,
+            'error': None,
+            'future': None,
+            'pool': None,
+            'pid': None,
+            'on_failure': None,
+            'done': threading.Event()
+        }
+
+    def _admit(self, owner, description):
+        with self._lock:
+            now = time.time()
+            self._prune(now)
+            active = sum(1 for job in self._jobs.values() if job['state'] in ACTIVE_STATES)
+            if active >= self.max_pending:
+                raise QueueFullError(f'{active} parse jobs already pending')
+            job = self._new_job(owner, description, 'queued')
+            self._jobs[job['job_id']] = job
+        self._persist(job)
+        return job
+
+    def _submit_job_task(self, job_id, fn, *args):
+        pool = self._get_pool()
+        try:
+            future = pool['executor'].submit(run_job, job_id, fn, self.timeout_seconds, *args)
+        except BrokenProcessPool:
+            # A crashed worker poisons the pool; start a fresh one
+            with self._lock:
+                if self._pool is pool:
+                    self._pool = None
+            pool = self._get_pool()
+            future = pool['executor'].submit(run_job, job_id, fn, self.timeout_seconds, *args)
+        with self._lock:
+            pool['futures'].add(future)
+        future.add_done_callback(lambda f: self._forget_future(pool, f))
+        return pool, future
+
+    def _forget_future(self, pool, future):
+        with self._lock:
+            pool['futures'].discard(future)
+
+    def submit_to_pool(self, fn, *args):
+        """Schedule one task on the pool with the job timeout, returning its future"""
+        return self._submit_job_task(None, fn, *args)[1]
+
+    def submit(self, owner, description, fn, args, on_success, on_failure=None):
+        """Queue ``fn(*args)`` in the pool; ``on_success(result)`` runs in this process.
+
+        ``on_failure()`` runs instead if the job fails or times out, e.g. to
+        delete its input. Raises QueueFullError when ``max_pending`` jobs are
+        already active.
+        """
+        job = self._admit(owner, description)
+        job['on_failure'] = on_failure
+        job['pool'], future = self._submit_job_task(job['job_id'], fn, *args)
+        job['future'] = future
+        future.add_done_callback(lambda f: self._finish(job, f, on_success))
+        return job
+
+    def submit_coordinated(self, owner, description, fn, args, on_success, on_failure=None):
+        """Run ``fn(submit_to_pool, *args)`` on a coordinator thread.
+
+        ``fn`` spreads its work over the pool itself; each pool task gets
+        the job timeout. Admission, ``on_success`` and ``on_failure`` work
+        as in ``submit``.
+        """
+        job = self._admit(owner, description)
+        job['on_failure'] = on_failure
+        with self._lock:
+            if self._coordinators is None:
+                self._coordinators = ThreadPoolExecutor(max_workers=2, thread_name_prefix='parse-coordinator')
+            coordinators = self._coordinators
+
+        def coordinate():
+            self._mark_started(job, time.time())
+            return fn(self.submit_to_pool, *args)
+
+        future = coordinators.submit(coordinate)
+        job['future'] = future
+        future.add_done_callback(lambda f: self._finish(job, f, on_success))
+        return job
+
+    def record_completed(self, owner, description, result):
+        """Register a job that finished without needing the pool (e.g. a cache hit)"""
+        with self._lock:
+            job = self._new_job(owner, description, 'done')
+            job['started_at'] = job['finished_at'] = job['submitted_at']
+            job['result'] = result
+            job['done'].set()
+            self._jobs[job['job_id']] = job
+        self._persist(job)
+        return job
+
+    def _finish(self, job, future, on_success):
+        with self._lock:
+            if job['state'] not in ACTIVE_STATES:
+                return
+            job['state'] = 'storing'
+        try:
+            result = future.result()
+            on_success(result)
+            job['result'] = result
+            state, error = 'done', None
+        except TimeoutError:
+            state, error = 'failed', f'Parsing timed out after {self.timeout_seconds}s'
+        except Exception as e:
+            state, error = 'failed', f'Parse job failed: {e}'
+        if state == 'failed':
+            self._run_on_failure(job)
+        with self._lock:
+            job['state'] = state
+            job['error'] = error
+            job['finished_at'] = time.time()
+        self._persist(job)
+        job['done'].set()
+        self._notify_finished(job)
+
+    def _run_on_failure(self, job):
+        if job['on_failure'] is None:
+            return
+        try:
+            job['on_failure']()
+        except Exception as e:
+            print(f"Error cleaning up failed job {job['job_id']}: {e}")
+
+    def _notify_finished(self, job):
+        if self.on_finished is None:
+            return
+        try:
+            self.on_finished(job)
+        except Exception as e:
+            print(f"Error in job finished hook: {e}")
+
+    def _expire(self, job):
+        with self._lock:
+            if job['state'] not in ('queued', 'parsing'):
+                return
+            job['state'] = 'failed'
+            job['error'] = f'Parsing timed out after {self.timeout_seconds}s'
+            job['finished_at'] = time.time()
+        self._persist(job)
+        job['done'].set()
+        self._notify_finished(job)
+        if job['future'].cancel() or job['pool'] is None:
+            self._run_on_failure(job)
+        else:
+            self._retire(job)
+
+    def _retire(self, job):
+        """Send new work to a fresh pool and kill the stuck worker once its pool is otherwise idle"""
+        pool = job['pool']
+        with self._lock:
+            previous = pool['state']
+            if previous == 'active':
+                pool['state'] = 'retired'
+                if self._pool is pool:
+                    self._pool = None
+            if previous != 'reaped':
+                pool['stuck'][job['future']] = job
+        if previous == 'reaped':
+            # The reaper already ran; nothing else is waiting on this pool
+            self._kill(job)
+        elif previous == 'active':
+            print(f"Parse job {job['job_id']} timed out in worker {job['pid']}; retiring its pool")
+            threading.Thread(target=self._reap, args=(pool,), name='parse-pool-reaper', daemon=True).start()
+
+    def _reap(self, pool):
+        # Let the pool's other tasks finish, for at most one more job timeout
+        deadline = time.time() + self.timeout_seconds
+        while True:
+            with self._lock:
+                if time.time() >= deadline or all(future in pool['stuck'] for future in pool['futures']):
+                    pool['state'] = 'reaped'
+                    stuck = list(pool['stuck'].values())
+                    break
+            time.sleep(0.5)
+        with self._lock:
+            pending = list(pool['futures'])
+        _cancel(pending)
+        for job in stuck:
+            self._kill(job)
+        # The killed worker breaks the pool, which stops its other workers
+        pool['executor'].shutdown(wait=True)
+
+    def _kill(self, job):
+        try:
+            os.kill(job['pid'], signal.SIGTERM)
+        except OSError:
+            pass
+        self._run_on_failure(job)
+
+    def get(self, job_id, owner):
+        """Return a job of ``owner`` or None; jobs of other processes come from their state files"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            job = self._load_persisted(job_id)
+        if job is None or job['owner'] != owner:
+            return None
+        return job
+
+    def wait(self, job, timeout=None):
+        job['done'].wait(timeout)
+        return job
+
+    def describe(self, job):
+        """JSON-ready status of a job"""
+        now = time.time()
+        with self._lock:
+            position = None
+            if job['state'] == 'queued':
+                position = sum(
+                    1 for other in self._jobs.values()
+                    if other['state'] in ('queued', 'parsing') and other['submitted_at'] < job['submitted_at']
+                )
+            end = job['finished_at'] or now
+            return {
+                'job_id': job['job_id'],
+                'state': job['state'],
+                'queue_position': position,
+                'elapsed_seconds': round(end - job['submitted_at'], 3),
+                'error': job['error'],
+                **job['description']
+            }
+
+    def shutdown(self):
+        # Cancelling runs done callbacks, which take the lock
+        with self._lock:
+            pending = [job['future'] for job in self._jobs.values() if job['future'] is not None]
+            if self._pool is not None:
+                pending.extend(self._pool['futures'])
+        _cancel(pending)
+        if self._coordinators is not None:
+            self._coordinators.shutdown(wait=True)
+        if self._pool is not None:
+            self._pool['executor'].shutdown(wait=True)
+        if self._started is not None:
+            self._started.put(None)
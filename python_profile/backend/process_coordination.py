@@ -0,0 +1,111 @@
+"""Coordination between server processes on one host.
+
+Several server workers (e.g. under gunicorn) share the storage
+directories, so anything that must be agreed on goes through the file
+system: the session signing key is created once and read by everyone,
+and host-wide roles such as the cleanup leader are held through an
+advisory file lock.
+"""
+import os
+import secrets
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+class ProcessLock:
+    """Advisory file lock held by at most one process on the host.
+
+    Once acquired it belongs to the whole process (every thread sees it as
+    held) until released or the process exits, which suits roles like the
+    cleanup leader rather than short critical sections.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self._thread_lock = threading.Lock()
+
+    @property
+    def held(self):
+        return self._fd is not None
+
+    def acquire(self, blocking=True):
+        """Take the lock; returns False if ``blocking`` is False and another holder has it,
+        or if the lock file cannot be opened"""
+        if not self._thread_lock.acquire(blocking):
+            return False
+        if self._fd is not None:
+            # Already held by this process
+            self._thread_lock.release()
+            return True
+        fd = None
+        try:
+            # Fails too when the lock file's directory has been removed
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            else:
+                msvcrt.locking(fd, msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+        except OSError:
+            if fd is not None:
+                os.close(fd)
+            self._thread_lock.release()
+            return False
+        self._fd = fd
+        self._thread_lock.release()
+        return True
+
+    def release(self):
+        with self._thread_lock:
+            if self._fd is None:
+                return
+            try:
+                if fcntl is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+                else:
+                    os.lseek(self._fd, 0, os.SEEK_SET)
+                    msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+            finally:
+                os.close(self._fd)
+                self._fd = None
+
+
+def load_or_create_secret_key(path, length=32):
+    """Read the shared session signing key, creating it if no process has yet.
+
+    The key is written to a temporary file and hard-linked into place, so
+    concurrent first starts agree on a single key and nobody reads a
+    partially written file.
+    """
+    try:
+        with open(path, 'rb') as f:
+            key = f.read()
+        if key:
+            return key
+    except FileNotFoundError:
+        pass
+
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(secrets.token_bytes(length))
+    try:
+        os.link(tmp_path, path)
+    except FileExistsError:
+        pass
+    except OSError:
+        # No hard links on this file system; first rename wins well enough
+        if not os.path.exists(path):
+            os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    with open(path, 'rb') as f:
+        return f.read()
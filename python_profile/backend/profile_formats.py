@@ -0,0 +1,500 @@
+"""Profile file formats and their detection.
+
+Every supported format is registered with a content sniffer and a parser
+that turns the file into a ``pstats.Stats.stats``-shaped dict, which
+ProfileTable.from_entries normalises into the function table. Formats
+are detected from the first bytes of the file, with the file extension
+only as a tie-breaker, and text formats are read line by line so large
+files are never held in memory whole.
+
+Supported: cProfile/profile/yappi pstats dumps, py-spy speedscope JSON,
+collapsed stacks (py-spy, Austin, flamegraph.pl), callgrind (yappi) and
+line_profiler text output or ``.lprof`` files. Pickles are only decoded
+through an allow-list, so uploads can never import arbitrary code.
+
+Sampled formats have no call counts; the number of samples a function
+appears in stands in for its calls.
+"""
+import copyreg
+import json
+import marshal
+import os
+import pickle
+import re
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+SNIFF_BYTES = 64 * 1024
+# Seconds per sample when a sampled format stores counts rather than times (py-spy defaults to 100 Hz)
+DEFAULT_SAMPLE_SECONDS = 0.01
+# Without ijson, speedscope files are loaded whole; refuse anything larger
+MAX_JSON_BYTES = 512 * 1024 * 1024
+
+UNKNOWN_FILE = '<unknown>'
+
+_formats = []
+
+
+class ProfileFormatError(ValueError):
+    """Raised when a file is not in any supported format or is malformed"""
+
+
+class ProfileFormat:
+    """A registered format: ``sniff(head, extension)`` and ``parse(path)`` returning stats entries"""
+
+    def __init__(self, name, extensions, sniff, parse):
+        self.name = name
+        self.extensions = extensions
+        self.sniff = sniff
+        self.parse = parse
+
+
+def register_format(name, extensions, sniff):
+    """Decorator registering ``parse(path)`` as a format; formats are tried in registration order"""
+    def decorator(parse):
+        _formats.append(ProfileFormat(name, tuple(extensions), sniff, parse))
+        return parse
+    return decorator
+
+
+def supported_extensions():
+    return sorted({ext for fmt in _formats for ext in fmt.extensions})
+
+
+def detect_format(path):
+    """The ProfileFormat of a file, judged by its content first and extension second"""
+    with open(path, 'rb') as f:
+        head = f.read(SNIFF_BYTES)
+    extension = os.path.splitext(path)[1].lower().lstrip('.')
+    matches = [fmt for fmt in _formats if fmt.sniff(head, extension)]
+    if not matches:
+        raise ProfileFormatError('Unrecognised profile format')
+    for fmt in matches:
+        if extension in fmt.extensions:
+            return fmt
+    return matches[0]
+
+
+def load_profile_entries(path):
+    """Parse any supported file into (format name, stats entries)"""
+    fmt = detect_format(path)
+    return fmt.name, fmt.parse(path)
+
+
+class StatsAccumulator:
+    """Builds stats entries from functions, edges and sampled stacks"""
+
+    def __init__(self):
+        self.functions = {}  # key -> [primitive calls, calls, tottime, cumtime]
+        self.edges = {}      # (caller, callee) -> [calls, primitive calls, tottime, cumtime]
+
+    def add_function(self, key, calls=0, total_time=0.0, cumulative_time=0.0, primitive_calls=None):
+        stats = self.functions.get(key)
+        if stats is None:
+            stats = self.functions[key] = [0, 0, 0.0, 0.0]
+        stats[0] += calls if primitive_calls is None else primitive_calls
+        stats[1] += calls
+        stats[2] += total_time
+        stats[3] += cumulative_time
+
+    def add_edge(self, caller, callee, calls=0, total_time=0.0, cumulative_time=0.0):
+        stats = self.edges.get((caller, callee))
+        if stats is None:
+            stats = self.edges[(caller, callee)] = [0, 0, 0.0, 0.0]
+        stats[0] += calls
+        stats[1] += calls
+        stats[2] += total_time
+        stats[3] += cumulative_time
+
+    def add_stack(self, frames, seconds, samples=1):
+        """Add one sampled stack (outermost frame first) that lasted ``seconds``"""
+        if not frames:
+            return
+        # Inlined add_function/add_edge: live streams fold thousands of stacks per batch
+        functions, edges = self.functions, self.edges
+        seen = set()
+        seen_edges = set()
+        caller = None
+        for key in frames[:-1]:
+            # Recursive frames count once per sample, as cProfile counts cumulative time once
+            if key not in seen:
+                seen.add(key)
+                stats = functions.get(key)
+                if stats is None:
+                    stats = functions[key] = [0, 0, 0.0, 0.0]
+                stats[0] += samples
+                stats[1] += samples
+                stats[3] += seconds
+            if caller is not None:
+                edge = (caller, key)
+                if edge not in seen_edges:
+                    seen_edges.add(edge)
+                    stats = edges.get(edge)
+                    if stats is None:
+                        stats = edges[edge] = [0, 0, 0.0, 0.0]
+                    stats[0] += samples
+                    stats[1] += samples
+                    stats[3] += seconds
+            caller = key
+        leaf = frames[-1]
+        if leaf not in seen:
+            self.add_function(leaf, samples, seconds, seconds)
+        else:
+            self.add_function(leaf, 0, seconds, 0.0)
+        if caller is not None and (caller, leaf) not in seen_edges:
+            self.add_edge(caller, leaf, samples, seconds, seconds)
+
+    def entries(self):
+        callers = {}
+        for (caller, callee), stats in self.edges.items():
+            callers.setdefault(callee, {})[caller] = tuple(stats)
+            if caller not in self.functions:
+                self.add_function(caller)
+            if callee not in self.functions:
+                self.add_function(callee)
+        return {
+            key: (stats[0], stats[1], stats[2], stats[3], callers.get(key, {}))
+            for key, stats in self.functions.items()
+        }
+
+
+def _text_lines(path):
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            yield line.rstrip('\r\n')
+
+
+def _first_text_lines(head, count=20):
+    text = head.decode('utf-8', errors='replace')
+    return [line for line in text.splitlines()[:count] if line.strip()]
+
+
+# --- cProfile / profile / yappi pstats dumps -------------------------------
+
+def _sniff_pstats(head, extension):
+    # A marshalled dict ('{', optionally with the ref flag) whose first key is a tuple, or an empty dict
+    return len(head) >= 2 and head[0] in (0x7b, 0xfb) and head[1] in (0x28, 0x29, 0xa8, 0xa9, 0x30)
+
+
+@register_format('pstats', ('prof', 'pstats', 'profile'), _sniff_pstats)
+def parse_pstats(path):
+    with open(path, 'rb') as f:
+        entries = marshal.load(f)
+    if not isinstance(entries, dict):
+        raise ProfileFormatError('pstats dump does not contain a stats dict')
+    return entries
+
+
+# --- py-spy speedscope JSON ----------------------------------------------
+
+SPEEDSCOPE_UNITS = {
+    'nanoseconds': 1e-9,
+    'microseconds': 1e-6,
+    'milliseconds': 1e-3,
+    'seconds': 1.0,
+    'none': DEFAULT_SAMPLE_SECONDS,
+}
+
+
+def _sniff_speedscope(head, extension):
+    start = head.lstrip()[:1]
+    return start == b'{' and (b'speedscope' in head or (b'"shared"' in head and b'"profiles"' in head))
+
+
+def _speedscope_frame_key(frame):
+    return (frame.get('file') or UNKNOWN_FILE, int(frame.get('line') or 0), frame.get('name') or '<anonymous>')
+
+
+def _add_speedscope_profile(acc, profile, frames):
+    scale = SPEEDSCOPE_UNITS.get(profile.get('unit', 'none'), DEFAULT_SAMPLE_SECONDS)
+    if profile.get('type') == 'sampled':
+        weights = profile.get('weights') or []
+        for i, stack in enumerate(profile.get('samples') or []):
+            weight = float(weights[i]) if i < len(weights) else 1.0
+            acc.add_stack([frames[int(index)] for index in stack], weight * scale)
+        return
+
+    # Evented: matching open/close events; a frame's own time excludes its children
+    open_frames = []  # [key, opened at, child time]
+    depth = {}
+    for event in profile.get('events') or []:
+        key = frames[int(event['frame'])]
+        at = float(event['at']) * scale
+        if event['type'] == 'O':
+            open_frames.append([key, at, 0.0])
+            depth[key] = depth.get(key, 0) + 1
+            continue
+        if not open_frames:
+            continue
+        key, opened, child_time = open_frames.pop()
+        depth[key] -= 1
+        duration = at - opened
+        recursive = depth[key] > 0
+        acc.add_function(key, 1, duration - child_time, 0.0 if recursive else duration,
+                         primitive_calls=0 if recursive else 1)
+        if open_frames:
+            parent = open_frames[-1]
+            parent[2] += duration
+            acc.add_edge(parent[0], key, 1, duration - child_time, duration)
+
+
+@register_format('speedscope', ('json', 'speedscope'), _sniff_speedscope)
+def parse_speedscope(path):
+    acc = StatsAccumulator()
+    if ijson is not None:
+        # Two streaming passes: the shared frame list, then one profile at a time
+        with open(path, 'rb') as f:
+            frames = [_speedscope_frame_key(frame) for frame in ijson.items(f, 'shared.frames.item')]
+        with open(path, 'rb') as f:
+            for profile in ijson.items(f, 'profiles.item'):
+                _add_speedscope_profile(acc, profile, frames)
+        return acc.entries()
+
+    if os.path.getsize(path) > MAX_JSON_BYTES:
+        raise ProfileFormatError('speedscope file too large to load without the ijson package')
+    with open(path, 'rb') as f:
+        document = json.load(f)
+    frames = [_speedscope_frame_key(frame) for frame in document.get('shared', {}).get('frames', [])]
+    for profile in document.get('profiles', []):
+        _add_speedscope_profile(acc, profile, frames)
+    return acc.entries()
+
+
+# --- Collapsed stacks (py-spy raw, Austin, flamegraph.pl) ------------------
+
+PYSPY_FRAME_RE = re.compile(r'^(?P<name>.+?) \((?P<file>.+?)(?::(?P<line>\d+))?\)$')
+AUSTIN_FRAME_RE = re.compile(r'^(?P<file>.+):(?P<name>[^:]+):(?P<line>\d+)$')
+AUSTIN_META_FRAME_RE = re.compile(r'^(P\d+|T[\w.:]+)$')
+COLLAPSED_LINE_RE = re.compile(r'^\S.* \d+(,-?\d+)*$')
+
+
+def _sniff_collapsed(head, extension):
+    lines = [line for line in _first_text_lines(head) if not line.startswith('#')]
+    if not lines:
+        return head.startswith(b'# austin:')
+    return all(COLLAPSED_LINE_RE.match(line) for line in lines[:10])
+
+
+def _collapsed_frame_key(frame):
+    match = PYSPY_FRAME_RE.match(frame)
+    if match:
+        return (match.group('file'), int(match.group('line') or 0), match.group('name'))
+    match = AUSTIN_FRAME_RE.match(frame)
+    if match:
+        return (match.group('file'), int(match.group('line')), match.group('name'))
+    return (UNKNOWN_FILE, 0, frame)
+
+
+@register_format('collapsed', ('txt', 'collapsed', 'folded', 'austin'), _sniff_collapsed)
+def parse_collapsed(path):
+    acc = StatsAccumulator()
+    frame_keys = {}
+    # Austin writes one line per sample with its duration in microseconds;
+    # other collapsed files aggregate identical stacks into a sample count
+    timed = False
+    for line in _text_lines(path):
+        if not line.strip():
+            continue
+        if line.startswith('#'):
+            if line.startswith('# mode:'):
+                mode = line.split(':', 1)[1].strip()
+                if mode == 'memory':
+                    raise ProfileFormatError('Austin memory profiles are not supported')
+                timed = True
+            continue
+        stack, _, metric = line.rpartition(' ')
+        weight = float(metric.split(',')[0])
+        frames = []
+        for frame in stack.split(';'):
+            if not frame or AUSTIN_META_FRAME_RE.match(frame):
+                continue
+            key = frame_keys.get(frame)
+            if key is None:
+                key = frame_keys[frame] = _collapsed_frame_key(frame)
+            frames.append(key)
+        if timed:
+            acc.add_stack(frames, weight * 1e-6)
+        else:
+            acc.add_stack(frames, weight * DEFAULT_SAMPLE_SECONDS, samples=int(weight))
+    return acc.entries()
+
+
+# --- callgrind (yappi) -----------------------------------------------------
+
+CALLGRIND_NAME_RE = re.compile(r'^\((?P<id>\d+)\)(?: (?P<name>.*))?$')
+YAPPI_FUNCTION_RE = re.compile(r'^(?P<name>.+) (?P<file>.+):(?P<line>\d+)$')
+# yappi writes times in microseconds
+CALLGRIND_SECONDS_PER_TICK = 1e-6
+
+
+def _sniff_callgrind(head, extension):
+    lines = _first_text_lines(head, 40)
+    return any(line.startswith(('events:', '# callgrind format')) for line in lines) and \
+        any(line.startswith(('fn=', 'fl=')) for line in head.decode('utf-8', errors='replace').splitlines())
+
+
+@register_format('callgrind', ('callgrind', 'out'), _sniff_callgrind)
+def parse_callgrind(path):
+    files, names = {}, {}
+
+    def resolve(table, value):
+        match = CALLGRIND_NAME_RE.match(value)
+        if not match:
+            return value
+        if match.group('name') is not None:
+            table[match.group('id')] = match.group('name')
+        return table.get(match.group('id'), value)
+
+    def function_key(filename, name, line):
+        match = YAPPI_FUNCTION_RE.match(name)
+        if match:
+            return (match.group('file'), int(match.group('line')), match.group('name'))
+        return (filename or UNKNOWN_FILE, line, name)
+
+    acc = StatsAccumulator()
+    incoming = {}
+    current_file = call_file = None
+    current = None
+    pending_call = None  # (callee name, call count)
+    for line in _text_lines(path):
+        if not line or line.startswith('#'):
+            continue
+        key, sep, value = line.partition('=')
+        if sep and key in ('fl', 'fi', 'fe'):
+            current_file = call_file = resolve(files, value)
+        elif sep and key == 'fn':
+            current = resolve(names, value)
+            call_file = current_file
+        elif sep and key in ('cfl', 'cfi'):
+            call_file = resolve(files, value)
+        elif sep and key == 'cfn':
+            pending_call = [resolve(names, value), 0]
+        elif sep and key == 'calls':
+            if pending_call is not None:
+                pending_call[1] = int(value.split()[0])
+        elif line[0].isdigit() or line[0] in '+-*':
+            parts = line.split()
+            if current is None or len(parts) < 2:
+                continue
+            position = int(parts[0]) if parts[0].isdigit() else 0
+            cost = int(parts[1]) * CALLGRIND_SECONDS_PER_TICK
+            caller = function_key(current_file, current, position)
+            if pending_call is not None:
+                callee = function_key(call_file, pending_call[0], 0)
+                acc.add_edge(caller, callee, pending_call[1], 0.0, cost)
+                acc.add_function(caller, 0, 0.0, cost)
+                acc.add_function(callee)
+                incoming[callee] = incoming.get(callee, 0) + pending_call[1]
+                pending_call = None
+                call_file = current_file
+            else:
+                acc.add_function(caller, 0, cost, cost)
+
+    # Call counts come from the callers' calls= lines; functions nobody calls ran once
+    for key, stats in acc.functions.items():
+        calls = incoming.get(key, 1)
+        stats[0] = stats[1] = calls
+    return acc.entries()
+
+
+# --- line_profiler ---------------------------------------------------------
+
+LP_TIMER_RE = re.compile(r'^Timer unit:\s*(?P<unit>[\d.eE+-]+)\s*s')
+LP_FILE_RE = re.compile(r'^File:\s*(?P<file>.+)$')
+LP_FUNCTION_RE = re.compile(r'^Function:\s*(?P<name>.+?) at line (?P<line>\d+)')
+LP_ROW_RE = re.compile(r'^\s*(?P<line>\d+)\s+(?P<hits>\d+)\s+(?P<time>[\d.eE+-]+)\s')
+
+
+class _LineStats:
+    """Stand-in for line_profiler.LineStats when decoding .lprof pickles"""
+
+
+# The only classes a pickle may reference; anything else is refused
+SAFE_PICKLE_CLASSES = {
+    ('line_profiler.line_profiler', 'LineStats'): _LineStats,
+    ('line_profiler._line_profiler', 'LineStats'): _LineStats,
+    ('copyreg', '_reconstructor'): copyreg._reconstructor,
+    ('builtins', 'object'): object,
+    # Protocol 0-2 pickles spell these with their Python 2 module names
+    ('copy_reg', '_reconstructor'): copyreg._reconstructor,
+    ('__builtin__', 'object'): object,
+}
+
+
+class SafeUnpickler(pickle.Unpickler):
+    """Decodes plain data (dicts, lists, tuples, numbers, strings) and LineStats only"""
+
+    def find_class(self, module, name):
+        cls = SAFE_PICKLE_CLASSES.get((module, name))
+        if cls is None:
+            raise pickle.UnpicklingError(f'Refusing to load {module}.{name} from an uploaded pickle')
+        return cls
+
+
+def _line_profiler_entries(timings, unit):
+    """Entries from line_profiler timings: {(file, line, name): [(lineno, hits, ticks), ...]}"""
+    acc = StatsAccumulator()
+    for (filename, line, name), rows in timings.items():
+        if not rows:
+            continue
+        seconds = sum(row[2] for row in rows) * unit
+        # The first executed line runs once per call
+        calls = min(rows, key=lambda row: row[0])[1]
+        acc.add_function((filename, int(line), name), calls, seconds, seconds)
+    return acc.entries()
+
+
+def _sniff_line_profiler(head, extension):
+    return head.lstrip().startswith(b'Timer unit:')
+
+
+@register_format('line_profiler', ('lprof', 'txt'), _sniff_line_profiler)
+def parse_line_profiler_text(path):
+    timings = {}
+    unit = 1e-6
+    filename = None
+    current = None
+    for line in _text_lines(path):
+        match = LP_TIMER_RE.match(line)
+        if match:
+            unit = float(match.group('unit'))
+            continue
+        match = LP_FILE_RE.match(line)
+        if match:
+            filename = match.group('file').strip()
+            continue
+        match = LP_FUNCTION_RE.match(line)
+        if match:
+            current = timings.setdefault((filename or UNKNOWN_FILE, int(match.group('line')), match.group('name')), [])
+            continue
+        match = LP_ROW_RE.match(line)
+        if match and current is not None:
+            current.append((int(match.group('line')), int(match.group('hits')), float(match.group('time'))))
+    # Row times are printed in timer units
+    return _line_profiler_entries(timings, unit)
+
+
+# --- Pickles (.lprof, pickled stats dicts) ---------------------------------
+
+def _sniff_pickle(head, extension):
+    # Protocol 2+ starts with PROTO; older pickles are accepted by extension only
+    return head[:1] == b'\x80' or (extension in ('pkl', 'pickle', 'lprof') and head[:1] in (b'(', b'}', b']', b'c'))
+
+
+@register_format('pickle', ('pkl', 'pickle', 'lprof'), _sniff_pickle)
+def parse_pickle(path):
+    with open(path, 'rb') as f:
+        try:
+            data = SafeUnpickler(f).load()
+        except (pickle.UnpicklingError, EOFError, AttributeError, ValueError, TypeError) as e:
+            raise ProfileFormatError(f'Unsupported pickle: {e}')
+
+    if isinstance(data, _LineStats):
+        return _line_profiler_entries(getattr(data, 'timings', {}), float(getattr(data, 'unit', 1e-6)))
+    if isinstance(data, dict) and all(isinstance(key, tuple) and len(key) == 3 for key in data):
+        # A pickled pstats.Stats.stats dict
+        return data
+    raise ProfileFormatError(f'Unsupported pickle content: {type(data).__name__}')
@@ -0,0 +1,180 @@
+"""Merging many profile dumps into one aggregate profile.
+
+This is ``pstats.Stats.add`` on columnar tables: functions are matched by
+(filename, line, function name) and their counts and times summed, and
+call-graph edges are matched by (caller, callee) and summed the same way.
+Large batches are reduced as a tree: each worker parses and merges one
+chunk of dumps, then the partial tables are merged pairwise, level by
+level, until one table is left.
+"""
+import os
+import shutil
+
+import numpy as np
+
+from call_graph import CallGraph
+from function_index import FunctionIndex
+from profile_parser import parse_table, summarize_table
+from profile_table import CATEGORIES, TABLE_SUFFIX, ProfileTable, StringTable
+from profile_views import ProfileViews
+
+# Tables a leaf worker holds before folding them into its running total
+LEAF_MERGE_BATCH = 8
+# Leaf chunks per worker; a few more than one keeps the pool busy when dumps differ in size
+CHUNKS_PER_WORKER = 2
+
+
+def _summed(inverse, values, count):
+    return np.bincount(inverse, weights=values, minlength=count)
+
+
+def merge_tables(tables):
+    """Merge tables into one, summing calls and times of matching functions and edges"""
+    tables = [table for table in tables if len(table)]
+    if not tables:
+        return ProfileTable.empty()
+    if len(tables) == 1:
+        return tables[0]
+
+    global_ids = {}
+    strings = []
+    keys = []
+    for table in tables:
+        local = [table.strings.get(i) for i in range(len(table.strings))]
+        for value in local:
+            if value not in global_ids:
+                global_ids[value] = len(strings)
+                strings.append(value)
+        mapping = np.fromiter((global_ids[value] for value in local), dtype=np.int64, count=len(local))
+        keys.append(np.stack([
+            mapping[table.filename_id],
+            table.line_number.astype(np.int64),
+            mapping[table.name_id]
+        ], axis=1))
+
+    all_keys = np.concatenate(keys)
+    unique_keys, first, inverse = np.unique(all_keys, axis=0, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    count = len(unique_keys)
+
+    def concat(name):
+        return np.concatenate([getattr(table, name) for table in tables])
+
+    merged_graph = None
+    graphs = [(p, table.graph) for p, table in enumerate(tables) if table.graph is not None]
+    if graphs:
+        offsets = np.concatenate([[0], np.cumsum([len(table) for table in tables])])
+        caller = np.concatenate([inverse[offsets[p]:offsets[p + 1]][graph.caller] for p, graph in graphs])
+        callee = np.concatenate([inverse[offsets[p]:offsets[p + 1]][graph.callee] for p, graph in graphs])
+        edge_keys, edge_inverse = np.unique(caller * count + callee, return_inverse=True)
+        edge_count = len(edge_keys)
+
+        def edge_sum(name):
+            values = np.concatenate([getattr(graph, name) for _, graph in graphs])
+            return _summed(edge_inverse, values, edge_count)
+
+        merged_graph = CallGraph.from_edges(
+            count, edge_keys // count, edge_keys % count,
+            np.rint(edge_sum('calls')).astype(np.int64),
+            edge_sum('total_time'), edge_sum('cumulative_time')
+        )
+
+    return ProfileTable(
+        StringTable.from_strings(strings),
+        unique_keys[:, 0].astype(np.int32),
+        unique_keys[:, 2].astype(np.int32),
+        unique_keys[:, 1].astype(np.int32),
+        np.rint(_summed(inverse, concat('calls'), count)).astype(np.int64),
+        np.rint(_summed(inverse, concat('ncalls'), count)).astype(np.int64),
+        _summed(inverse, concat('total_time'), count),
+        _summed(inverse, concat('cumulative_time'), count),
+        concat('category')[first],
+        concat('flags')[first],
+        graph=merged_graph
+    )
+
+
+def merge_dump_files(paths, output_path):
+    """Parse profile files and merge them into the table at ``output_path`` (a leaf of the tree).
+
+    Returns (output path or None if nothing parsed, [(path, error), ...]).
+    """
+    merged = None
+    pending = []
+    errors = []
+    for path in paths:
+        try:
+            pending.append(parse_table(path)[1])
+        except TimeoutError:
+            raise
+        except Exception as e:
+            errors.append((path, str(e)))
+            continue
+        if len(pending) >= LEAF_MERGE_BATCH:
+            merged = merge_tables(([merged] if merged is not None else []) + pending)
+            pending = []
+    if pending:
+        merged = merge_tables(([merged] if merged is not None else []) + pending)
+    if merged is None:
+        return None, errors
+    merged.save(output_path)
+    return output_path, errors
+
+
+def merge_table_files(paths, output_path):
+    """Merge saved tables into ``output_path`` (an inner node of the tree), removing the inputs"""
+    merged = merge_tables([ProfileTable.load(path) for path in paths])
+    merged.save(output_path)
+    for path in paths:
+        os.remove(path)
+    return output_path
+
+
+def merge_profile_dumps(submit, paths, work_dir, output_path, workers):
+    """Tree-reduce profile files into one table at ``output_path``.
+
+    ``submit(fn, *args)`` schedules work on the process pool and returns a
+    future. ``work_dir`` holds the dumps and intermediate tables and is
+    removed once the merge finishes. Returns the slot summary of the
+    aggregate with the merge counts added.
+    """
+    try:
+        chunk_count = max(1, min(len(paths), workers * CHUNKS_PER_WORKER))
+        chunks = [paths[i::chunk_count] for i in range(chunk_count)]
+        leaves = [
+            submit(merge_dump_files, chunk, os.path.join(work_dir, f"leaf_{i}{TABLE_SUFFIX}"))
+            for i, chunk in enumerate(chunks)
+        ]
+
+        level = []
+        failed_files = []
+        for future in leaves:
+            table_path, errors = future.result()
+            failed_files.extend(errors)
+            if table_path:
+                level.append(table_path)
+        if not level:
+            raise ValueError('None of the uploaded files could be parsed')
+
+        depth = 0
+        while len(level) > 1:
+            depth += 1
+            futures = [
+                submit(merge_table_files, level[i:i + 2], os.path.join(work_dir, f"merge_{depth}_{i}{TABLE_SUFFIX}"))
+                for i in range(0, len(level) - 1, 2)
+            ]
+            carried = [level[-1]] if len(level) % 2 else []
+            level = [future.result() for future in futures] + carried
+
+        merged = ProfileTable.load(level[0])
+        merged.index = FunctionIndex.build(merged)
+        merged.views = ProfileViews.build(merged, len(CATEGORIES))
+        merged.save(output_path)
+        profile_data = summarize_table(merged)
+        profile_data['merged_file_count'] = len(paths) - len(failed_files)
+        profile_data['failed_files'] = [
+            {'filename': os.path.basename(path), 'error': error} for path, error in failed_files
+        ]
+        return profile_data
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
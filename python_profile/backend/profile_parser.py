@@ -0,0 +1,96 @@
+"""Profile file parsing.
+
+Kept free of Flask and app state so it can run inside parse worker
+processes.
+"""
+import time
+
+from function_categories import categorize_function
+from function_index import FunctionIndex
+from profile_formats import load_profile_entries
+from profile_table import CATEGORIES, ProfileTable
+from profile_views import ProfileViews
+
+# Number of functions embedded in the slot summary; the full table is paged via /api/profiles/<slot>/functions
+SUMMARY_FUNCTION_COUNT = 50
+
+
+def summarize_table(table, total_calls=None, total_time=None):
+    """Slot summary of a table: totals plus the top functions by cumulative time"""
+    return {
+        'total_calls': int(table.ncalls.sum()) if total_calls is None else total_calls,
+        'total_time': float(table.total_time.sum()) if total_time is None else total_time,
+        'function_count': len(table),
+        'functions': table.rows(table.top('cumulative_time', SUMMARY_FUNCTION_COUNT))
+    }
+
+
+def parse_table(filepath):
+    """Parse a profile in any supported format into (format name, ProfileTable)"""
+    format_name, entries = load_profile_entries(filepath)
+    return format_name, ProfileTable.from_entries(entries, categorize_function)
+
+
+def table_profile_data(table, format_name, table_path=None):
+    """Slot summary of a table, saving the table with its search index and views to ``table_path``"""
+    profile_data = summarize_table(table)
+    profile_data['format'] = format_name
+    if table_path:
+        table.index = FunctionIndex.build(table)
+        table.views = ProfileViews.build(table, len(CATEGORIES))
+        table.save(table_path)
+    return profile_data
+
+
+def parse_profile_file(filepath, table_path=None):
+    """Parse different types of Python profiling files
+
+    The format is detected from the file content (see profile_formats).
+    Every function is kept in a columnar ProfileTable written to
+    ``table_path``; the returned summary embeds only the top functions by
+    cumulative time.
+    """
+    try:
+        format_name, table = parse_table(filepath)
+        return table_profile_data(table, format_name, table_path)
+
+    except TimeoutError:
+        # The job timeout (run_with_timeout) must fail the job, not become a parse error
+        raise
+    except Exception as e:
+        return {
+            'error': f'Could not parse profile file: {str(e)}',
+            'total_calls': 0,
+            'total_time': 0,
+            'functions': []
+        }
+
+
+def parse_profile_file_timed(filepath, table_path=None):
+    """parse_profile_file plus the seconds it took"""
+    started = time.perf_counter()
+    profile_data = parse_profile_file(filepath, table_path)
+    return profile_data, time.perf_counter() - started
+
+
+def parse_profile_batch(submit, items):
+    """Parse many (filepath, table_path) pairs in parallel.
+
+    ``submit(fn, *args)`` schedules work on the pool as in
+    profile_merge.merge_profile_dumps. Returns (profile data, parse
+    seconds) per item in input order; a task that fails or times out gets
+    an error summary instead of failing the whole batch.
+    """
+    futures = [submit(parse_profile_file_timed, filepath, table_path) for filepath, table_path in items]
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            results.append(({
+                'error': f'Could not parse profile file: {str(e) or type(e).__name__}',
+                'total_calls': 0,
+                'total_time': 0,
+                'functions': []
+            }, None))
+    return results
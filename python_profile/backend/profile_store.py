@@ -0,0 +1,255 @@
+"""Per-session profile storage.
+
+Each session owns one small SQLite database under the storage directory,
+with one row per profile slot. Rows hold the slot record as zlib
+compressed compact JSON, so writing slot 3 never re-serialises slots 1
+and 2, plus a small JSON summary so listings never decode whole records.
+Writes go through a lock private to the session, so sessions never queue
+behind each other, and every write is a single SQLite transaction so
+readers see either the old or the new slot, never a partial file.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import closing, contextmanager
+
+DB_SUFFIX = '.db'
+LEGACY_SUFFIX = '.json'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS slots (
+    slot TEXT PRIMARY KEY,
+    record BLOB NOT NULL,
+    updated_at REAL NOT NULL,
+    summary TEXT
+)
+"""
+
+
+def encode_record(record):
+    return zlib.compress(json.dumps(record, separators=(',', ':')).encode('utf-8'), 1)
+
+
+def decode_record(blob):
+    return json.loads(zlib.decompress(blob).decode('utf-8'))
+
+
+class ProfileStore:
+    """Slot records for every session, one SQLite file per session"""
+
+    def __init__(self, root, summarize=None):
+        """``summarize(record)`` builds the summary stored next to each record"""
+        self.root = root
+        self.summarize = summarize
+        self._upgraded = set()
+        # session id -> [lock, threads holding or waiting for it]
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        self.lock_wait_seconds = 0.0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        os.makedirs(root, exist_ok=True)
+
+    def db_path(self, session_id):
+        return os.path.join(self.root, f"{session_id}{DB_SUFFIX}")
+
+    @contextmanager
+    def _locked(self, session_id):
+        with self._locks_guard:
+            entry = self._locks.get(session_id)
+            if entry is None:
+                entry = self._locks[session_id] = [threading.Lock(), 0]
+            entry[1] += 1
+        started = time.perf_counter()
+        try:
+            with entry[0]:
+                self.lock_wait_seconds += time.perf_counter() - started
+                yield
+        finally:
+            with self._locks_guard:
+                entry[1] -= 1
+
+    def _connect(self, session_id, create=True):
+        path = self.db_path(session_id)
+        if not create and not os.path.exists(path):
+            return None
+        conn = sqlite3.connect(path, timeout=30)
+        conn.execute(SCHEMA)
+        if path not in self._upgraded:
+            # Databases written before summaries existed lack the column
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(slots)")}
+            if 'summary' not in columns:
+                conn.execute("ALTER TABLE slots ADD COLUMN summary TEXT")
+                conn.commit()
+            self._upgraded.add(path)
+        return conn
+
+    def _summary_json(self, record):
+        if self.summarize is None:
+            return None
+        return json.dumps(self.summarize(record), separators=(',', ':'))
+
+    def _row(self, slot, record):
+        return (slot, encode_record(record), time.time(), self._summary_json(record))
+
+    def _decode_summary(self, summary, blob):
+        if summary is not None:
+            return json.loads(summary)
+        # Rows stored before summaries existed fall back to the full record
+        self.bytes_read += len(blob)
+        record = decode_record(blob)
+        return self.summarize(record) if self.summarize else record
+
+    def _migrate_legacy(self, session_id):
+        """Import a pre-SQLite <session>.json file into the session database"""
+        legacy_path = os.path.join(self.root, f"{session_id}{LEGACY_SUFFIX}")
+        if not os.path.exists(legacy_path):
+            return
+        try:
+            with open(legacy_path, 'r') as f:
+                profiles = json.load(f)
+            with closing(self._connect(session_id)) as conn, conn:
+                now = time.time()
+                conn.executemany(
+                    "INSERT OR REPLACE INTO slots (slot, record, updated_at, summary) VALUES (?, ?, ?, ?)",
+                    [(slot, encode_record(record), now, self._summary_json(record))
+                     for slot, record in profiles.items()]
+                )
+            os.remove(legacy_path)
+            print(f"Migrated legacy profile data for session {session_id}")
+        except (OSError, ValueError, sqlite3.Error) as e:
+            print(f"Error migrating legacy profile data {legacy_path}: {e}")
+
+    def load_all(self, session_id):
+        """Return {slot: record} for a session"""
+        with self._locked(session_id):
+            self._migrate_legacy(session_id)
+            conn = self._connect(session_id, create=False)
+            if conn is None:
+                return {}
+            with closing(conn):
+                rows = conn.execute("SELECT slot, record FROM slots ORDER BY slot").fetchall()
+        self.bytes_read += sum(len(blob) for _, blob in rows)
+        return {slot: decode_record(blob) for slot, blob in rows}
+
+    def get(self, session_id, slot):
+        with self._locked(session_id):
+            self._migrate_legacy(session_id)
+            conn = self._connect(session_id, create=False)
+            if conn is None:
+                return None
+            with closing(conn):
+                row = conn.execute("SELECT record FROM slots WHERE slot = ?", (slot,)).fetchone()
+        if row:
+            self.bytes_read += len(row[0])
+        return decode_record(row[0]) if row else None
+
+    def load_summaries(self, session_id):
+        """Return {slot: summary} for a session without decoding full records"""
+        with self._locked(session_id):
+            self._migrate_legacy(session_id)
+            conn = self._connect(session_id, create=False)
+            if conn is None:
+                return {}
+            with closing(conn):
+                rows = conn.execute(
+                    "SELECT slot, summary, CASE WHEN summary IS NULL THEN record END FROM slots ORDER BY slot"
+                ).fetchall()
+        return {slot: self._decode_summary(summary, blob) for slot, summary, blob in rows}
+
+    def get_summary(self, session_id, slot):
+        with self._locked(session_id):
+            self._migrate_legacy(session_id)
+            conn = self._connect(session_id, create=False)
+            if conn is None:
+                return None
+            with closing(conn):
+                row = conn.execute(
+                    "SELECT summary, CASE WHEN summary IS NULL THEN record END FROM slots WHERE slot = ?",
+                    (slot,)
+                ).fetchone()
+        return self._decode_summary(*row) if row else None
+
+    def count(self, session_id):
+        with self._locked(session_id):
+            self._migrate_legacy(session_id)
+            conn = self._connect(session_id, create=False)
+            if conn is None:
+                return 0
+            with closing(conn):
+                return conn.execute("SELECT COUNT(*) FROM slots").fetchone()[0]
+
+    def put(self, session_id, slot, record):
+        """Insert or replace a single slot; returns the record it replaced, or None"""
+        return self.put_many(session_id, {slot: record}).get(slot)
+
+    def put_many(self, session_id, records):
+        """Insert or replace several slots in one transaction; returns {slot: replaced record}"""
+        rows = [self._row(slot, record) for slot, record in records.items()]
+        self.bytes_written += sum(len(row[1]) for row in rows)
+        with self._locked(session_id):
+            self._migrate_legacy(session_id)
+            with closing(self._connect(session_id)) as conn, conn:
+                replaced = conn.execute(
+                    f"SELECT slot, record FROM slots WHERE slot IN ({','.join('?' * len(rows))})",
+                    [row[0] for row in rows]
+                ).fetchall() if rows else []
+                conn.executemany(
+                    "INSERT OR REPLACE INTO slots (slot, record, updated_at, summary) VALUES (?, ?, ?, ?)",
+                    rows
+                )
+        self.bytes_read += sum(len(blob) for _, blob in replaced)
+        return {slot: decode_record(blob) for slot, blob in replaced}
+
+    def replace_all(self, session_id, profiles):
+        """Make the session hold exactly ``profiles``, in one transaction"""
+        rows = [self._row(slot, record) for slot, record in profiles.items()]
+        self.bytes_written += sum(len(row[1]) for row in rows)
+        with self._locked(session_id):
+            self._migrate_legacy(session_id)
+            with closing(self._connect(session_id)) as conn, conn:
+                conn.execute("DELETE FROM slots")
+                conn.executemany(
+                    "INSERT INTO slots (slot, record, updated_at, summary) VALUES (?, ?, ?, ?)",
+                    rows
+                )
+
+    def delete(self, session_id, slot):
+        with self._locked(session_id):
+            conn = self._connect(session_id, create=False)
+            if conn is None:
+                return
+            with closing(conn), conn:
+                conn.execute("DELETE FROM slots WHERE slot = ?", (slot,))
+
+    def delete_session(self, session_id):
+        """Remove all stored slots of a session"""
+        with self._locked(session_id):
+            for suffix in (DB_SUFFIX, f"{DB_SUFFIX}-journal", LEGACY_SUFFIX):
+                path = os.path.join(self.root, f"{session_id}{suffix}")
+                if os.path.exists(path):
+                    os.remove(path)
+        with self._locks_guard:
+            # Threads still queued on the lock must keep sharing it
+            entry = self._locks.get(session_id)
+            if entry is not None and entry[1] == 0:
+                del self._locks[session_id]
+
+    def session_ids(self):
+        """Ids of every session with stored profiles"""
+        ids = set()
+        for filename in os.listdir(self.root):
+            for suffix in (DB_SUFFIX, LEGACY_SUFFIX):
+                if filename.endswith(suffix):
+                    ids.add(filename[:-len(suffix)])
+        return sorted(ids)
+
+    def last_modified(self, session_id):
+        for suffix in (DB_SUFFIX, LEGACY_SUFFIX):
+            path = os.path.join(self.root, f"{session_id}{suffix}")
+            if os.path.exists(path):
+                return os.path.getmtime(path)
+        return None
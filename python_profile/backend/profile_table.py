@@ -0,0 +1,424 @@
+"""Columnar function table for parsed profiles.
+
+Every function from a pstats dump is kept as one row spread over NumPy
+columns. Filenames and function names are interned into a single string
+table so each row only carries integer ids.
+
+Tables are saved as one file: a small JSON header giving the dtype,
+offset and length of every column, followed by the fixed-width columns
+themselves, each aligned to 64 bytes. Loading memory-maps the file and
+wraps each column in place, so a request pays only for the pages of the
+rows and columns it actually reads, and the page cache rather than each
+process holds the data.
+"""
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from call_graph import CallGraph
+from function_index import FunctionIndex
+from profile_views import ProfileViews
+
+CATEGORIES = ('user', 'builtin', 'stdlib', 'third_party')
+
+FLAG_BUILTIN = 1
+FLAG_STDLIB = 2
+FLAG_THIRD_PARTY = 4
+
+# Public column names plus the pstats-style aliases accepted for sorting
+SORT_COLUMNS = (
+    'calls', 'ncalls', 'total_time', 'cumulative_time', 'per_call',
+    'line_number', 'filename', 'function_name', 'name', 'category'
+)
+SORT_ALIASES = {
+    'cumulative': 'cumulative_time',
+    'cumtime': 'cumulative_time',
+    'tottime': 'total_time',
+    'time': 'total_time',
+    'percall': 'per_call',
+    'line': 'line_number',
+    'file': 'filename',
+}
+
+
+FULL_NAME_RE = re.compile(r'^(.*):(\d+)\((.*)\)$')
+
+TABLE_SUFFIX = '.ptab'
+TABLE_MAGIC = b'PROFTAB1'
+TABLE_HEADER = struct.Struct('<8sI')
+TABLE_ALIGNMENT = 64
+NPZ_MAGIC = b'PK'
+
+
+def _aligned(offset):
+    return -(-offset // TABLE_ALIGNMENT) * TABLE_ALIGNMENT
+
+
+def write_table_file(path, arrays):
+    """Write 1-d ``arrays`` (name -> array) as a header plus aligned little-endian columns"""
+    columns = {}
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        array = np.asarray(array)
+        array = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder('<')).reshape(-1)
+        columns[name] = (offset, array)
+        layout[name] = [array.dtype.str, offset, len(array)]
+        offset = _aligned(offset + array.nbytes)
+    header = json.dumps({'arrays': layout}, separators=(',', ':')).encode('utf-8')
+    data_start = _aligned(TABLE_HEADER.size + len(header))
+
+    with open(path, 'wb') as f:
+        f.write(TABLE_HEADER.pack(TABLE_MAGIC, len(header)))
+        f.write(header)
+        for column_offset, array in columns.values():
+            f.seek(data_start + column_offset)
+            f.write(memoryview(array).cast('B'))
+        f.truncate(data_start + offset)
+
+
+def map_table_file(path):
+    """Memory-map a file written by write_table_file; returns name -> read-only array views"""
+    with open(path, 'rb') as f:
+        magic, header_length = TABLE_HEADER.unpack(f.read(TABLE_HEADER.size))
+        if magic != TABLE_MAGIC:
+            raise ValueError(f'{path} is not a profile table')
+        header = json.loads(f.read(header_length))
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    data_start = _aligned(TABLE_HEADER.size + header_length)
+    # Each view keeps the mapping alive; it is unmapped once the last view goes away
+    return {
+        name: np.frombuffer(mapped, dtype=np.dtype(dtype), count=count, offset=data_start + offset)
+        for name, (dtype, offset, count) in header['arrays'].items()
+    }
+
+
+def resolve_sort_column(column):
+    """Map a user supplied sort key onto a table column, or None if unknown"""
+    column = SORT_ALIASES.get(column, column)
+    return column if column in SORT_COLUMNS else None
+
+
+class StringTable:
+    """Interned strings packed as utf-8 bytes plus offsets"""
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+        self._decoded = {}
+        self._ranks = None
+        self._ids = None
+
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [s.encode('utf-8', 'surrogateescape') for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        if encoded:
+            np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        return cls(data, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get(self, string_id):
+        string_id = int(string_id)
+        value = self._decoded.get(string_id)
+        if value is None:
+            start, end = self.offsets[string_id], self.offsets[string_id + 1]
+            value = bytes(self.data[start:end]).decode('utf-8', 'surrogateescape')
+            self._decoded[string_id] = value
+        return value
+
+    def index_of(self, value):
+        """Id of an interned string, or None"""
+        if self._ids is None:
+            self._ids = {self.get(i): i for i in range(len(self))}
+        return self._ids.get(value)
+
+    def ranks(self):
+        """Rank of every string id in lexical order, used for sorting by name"""
+        if self._ranks is None:
+            order = sorted(range(len(self)), key=self.get)
+            ranks = np.empty(len(self), dtype=np.int64)
+            ranks[order] = np.arange(len(self), dtype=np.int64)
+            self._ranks = ranks
+        return self._ranks
+
+
+class ProfileTable:
+    """All functions of one profile as parallel NumPy columns"""
+
+    NUMERIC_COLUMNS = (
+        'filename_id', 'name_id', 'line_number', 'calls', 'ncalls',
+        'total_time', 'cumulative_time', 'category', 'flags'
+    )
+
+    def __init__(self, strings, filename_id, name_id, line_number, calls,
+                 ncalls, total_time, cumulative_time, category, flags, graph=None, index=None, views=None):
+        self.strings = strings
+        self.filename_id = filename_id
+        self.name_id = name_id
+        self.line_number = line_number
+        self.calls = calls
+        self.ncalls = ncalls
+        self.total_time = total_time
+        self.cumulative_time = cumulative_time
+        self.category = category
+        self.flags = flags
+        self.graph = graph
+        self.index = index
+        self.views = views
+        self._orders = {}
+
+    @classmethod
+    def from_stats(cls, stats, categorize):
+        """Build a table from a pstats.Stats object.
+
+        ``categorize(filename, function_name)`` must return a
+        ``(category, is_builtin, is_stdlib, is_third_party)`` tuple.
+        """
+        return cls.from_entries(stats.stats, categorize)
+
+    @classmethod
+    def from_entries(cls, entries, categorize):
+        """Build a table from a ``pstats.Stats.stats``-shaped dict:
+        ``{(filename, line, name): (cc, nc, tt, ct, callers)}``"""
+        count = len(entries)
+
+        interned = {}
+        strings = []
+
+        def intern(value):
+            string_id = interned.get(value)
+            if string_id is None:
+                string_id = interned[value] = len(strings)
+                strings.append(value)
+            return string_id
+
+        filename_id = np.empty(count, dtype=np.int32)
+        name_id = np.empty(count, dtype=np.int32)
+        line_number = np.empty(count, dtype=np.int32)
+        calls = np.empty(count, dtype=np.int64)
+        ncalls = np.empty(count, dtype=np.int64)
+        total_time = np.empty(count, dtype=np.float64)
+        cumulative_time = np.empty(count, dtype=np.float64)
+        category = np.empty(count, dtype=np.int8)
+        flags = np.empty(count, dtype=np.uint8)
+
+        row_of = {}
+        category_index = {name: i for i, name in enumerate(CATEGORIES)}
+        for row, (func_key, func_stats) in enumerate(entries.items()):
+            row_of[func_key] = row
+            filename, line, function_name = func_key
+            filename_id[row] = intern(filename)
+            name_id[row] = intern(function_name)
+            line_number[row] = line
+            calls[row] = func_stats[0]
+            ncalls[row] = func_stats[1]
+            total_time[row] = func_stats[2]
+            cumulative_time[row] = func_stats[3]
+
+            func_category, is_builtin, is_stdlib, is_third_party = categorize(filename, function_name)
+            category[row] = category_index[func_category]
+            flags[row] = (
+                (FLAG_BUILTIN if is_builtin else 0) |
+                (FLAG_STDLIB if is_stdlib else 0) |
+                (FLAG_THIRD_PARTY if is_third_party else 0)
+            )
+
+        return cls(StringTable.from_strings(strings), filename_id, name_id,
+                   line_number, calls, ncalls, total_time, cumulative_time,
+                   category, flags, graph=CallGraph.from_stats(entries, row_of))
+
+    @classmethod
+    def empty(cls):
+        """A table with no functions, for profiles that could not be parsed"""
+        return cls(StringTable.from_strings([]),
+                   *(np.empty(0, dtype=dtype) for dtype in (
+                       np.int32, np.int32, np.int32, np.int64, np.int64,
+                       np.float64, np.float64, np.int8, np.uint8)))
+
+    def __len__(self):
+        return len(self.calls)
+
+    def save(self, path):
+        """Write the table to ``path`` atomically in the memory-mappable layout"""
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        write_table_file(tmp_path, {
+            'string_data': self.strings.data,
+            'string_offsets': self.strings.offsets,
+            **{name: getattr(self, name) for name in self.NUMERIC_COLUMNS},
+            **(self.graph.arrays() if self.graph is not None else {}),
+            **(self.index.arrays() if self.index is not None else {}),
+            **(self.views.arrays() if self.views is not None else {})
+        })
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Map a saved table; columns are read-only views of the file"""
+        with open(path, 'rb') as f:
+            magic = f.read(len(NPZ_MAGIC))
+        if magic == NPZ_MAGIC:
+            # Tables saved as .npz before the mapped layout existed
+            with np.load(path, allow_pickle=False) as archive:
+                arrays = {name: archive[name] for name in archive.files}
+        else:
+            arrays = map_table_file(path)
+        strings = StringTable(arrays['string_data'], arrays['string_offsets'])
+        columns = {name: arrays[name] for name in cls.NUMERIC_COLUMNS}
+        return cls(strings, graph=CallGraph.from_arrays(arrays),
+                   index=FunctionIndex.from_arrays(arrays), views=ProfileViews.from_arrays(arrays), **columns)
+
+    def find(self, full_name):
+        """Row of a function given as ``filename:line(function_name)``, or None"""
+        match = FULL_NAME_RE.match(full_name or '')
+        if not match:
+            return None
+        filename_id = self.strings.index_of(match.group(1))
+        name_id = self.strings.index_of(match.group(3))
+        if filename_id is None or name_id is None:
+            return None
+        rows = np.flatnonzero(
+            (self.filename_id == filename_id) &
+            (self.name_id == name_id) &
+            (self.line_number == int(match.group(2)))
+        )
+        return int(rows[0]) if len(rows) else None
+
+    def full_name(self, index):
+        index = int(index)
+        return (f"{self.strings.get(self.filename_id[index])}:"
+                f"{int(self.line_number[index])}({self.strings.get(self.name_id[index])})")
+
+    def column(self, name):
+        """Return a sortable array for a public column name"""
+        if name == 'per_call':
+            return np.divide(self.cumulative_time, self.calls,
+                             out=np.zeros(len(self), dtype=np.float64),
+                             where=self.calls > 0)
+        if name in ('filename', 'name'):
+            return self.strings.ranks()[self.filename_id]
+        if name == 'function_name':
+            return self.strings.ranks()[self.name_id]
+        return getattr(self, name)
+
+    def order_by(self, column, descending=True):
+        """Row permutation sorted by ``column``; stable and cached per key"""
+        if descending and self.views is not None and column in self.views.orders:
+            return self.views.orders[column]
+        key = (column, descending)
+        order = self._orders.get(key)
+        if order is None:
+            values = self.column(column)
+            if column == 'name':
+                # Full name sorts by file, then line, then function name
+                order = np.lexsort((self.strings.ranks()[self.name_id],
+                                    self.line_number, values))
+                if descending:
+                    order = order[::-1]
+            else:
+                # Negating keeps ties in row order for descending sorts too
+                order = np.argsort(-values if descending else values, kind='stable')
+            self._orders[key] = order
+        return order
+
+    def top(self, column, limit, descending=True, offset=0):
+        """Row indices for one page of the table sorted by ``column``"""
+        count = len(self)
+        offset = max(0, min(offset, count))
+        end = min(count, offset + max(0, limit))
+        return self.order_by(column, descending)[offset:end]
+
+    def row(self, index):
+        """Return one function in the dict shape used by the API"""
+        index = int(index)
+        filename = self.strings.get(self.filename_id[index])
+        function_name = self.strings.get(self.name_id[index])
+        line_num = int(self.line_number[index])
+        calls = int(self.calls[index])
+        cumulative_time = float(self.cumulative_time[index])
+        flags = int(self.flags[index])
+        return {
+            'id': index,
+            'name': f"{filename}:{line_num}({function_name})",
+            'filename': filename,
+            'line_number': line_num,
+            'function_name': function_name,
+            'calls': calls,
+            'ncalls': int(self.ncalls[index]),
+            'total_time': float(self.total_time[index]),
+            'cumulative_time': cumulative_time,
+            'per_call': cumulative_time / calls if calls > 0 else 0,
+            'is_builtin': bool(flags & FLAG_BUILTIN),
+            'is_stdlib': bool(flags & FLAG_STDLIB),
+            'is_third_party': bool(flags & FLAG_THIRD_PARTY),
+            'category': CATEGORIES[int(self.category[index])]
+        }
+
+    def rows(self, indices):
+        return [self.row(i) for i in indices]
+
+
+_loaded_tables = OrderedDict()
+_loaded_tables_lock = threading.Lock()
+LOADED_TABLES_MAX = 16
+
+
+def table_views(table):
+    """The table's saved views, or ones built and kept on the table for older files"""
+    if table.views is None:
+        table.views = ProfileViews.build(table, len(CATEGORIES))
+    return table.views
+
+
+def release_table(path):
+    """Forget any cached mapping of ``path`` and delete the file.
+
+    Returns False if the file could not be removed, e.g. because another
+    reader or process still has it mapped on Windows.
+    """
+    with _loaded_tables_lock:
+        for key in [key for key in _loaded_tables if key[0] == path]:
+            del _loaded_tables[key]
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"Could not remove table {path}, still in use: {e}")
+        return False
+    return True
+
+
+def release_tables(directory):
+    """Forget the cached mappings of every table under ``directory`` so it can be removed"""
+    prefix = os.path.join(directory, '')
+    with _loaded_tables_lock:
+        for key in [key for key in _loaded_tables if key[0].startswith(prefix)]:
+            del _loaded_tables[key]
+
+
+def load_table(path):
+    """Map a table, reusing a recently mapped copy while the file is unchanged"""
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    with _loaded_tables_lock:
+        table = _loaded_tables.get(key)
+        if table is not None:
+            _loaded_tables.move_to_end(key)
+            return table
+    table = ProfileTable.load(path)
+    with _loaded_tables_lock:
+        _loaded_tables[key] = table
+        while len(_loaded_tables) > LOADED_TABLES_MAX:
+            _loaded_tables.popitem(last=False)
+    return table
@@ -0,0 +1,256 @@
+"""Derived views of a profile, built once at ingest and saved in its table file.
+
+- Sort orders: the descending row permutation of every timing and call
+  column, so a top-N page by any metric is a slice rather than a sort.
+- Category rollups: function count, calls and self time (tottime) per
+  category, plus each category's heaviest functions by self time. Self
+  times partition the profile, so the rollups add up to the total.
+- Flame tree: the call tree a flamegraph or icicle chart draws. pstats
+  keeps no stacks, only caller edges, so the tree is rebuilt by walking
+  callees from the root functions and giving each child its edge's share
+  of the parent's time (a function reached from several callers splits
+  its callees' time between them in the same proportions). The heaviest
+  nodes are expanded first, up to ``MAX_TREE_NODES``, and recursion stops
+  at a function already on the path. Nodes are stored in preorder with
+  the heaviest child first, and ``tree_end`` gives where each subtree
+  ends, so a zoomed-in subtree is a slice.
+
+The views only depend on the table, so they change exactly when the
+profile does.
+"""
+import heapq
+
+import numpy as np
+
+ORDER_COLUMNS = ('cumulative_time', 'total_time', 'per_call', 'calls', 'ncalls')
+VIEW_ARRAYS = (
+    'category_functions', 'category_calls', 'category_total_time',
+    'category_top_offsets', 'category_top_rows',
+    'tree_row', 'tree_parent', 'tree_end', 'tree_value', 'tree_self_time'
+)
+ARRAY_PREFIX = 'views_'
+CATEGORY_TOP_COUNT = 50
+MAX_TREE_NODES = 5000
+MAX_TREE_DEPTH = 256
+# Nodes below this share of the root's time are not expanded into the tree
+MIN_TREE_FRACTION = 1e-5
+
+
+class ProfileViews:
+    """Precomputed sort orders, category rollups and flame tree of one ProfileTable"""
+
+    def __init__(self, orders, category_functions, category_calls, category_total_time,
+                 category_top_offsets, category_top_rows, tree_row, tree_parent, tree_end,
+                 tree_value, tree_self_time):
+        self.orders = orders
+        self.category_functions = category_functions
+        self.category_calls = category_calls
+        self.category_total_time = category_total_time
+        self.category_top_offsets = category_top_offsets
+        self.category_top_rows = category_top_rows
+        self.tree_row = tree_row
+        self.tree_parent = tree_parent
+        self.tree_end = tree_end
+        self.tree_value = tree_value
+        self.tree_self_time = tree_self_time
+
+    @classmethod
+    def build(cls, table, category_count):
+        orders = {
+            column: np.argsort(-table.column(column), kind='stable').astype(np.int32)
+            for column in ORDER_COLUMNS
+        }
+        category = table.category.astype(np.int64)
+        category_functions = np.bincount(category, minlength=category_count).astype(np.int64)
+        category_calls = np.bincount(category, weights=table.calls, minlength=category_count).astype(np.int64)
+        category_total_time = np.bincount(category, weights=table.total_time, minlength=category_count)
+
+        # Rows ordered by category, then by self time within it; keep each category's head
+        by_time = orders['total_time']
+        grouped = by_time[np.argsort(category[by_time], kind='stable')]
+        starts = np.concatenate(([0], np.cumsum(category_functions)[:-1]))
+        kept = np.minimum(category_functions, CATEGORY_TOP_COUNT)
+        category_top_offsets = np.zeros(category_count + 1, dtype=np.int64)
+        np.cumsum(kept, out=category_top_offsets[1:])
+        category_top_rows = np.concatenate(
+            [grouped[start:start + count] for start, count in zip(starts, kept)] or [np.empty(0, np.int32)]
+        ).astype(np.int32)
+
+        return cls(orders, category_functions, category_calls, category_total_time,
+                   category_top_offsets, category_top_rows, *build_flame_tree(table))
+
+    def arrays(self):
+        arrays = {f"{ARRAY_PREFIX}order_{column}": order for column, order in self.orders.items()}
+        arrays.update((f"{ARRAY_PREFIX}{name}", getattr(self, name)) for name in VIEW_ARRAYS)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Rebuild from saved arrays, or return None if the table was saved without views"""
+        if f"{ARRAY_PREFIX}tree_row" not in arrays:
+            return None
+        orders = {column: arrays[f"{ARRAY_PREFIX}order_{column}"] for column in ORDER_COLUMNS}
+        return cls(orders, **{name: arrays[f"{ARRAY_PREFIX}{name}"] for name in VIEW_ARRAYS})
+
+    def category_top(self, category_id, limit):
+        start = self.category_top_offsets[category_id]
+        return self.category_top_rows[start:min(start + limit, self.category_top_offsets[category_id + 1])]
+
+
+def build_flame_tree(table, max_nodes=MAX_TREE_NODES):
+    """(row, parent, end, value, self time) arrays of the flame tree; node 0 is a synthetic root (row -1)"""
+    graph = table.graph
+    cumulative = np.asarray(table.cumulative_time, dtype=np.float64)
+    if graph is not None and len(table):
+        has_callers = np.diff(graph.callers_offsets) > 0
+        roots = np.flatnonzero(~has_callers & (cumulative > 0))
+        if not len(roots):
+            # Every function sits in a cycle; start from the heaviest
+            roots = np.array([int(np.argmax(cumulative))])
+    else:
+        roots = np.flatnonzero(cumulative > 0)
+    roots = roots[np.argsort(-cumulative[roots], kind='stable')]
+    total = float(cumulative[roots].sum()) if len(roots) else 0.0
+
+    # Scalar reads from lists are much cheaper than from arrays in the loop below
+    cumulative_of = cumulative.tolist()
+    own_of = np.asarray(table.total_time, dtype=np.float64).tolist()
+    if graph is not None:
+        # Every row's callees, heaviest edge first, sorted once for the whole tree
+        edge_order = np.lexsort((-graph.cumulative_time, graph.caller))
+        callees = graph.callee[edge_order].tolist()
+        edge_times = graph.cumulative_time[edge_order].tolist()
+        callee_offsets = graph.callees_offsets.tolist()
+
+    rows, parents, values, self_times, depths = [-1], [-1], [total], [0.0], [0]
+    in_tree = set()
+    min_value = total * MIN_TREE_FRACTION
+    pending = []
+
+    def add_node(row, parent, value):
+        node = len(rows)
+        rows.append(row)
+        parents.append(parent)
+        values.append(value)
+        self_times.append(value * own_of[row] / cumulative_of[row] if cumulative_of[row] > 0 else 0.0)
+        depths.append(depths[parent] + 1)
+        in_tree.add(row)
+        if graph is not None and depths[node] < MAX_TREE_DEPTH:
+            heapq.heappush(pending, (-value, node))
+
+    for row in roots.tolist():
+        if len(rows) >= max_nodes or cumulative_of[row] < min_value:
+            break
+        add_node(row, 0, cumulative_of[row])
+
+    # Heaviest first, so the node limit drops the lightest branches
+    while pending and len(rows) < max_nodes:
+        _, node = heapq.heappop(pending)
+        row = rows[node]
+        value = values[node]
+        scale = value / cumulative_of[row] if cumulative_of[row] > 0 else 0.0
+        on_path = None
+        for index in range(callee_offsets[row], callee_offsets[row + 1]):
+            # Recursion can give an edge more time than its caller; a child never outweighs its parent
+            child_value = min(edge_times[index] * scale, value)
+            if child_value < min_value or len(rows) >= max_nodes:
+                break
+            callee = callees[index]
+            if callee in in_tree:
+                # Only a function already in the tree can be on this node's path
+                if on_path is None:
+                    on_path = set()
+                    ancestor = node
+                    while ancestor > 0:
+                        on_path.add(rows[ancestor])
+                        ancestor = parents[ancestor]
+                if callee in on_path:
+                    continue
+            add_node(callee, node, child_value)
+
+    # Nodes are created parent first and siblings heaviest first, so each node's
+    # preorder position is its parent's plus the sizes of the siblings before it
+    count = len(rows)
+    size = [1] * count
+    for node in range(count - 1, 0, -1):
+        size[parents[node]] += size[node]
+    position = [0] * count
+    next_position = [1] * count
+    for node in range(1, count):
+        parent = parents[node]
+        position[node] = next_position[parent]
+        next_position[parent] += size[node]
+        next_position[node] = position[node] + 1
+
+    order = np.empty(count, dtype=np.int64)
+    order[position] = np.arange(count)
+    position = np.array(position, dtype=np.int64)
+    parent = np.array(parents, dtype=np.int64)[order]
+    tree_parent = np.where(parent >= 0, position[np.maximum(parent, 0)], -1).astype(np.int32)
+    tree_end = position[order] + np.array(size, dtype=np.int64)[order]
+    return (np.array(rows, dtype=np.int32)[order], tree_parent, tree_end,
+            np.array(values, dtype=np.float64)[order], np.array(self_times, dtype=np.float64)[order])
+
+
+def flame_tree_view(table, views, root=0, min_fraction=0.0, max_nodes=MAX_TREE_NODES):
+    """JSON-ready subtree of the flame tree below node ``root``.
+
+    Nodes lighter than ``min_fraction`` of the subtree root are dropped;
+    since a child never outweighs its parent, what is left is still a
+    tree. Function details are listed once per distinct row.
+    """
+    end = int(views.tree_end[root])
+    rows = views.tree_row[root:end]
+    values = views.tree_value[root:end]
+    keep = np.flatnonzero(values >= values[0] * min_fraction)[:max_nodes] if len(values) else np.empty(0, int)
+    # Remap parents onto the kept nodes
+    position = np.full(end - root, -1, dtype=np.int64)
+    position[keep] = np.arange(len(keep))
+    parents = views.tree_parent[root:end][keep].astype(np.int64) - root
+    parents = np.where(parents >= 0, position[np.maximum(parents, 0)], -1)
+    parents[0] = -1
+    kept_rows = rows[keep]
+    functions = {int(row): table.row(row) for row in np.unique(kept_rows[kept_rows >= 0]).tolist()}
+    return {
+        'root': int(root),
+        'total_time': float(values[0]) if len(values) else 0.0,
+        'node_count': len(keep),
+        'nodes': {
+            'id': (keep + root).tolist(),
+            'function_id': kept_rows.tolist(),
+            'parent': parents.tolist(),
+            'value': values[keep].tolist(),
+            'self_time': views.tree_self_time[root:end][keep].tolist()
+        },
+        'functions': functions
+    }
+
+
+def collapsed_stacks(table, views, root=0, min_fraction=0.0):
+    """flamegraph.pl lines (``a;b;c seconds``) of the subtree below ``root``, by self time"""
+    end = int(views.tree_end[root])
+    threshold = float(views.tree_value[root]) * min_fraction
+    names = {}
+    path = []  # (node, name) from the subtree root down to the current node's parent
+    lines = []
+    index = root
+    while index < end:
+        if views.tree_value[index] < threshold:
+            # Children are never heavier than their parent, so skip the whole subtree
+            index = int(views.tree_end[index])
+            continue
+        parent = int(views.tree_parent[index])
+        while path and path[-1][0] != parent:
+            path.pop()
+        row = int(views.tree_row[index])
+        name = None
+        if row >= 0:
+            name = names.get(row)
+            if name is None:
+                name = names[row] = table.full_name(row).replace(';', ':')
+        path.append((index, name))
+        self_time = float(views.tree_self_time[index])
+        if self_time > 0:
+            lines.append(';'.join(name for _, name in path if name is not None) + f" {self_time:.9f}")
+        index += 1
+    return lines
@@ -0,0 +1,175 @@
+"""Statistical regression detection between repeated runs.
+
+Several uploads of the same job form a baseline set and a candidate set.
+For every function the per-run times of the two sets are compared with a
+Mann-Whitney U test (exact null distribution for small samples, normal
+approximation otherwise), computed for all functions at once. p-values
+are corrected with Benjamini-Hochberg, and the functions that pass are
+reported with effect sizes and a bootstrap confidence interval for the
+relative change in mean time.
+"""
+import math
+
+import numpy as np
+
+from comparison import AlignedProfiles
+
+# Above this many (baseline x candidate) pairs the normal approximation is used
+EXACT_PAIR_LIMIT = 2500
+BOOTSTRAP_RESAMPLES = 2000
+PAIRWISE_CHUNK_ELEMENTS = 16 * 1024 * 1024
+
+
+def _exact_u_cdf(m, n):
+    """CDF of the Mann-Whitney U statistic for sample sizes m and n without ties"""
+    # counts[i][j] holds the distribution of U for sizes (i, j)
+    counts = [[None] * (n + 1) for _ in range(m + 1)]
+    for i in range(m + 1):
+        for j in range(n + 1):
+            if i == 0 or j == 0:
+                counts[i][j] = np.array([1.0])
+                continue
+            # The largest value is either a baseline value (adds no pairs)
+            # or a candidate value that beats all i baseline values
+            dist = np.zeros(i * j + 1)
+            without_baseline = counts[i - 1][j]
+            dist[:len(without_baseline)] += without_baseline
+            without_candidate = counts[i][j - 1]
+            dist[i:i + len(without_candidate)] += without_candidate
+            counts[i][j] = dist
+    dist = counts[m][n]
+    return np.cumsum(dist) / dist.sum()
+
+
+def mann_whitney(baseline, candidate):
+    """Vectorised two-sided Mann-Whitney U test along rows.
+
+    ``baseline`` is (functions, m) and ``candidate`` is (functions, n).
+    Returns (U of the candidate, two-sided p-values).
+    """
+    m, n = baseline.shape[1], candidate.shape[1]
+    u = np.empty(len(baseline))
+    # Pairwise comparisons are (rows, n, m); chunk rows to bound memory
+    chunk = max(1, PAIRWISE_CHUNK_ELEMENTS // max(1, m * n))
+    for start in range(0, len(baseline), chunk):
+        base = baseline[start:start + chunk, None, :]
+        cand = candidate[start:start + chunk, :, None]
+        u[start:start + chunk] = (cand > base).sum(axis=(1, 2)) + 0.5 * (cand == base).sum(axis=(1, 2))
+
+    if m * n <= EXACT_PAIR_LIMIT:
+        cdf = _exact_u_cdf(m, n)
+        lower = cdf[np.floor(u).astype(np.int64)]
+        upper_index = np.ceil(u).astype(np.int64) - 1
+        upper = 1.0 - np.where(upper_index >= 0, cdf[np.clip(upper_index, 0, None)], 0.0)
+        p = np.minimum(1.0, 2.0 * np.minimum(lower, upper))
+    else:
+        mean = m * n / 2.0
+        sd = math.sqrt(m * n * (m + n + 1) / 12.0)
+        z = (np.abs(u - mean) - 0.5) / sd
+        p = np.array([math.erfc(value / math.sqrt(2)) for value in np.clip(z, 0, None)])
+    return u, p
+
+
+def benjamini_hochberg(p_values):
+    """False-discovery-rate adjusted p-values"""
+    count = len(p_values)
+    if count == 0:
+        return p_values
+    order = np.argsort(p_values)
+    ranked = p_values[order] * count / np.arange(1, count + 1)
+    adjusted = np.minimum.accumulate(ranked[::-1])[::-1]
+    result = np.empty(count)
+    result[order] = np.minimum(adjusted, 1.0)
+    return result
+
+
+def bootstrap_change_interval(baseline, candidate, resamples=BOOTSTRAP_RESAMPLES, confidence=0.95, seed=0):
+    """Bootstrap interval of mean(candidate) / mean(baseline) - 1, per row"""
+    rng = np.random.default_rng(seed)
+    m, n = baseline.shape[1], candidate.shape[1]
+    base_means = baseline[:, rng.integers(0, m, size=(resamples, m))].mean(axis=2)
+    cand_means = candidate[:, rng.integers(0, n, size=(resamples, n))].mean(axis=2)
+    change = np.divide(cand_means, base_means, out=np.full_like(cand_means, np.nan),
+                       where=base_means > 0) - 1.0
+    tail = (1.0 - confidence) / 2 * 100
+    return np.nanpercentile(change, [tail, 100 - tail], axis=1)
+
+
+def detect_regressions(baseline_tables, candidate_tables, metric='cumulative_time',
+                       alpha=0.05, min_time=0.001, min_change_pct=5.0, limit=50,
+                       correction='fdr'):
+    """Rank statistically significant per-function regressions and improvements
+
+    ``correction`` is 'fdr' (Benjamini-Hochberg over all tested functions) or
+    'none'. With only a few runs per set the smallest achievable p-value is
+    large, so FDR correction over thousands of functions needs more runs.
+    """
+    tables = list(baseline_tables) + list(candidate_tables)
+    m = len(baseline_tables)
+    aligned = AlignedProfiles(tables)
+    values = aligned.values[metric]
+    baseline, candidate = values[:, :m], values[:, m:]
+
+    # Only functions that matter in at least one run are tested
+    tested = np.flatnonzero(values.max(axis=1) >= min_time) if len(values) else np.empty(0, dtype=np.int64)
+    base_t, cand_t = baseline[tested], candidate[tested]
+    u, p = mann_whitney(base_t, cand_t)
+    q = benjamini_hochberg(p) if correction == 'fdr' else p
+
+    base_median = np.median(base_t, axis=1) if len(tested) else np.empty(0)
+    cand_median = np.median(cand_t, axis=1) if len(tested) else np.empty(0)
+    change_pct = np.divide(cand_median - base_median, base_median,
+                           out=np.full(len(tested), np.inf), where=base_median > 0) * 100
+    cliffs_delta = 2.0 * u / (m * len(candidate_tables)) - 1.0
+
+    significant = (q <= alpha) & (np.abs(change_pct) >= min_change_pct)
+    regressed = significant & (cand_median > base_median)
+    improved = significant & (cand_median < base_median)
+
+    def report(mask, descending):
+        rows = np.flatnonzero(mask)
+        impact = cand_median[rows] - base_median[rows]
+        rows = rows[np.argsort(-impact if descending else impact, kind='stable')][:limit]
+        if not len(rows):
+            return []
+        low, high = bootstrap_change_interval(base_t[rows], cand_t[rows])
+        results = []
+        for k, row in enumerate(rows):
+            function = tested[row]
+            results.append({
+                'name': aligned.name(function),
+                'baseline': base_t[row].tolist(),
+                'candidate': cand_t[row].tolist(),
+                'baseline_median': float(base_median[row]),
+                'candidate_median': float(cand_median[row]),
+                'absolute_change': float(cand_median[row] - base_median[row]),
+                'change_pct': float(change_pct[row]) if np.isfinite(change_pct[row]) else None,
+                'change_pct_ci': [
+                    float(low[k]) * 100 if np.isfinite(low[k]) else None,
+                    float(high[k]) * 100 if np.isfinite(high[k]) else None
+                ],
+                'cliffs_delta': float(cliffs_delta[row]),
+                'p_value': float(p[row]),
+                'q_value': float(q[row])
+            })
+        return results
+
+    if m * len(candidate_tables) <= EXACT_PAIR_LIMIT:
+        min_p = float(min(1.0, 2.0 * _exact_u_cdf(m, len(candidate_tables))[0]))
+    else:
+        min_p = 0.0
+
+    return {
+        'metric': metric,
+        'alpha': alpha,
+        'correction': correction,
+        'min_time': min_time,
+        'min_change_pct': min_change_pct,
+        'function_count': len(aligned),
+        'tested_function_count': int(len(tested)),
+        'min_achievable_p_value': min_p,
+        'significant_regression_count': int(regressed.sum()),
+        'significant_improvement_count': int(improved.sum()),
+        'regressions': report(regressed, descending=True),
+        'improvements': report(improved, descending=False)
+    }
@@ -0,0 +1,47 @@
+"""Compression of large API responses.
+
+Bodies above a size threshold are brotli compressed when the client
+accepts it and the optional ``brotli`` package is installed, otherwise
+gzip compressed. Streamed and file responses pass through untouched.
+"""
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'text/plain', 'text/html', 'text/csv')
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+
+def choose_encoding(accept_encodings):
+    """Best supported encoding from a request's ``accept_encodings``, or None"""
+    if brotli is not None and accept_encodings['br']:
+        return 'br'
+    if accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress_response(response, accept_encodings, min_bytes):
+    """Compress ``response`` in place when it is large enough and the client allows it"""
+    if (response.direct_passthrough or response.is_streamed or response.status_code != 200
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    encoding = choose_encoding(accept_encodings)
+    if encoding is None or len(body) < min_bytes:
+        return response
+
+    if encoding == 'br':
+        compressed = brotli.compress(body, quality=BROTLI_QUALITY)
+    else:
+        compressed = gzip.compress(body, compresslevel=GZIP_LEVEL)
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    return response
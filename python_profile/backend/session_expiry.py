@@ -0,0 +1,110 @@
+"""Expiry index for session data.
+
+Tracks when each session last wrote data so cleanup can ask for exactly
+the sessions that have expired instead of listing and stat-ing every
+directory. The index is a small SQLite table ordered by last-touched time
+and survives restarts.
+"""
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS sessions ("
+    " session_id TEXT PRIMARY KEY,"
+    " last_touched REAL NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS sessions_last_touched ON sessions (last_touched)",
+)
+
+
+class SessionExpiryIndex:
+    """session_id -> last touched time, queryable by age"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        with closing(self._connect()) as conn, conn:
+            for statement in SCHEMA:
+                conn.execute(statement)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def touch(self, session_id, when=None):
+        """Record that a session just wrote data"""
+        when = time.time() if when is None else when
+        with self._lock, closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT INTO sessions (session_id, last_touched) VALUES (?, ?) "
+                "ON CONFLICT(session_id) DO UPDATE SET last_touched = MAX(last_touched, excluded.last_touched)",
+                (session_id, when)
+            )
+
+    def seed(self, entries):
+        """Add (session_id, last_touched) pairs without overriding newer entries"""
+        with self._lock, closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "INSERT INTO sessions (session_id, last_touched) VALUES (?, ?) "
+                "ON CONFLICT(session_id) DO UPDATE SET last_touched = MAX(last_touched, excluded.last_touched)",
+                entries
+            )
+
+    def expired(self, cutoff, limit):
+        """Oldest session ids last touched before ``cutoff``, at most ``limit``"""
+        with self._lock, closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT session_id FROM sessions WHERE last_touched < ? "
+                "ORDER BY last_touched LIMIT ?",
+                (cutoff, limit)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def remove(self, session_ids):
+        with self._lock, closing(self._connect()) as conn, conn:
+            conn.executemany("DELETE FROM sessions WHERE session_id = ?",
+                             [(session_id,) for session_id in session_ids])
+
+    def __len__(self):
+        with self._lock, closing(self._connect()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+
+class ExpiryScheduler:
+    """Background thread that runs a cleanup callback at a fixed interval"""
+
+    def __init__(self, cleanup, interval_seconds, leader_lock=None):
+        """With a ``leader_lock``, only the process holding it runs ``cleanup``;
+        the others keep trying to take it over at every interval."""
+        self.cleanup = cleanup
+        self.interval_seconds = interval_seconds
+        self.leader_lock = leader_lock
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='session-expiry', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def is_leader(self):
+        """True if this process runs the cleanup (taking the leader lock when free)"""
+        return self.leader_lock is None or self.leader_lock.acquire(blocking=False)
+
+    @property
+    def leading(self):
+        """True if this process holds the cleanup role right now; never takes the lock"""
+        return self.leader_lock is None or self.leader_lock.held
+
+    def _run(self):
+        while not self._stop.wait(self.interval_seconds):
+            if not self.is_leader():
+                continue
+            try:
+                self.cleanup()
+            except Exception as e:
+                print(f"Background cleanup error: {e}")
@@ -0,0 +1,249 @@
+"""Persistent history of batch-job profiles.
+
+Opt-in and separate from session storage, which expires after a day.
+Every recorded run is tagged with a job name, run id and timestamp and
+appended to the partition for its job and month,
+``<root>/<job>/<YYYY-MM>.db``. Partitions are SQLite databases that are
+only ever inserted into, so old months can be archived or deleted as
+whole files. A run keeps its totals plus the timings of its heaviest
+functions, clustered by (function, time) so the series of one function
+over a range is a single index scan per month.
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+import numpy as np
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS runs ("
+    " run_id TEXT PRIMARY KEY, ts REAL NOT NULL, recorded_at REAL NOT NULL,"
+    " filename TEXT, content_hash TEXT, total_calls INTEGER NOT NULL,"
+    " total_time REAL NOT NULL, function_count INTEGER NOT NULL, stored_functions INTEGER NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS functions (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)",
+    "CREATE TABLE IF NOT EXISTS points ("
+    " function_id INTEGER NOT NULL, ts REAL NOT NULL, run_id TEXT NOT NULL,"
+    " calls INTEGER NOT NULL, total_time REAL NOT NULL, cumulative_time REAL NOT NULL,"
+    " PRIMARY KEY (function_id, ts, run_id)) WITHOUT ROWID",
+    "CREATE INDEX IF NOT EXISTS points_by_run ON points (run_id)",
+)
+RUN_COLUMNS = ('run_id', 'ts', 'recorded_at', 'filename', 'content_hash', 'total_calls',
+               'total_time', 'function_count', 'stored_functions')
+POINT_METRICS = ('calls', 'total_time', 'cumulative_time')
+JOB_FILE = 'job.json'
+PARTITION_SUFFIX = '.db'
+MAX_NAME_LENGTH = 200
+# Names per SELECT ... IN (...); older SQLite allows 999 parameters
+NAME_QUERY_BATCH = 500
+
+
+class TrendRunExists(ValueError):
+    """The run id is already recorded for the job; runs are never overwritten"""
+
+
+def validate_name(value, what):
+    """Return a job name or run id stripped of surrounding space, or raise ValueError"""
+    value = str(value or '').strip()
+    if not value or len(value) > MAX_NAME_LENGTH or any(ord(c) < 32 for c in value):
+        raise ValueError(f'{what} must be 1-{MAX_NAME_LENGTH} printable characters')
+    return value
+
+
+def _month(timestamp):
+    return time.strftime('%Y-%m', time.gmtime(timestamp))
+
+
+class TrendStore:
+    """Append-only per-job, per-month history of profile runs"""
+
+    def __init__(self, root, functions_per_run=10000):
+        """``functions_per_run`` caps the functions kept per run, heaviest first"""
+        self.root = root
+        self.functions_per_run = functions_per_run
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _job_dir(self, job):
+        slug = re.sub(r'[^A-Za-z0-9._-]+', '_', job).strip('._')[:48] or 'job'
+        return os.path.join(self.root, f"{slug}-{hashlib.sha1(job.encode('utf-8')).hexdigest()[:10]}")
+
+    def _partitions(self, job, start=None, end=None):
+        """Partition files of a job overlapping [start, end], oldest first"""
+        job_dir = self._job_dir(job)
+        if not os.path.isdir(job_dir):
+            return []
+        first = _month(start) if start is not None else None
+        last = _month(end) if end is not None else None
+        return [
+            os.path.join(job_dir, name)
+            for name in sorted(os.listdir(job_dir))
+            if name.endswith(PARTITION_SUFFIX)
+            and (first is None or name[:7] >= first) and (last is None or name[:7] <= last)
+        ]
+
+    def _connect(self, path):
+        conn = sqlite3.connect(path, timeout=30)
+        for statement in SCHEMA:
+            conn.execute(statement)
+        return conn
+
+    def _heaviest_rows(self, table):
+        """Rows kept for a run: the top functions by cumulative and by own time"""
+        limit = self.functions_per_run
+        if len(table) <= limit:
+            return np.arange(len(table))
+        return np.union1d(table.top('cumulative_time', limit), table.top('total_time', limit))
+
+    def has_run(self, job, run_id):
+        for path in self._partitions(job):
+            with closing(self._connect(path)) as conn:
+                if conn.execute("SELECT 1 FROM runs WHERE run_id = ?", (run_id,)).fetchone():
+                    return True
+        return False
+
+    def record_run(self, job, run_id, timestamp, table, filename=None, content_hash=None):
+        """Append one run of ``job``; raises TrendRunExists if ``run_id`` is taken"""
+        if self.has_run(job, run_id):
+            raise TrendRunExists(f'Run {run_id} is already recorded for job {job}')
+        rows = self._heaviest_rows(table)
+        names = [table.full_name(row) for row in rows]
+        run = {
+            'run_id': run_id,
+            'ts': float(timestamp),
+            'recorded_at': time.time(),
+            'filename': filename,
+            'content_hash': content_hash,
+            'total_calls': int(table.ncalls.sum()),
+            'total_time': float(table.total_time.sum()),
+            'function_count': len(table),
+            'stored_functions': len(rows)
+        }
+
+        job_dir = self._job_dir(job)
+        os.makedirs(job_dir, exist_ok=True)
+        job_file = os.path.join(job_dir, JOB_FILE)
+        if not os.path.exists(job_file):
+            tmp_path = f"{job_file}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({'job': job}, f)
+            os.replace(tmp_path, job_file)
+
+        path = os.path.join(job_dir, f"{_month(timestamp)}{PARTITION_SUFFIX}")
+        with self._lock, closing(self._connect(path)) as conn, conn:
+            try:
+                conn.execute(
+                    f"INSERT INTO runs ({', '.join(RUN_COLUMNS)}) VALUES ({', '.join('?' * len(RUN_COLUMNS))})",
+                    [run[column] for column in RUN_COLUMNS]
+                )
+            except sqlite3.IntegrityError:
+                raise TrendRunExists(f'Run {run_id} is already recorded for job {job}')
+            conn.executemany("INSERT OR IGNORE INTO functions (name) VALUES (?)", ((name,) for name in names))
+            # Only this run's names, so the cost follows the run rather than the partition's history
+            ids = {}
+            for start in range(0, len(names), NAME_QUERY_BATCH):
+                batch = names[start:start + NAME_QUERY_BATCH]
+                ids.update(conn.execute(
+                    f"SELECT name, id FROM functions WHERE name IN ({', '.join('?' * len(batch))})", batch
+                ))
+            conn.executemany(
+                "INSERT INTO points (function_id, ts, run_id, calls, total_time, cumulative_time) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                zip((ids[name] for name in names), [run['ts']] * len(names), [run_id] * len(names),
+                    table.calls[rows].tolist(), table.total_time[rows].tolist(),
+                    table.cumulative_time[rows].tolist())
+            )
+        return dict(run, job=job)
+
+    def jobs(self):
+        """Every job with its run count and time span"""
+        jobs = []
+        for entry in sorted(os.listdir(self.root)):
+            job_file = os.path.join(self.root, entry, JOB_FILE)
+            if not os.path.isfile(job_file):
+                continue
+            with open(job_file) as f:
+                job = json.load(f)['job']
+            runs, first, last = 0, None, None
+            for path in self._partitions(job):
+                with closing(self._connect(path)) as conn:
+                    count, low, high = conn.execute("SELECT COUNT(*), MIN(ts), MAX(ts) FROM runs").fetchone()
+                if count:
+                    runs += count
+                    first = low if first is None else min(first, low)
+                    last = high if last is None else max(last, high)
+            jobs.append({'job': job, 'runs': runs, 'first_ts': first, 'last_ts': last})
+        return jobs
+
+    def runs(self, job, start=None, end=None):
+        """Runs of a job in [start, end], oldest first"""
+        runs = []
+        for path in self._partitions(job, start, end):
+            with closing(self._connect(path)) as conn:
+                runs.extend(
+                    dict(zip(RUN_COLUMNS, row)) for row in conn.execute(
+                        f"SELECT {', '.join(RUN_COLUMNS)} FROM runs WHERE ts BETWEEN ? AND ? ORDER BY ts",
+                        (start if start is not None else float('-inf'), end if end is not None else float('inf'))
+                    )
+                )
+        return runs
+
+    def function_series(self, job, function_name, start=None, end=None):
+        """Timings of one function (``file:line(name)``) per run, as parallel arrays sorted by time.
+
+        Runs where the function was not among the stored heaviest are absent.
+        """
+        rows = []
+        for path in self._partitions(job, start, end):
+            with closing(self._connect(path)) as conn:
+                rows.extend(conn.execute(
+                    "SELECT p.ts, p.run_id, p.calls, p.total_time, p.cumulative_time "
+                    "FROM points p JOIN functions f ON f.id = p.function_id "
+                    "WHERE f.name = ? AND p.ts BETWEEN ? AND ? ORDER BY p.ts",
+                    (function_name, start if start is not None else float('-inf'),
+                     end if end is not None else float('inf'))
+                ))
+        return {
+            'ts': np.array([row[0] for row in rows], dtype=np.float64),
+            'run_id': [row[1] for row in rows],
+            'calls': np.array([row[2] for row in rows], dtype=np.int64),
+            'total_time': np.array([row[3] for row in rows], dtype=np.float64),
+            'cumulative_time': np.array([row[4] for row in rows], dtype=np.float64)
+        }
+
+    def totals_series(self, job, start=None, end=None):
+        """Whole-run totals shaped like function_series (no cumulative_time)"""
+        runs = self.runs(job, start, end)
+        return {
+            'ts': np.array([run['ts'] for run in runs], dtype=np.float64),
+            'run_id': [run['run_id'] for run in runs],
+            'calls': np.array([run['total_calls'] for run in runs], dtype=np.int64),
+            'total_time': np.array([run['total_time'] for run in runs], dtype=np.float64)
+        }
+
+    def latest_functions(self, job, text=None, metric='cumulative_time', limit=50):
+        """Heaviest stored functions of the job's latest run, optionally filtered by substring"""
+        if metric not in POINT_METRICS:
+            raise ValueError(f'metric must be one of {", ".join(POINT_METRICS)}')
+        for path in reversed(self._partitions(job)):
+            with closing(self._connect(path)) as conn:
+                latest = conn.execute("SELECT run_id, ts FROM runs ORDER BY ts DESC LIMIT 1").fetchone()
+                if latest is None:
+                    continue
+                rows = conn.execute(
+                    "SELECT f.name, p.calls, p.total_time, p.cumulative_time "
+                    "FROM points p JOIN functions f ON f.id = p.function_id "
+                    "WHERE p.run_id = ? AND instr(lower(f.name), ?) > 0 "
+                    f"ORDER BY p.{metric} DESC LIMIT ?",
+                    (latest[0], (text or '').lower(), limit)
+                ).fetchall()
+            return {
+                'run_id': latest[0],
+                'ts': latest[1],
+                'functions': [dict(zip(('name',) + POINT_METRICS, row)) for row in rows]
+            }
+        return {'run_id': None, 'ts': None, 'functions': []}
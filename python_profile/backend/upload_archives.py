@@ -0,0 +1,92 @@
+"""Reading profile dumps out of uploaded zip and tar archives.
+
+Members are streamed one at a time, never extracted wholesale, and only
+their base names are used so an archive cannot write outside the target
+directory. Uncompressed bytes are counted while copying, so a small
+archive cannot expand past its caller's budget.
+"""
+import os
+import tarfile
+import zipfile
+
+from werkzeug.utils import secure_filename
+
+ARCHIVE_SUFFIXES = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class ArchiveTooLarge(ValueError):
+    """An archive expands past the allowed number of uncompressed bytes"""
+
+
+def is_archive(filename):
+    return filename.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def iter_archive_members(path):
+    """Yield (member name, declared size, readable file object) for every regular file in an archive"""
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                with archive.open(info) as member:
+                    yield info.filename, info.file_size, member
+        return
+
+    # Stream mode reads the tar sequentially, compressed or not
+    with tarfile.open(path, mode='r|*') as archive:
+        for info in archive:
+            if not info.isfile():
+                continue
+            member = archive.extractfile(info)
+            if member is not None:
+                with member:
+                    yield info.name, info.size, member
+
+
+def copy_bounded(member, out, limit, message):
+    """Copy ``member`` to ``out``, raising ArchiveTooLarge(message) past ``limit`` bytes; returns bytes copied"""
+    copied = 0
+    while True:
+        chunk = member.read(COPY_CHUNK_SIZE)
+        if not chunk:
+            return copied
+        copied += len(chunk)
+        if copied > limit:
+            raise ArchiveTooLarge(message)
+        out.write(chunk)
+
+
+def extract_profile_members(path, target_dir, accept, max_members=10000, max_member_bytes=None,
+                            max_total_bytes=None):
+    """Copy archive members whose name passes ``accept`` into ``target_dir``.
+
+    No member may expand past ``max_member_bytes``, nor all of them
+    together past ``max_total_bytes``; declared sizes are checked up front
+    and actual bytes while copying. Returns a list of (original member
+    name, extracted path, size) in archive order.
+    """
+    os.makedirs(target_dir, exist_ok=True)
+    extracted = []
+    total = 0
+    for name, declared_size, member in iter_archive_members(path):
+        base_name = os.path.basename(name.replace('\\', '/'))
+        if not accept(base_name):
+            continue
+        if len(extracted) >= max_members:
+            raise ValueError(f'Archive holds more than {max_members} profile files')
+        remaining = float('inf') if max_total_bytes is None else max_total_bytes - total
+        if max_member_bytes is not None and max_member_bytes <= remaining:
+            limit, message = max_member_bytes, f'{name} expands to more than {max_member_bytes} bytes'
+        else:
+            limit, message = remaining, f'Archive expands to more than {max_total_bytes} bytes'
+        if declared_size > limit:
+            raise ArchiveTooLarge(message)
+        safe_name = secure_filename(base_name) or 'profile.prof'
+        member_path = os.path.join(target_dir, f"{len(extracted):05d}_{safe_name}")
+        with open(member_path, 'wb') as out:
+            size = copy_bounded(member, out, limit, message)
+        total += size
+        extracted.append((name, member_path, size))
+    return extracted